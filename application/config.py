@@ -10,6 +10,7 @@ import application.inner as inner
 
 _FUNCTION_RE = re.compile(r'(%%)|(%{(\w+\(.*?\))})')
 _DEFAULT_APP_NAME = 'application'
+_TRUE_VALUES = ('true', 'yes', 'on', '1')
 
 class config(object):
     __metaclass__ = singleton
@@ -31,6 +32,16 @@ class config(object):
 
         return value
 
+    def getBoolean(self, section, option, fallback=False):
+        """
+        布尔类型的配置：true、yes、on、1(不区分大小写)为True，其它值为False，没有配置时返回fallback
+        """
+        value = self.get(section, option)
+        if value is None:
+            return fallback
+
+        return value.strip().lower() in _TRUE_VALUES
+
     def getAppName(self):
         return self.get('global', 'app_name', _DEFAULT_APP_NAME)
 
@@ -31,6 +31,14 @@ class ConnectinoPool(object):
 
         return conn
 
+    def reset(self):
+        """
+        丢弃所有的连接（但不关闭）。
+        fork出的子进程不能与父进程共用连接，需要在子进程中调用
+        """
+        with self._rlock:
+            self.connections = {}
+
     def _connect(self, database):
         section = 'mysql:' + str(database)
         conn = pymysql.connect(
@@ -54,5 +54,14 @@ class ConfigTests(unittest.TestCase):
         value  = conf.get('unittest', 'date1')
         self.assertEqual(value, 'now_is_%s.date' % (datetime.now().strftime('%Y-%m')))
 
+    def test_config_getBoolean(self):
+        conf = config()
+
+        self.assertTrue(conf.getBoolean('unittest', 'enabled'))
+        self.assertFalse(conf.getBoolean('unittest', 'disabled', True))
+        self.assertFalse(conf.getBoolean('unittest', 'not_exist'))
+        self.assertTrue(conf.getBoolean('unittest', 'not_exist', True))
+        self.assertTrue(conf.getBoolean('not_exist_section', 'not_exist', True))
+
 
 
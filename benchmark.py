@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+mapping中db_field的求值耗时：每次解析（common.resolve）与加载时编译（compiler.compileFunction）对比。
+只统计示例配置中不需要访问数据库的db_field，字段的值都使用数字。
+
+python benchmark.py [次数]
+"""
+
+from __future__ import print_function, division
+
+import os
+import sys
+import glob
+import timeit
+
+import yaml
+
+import application.app as app
+import modules.handlers.common as common
+import modules.handlers.compiler as compiler
+
+from modules.handlers.loader import Loader
+
+def collectDBFields(data, dbFields):
+    if isinstance(data, dict):
+        for key, value in data.items():
+            if key in ('db_field', 'field') and isinstance(value, basestring):
+                dbFields.append(value)
+            elif key == 'mapping' and isinstance(value, list):
+                dbFields.extend(item for item in value if isinstance(item, basestring))
+                collectDBFields(value, dbFields)
+            else:
+                collectDBFields(value, dbFields)
+    elif isinstance(data, list):
+        for item in data:
+            collectDBFields(item, dbFields)
+
+def sampleValues(dbField):
+    fields = compiler.getFields(dbField)
+    if fields is None or 'executeSQL' in dbField:
+        return None
+
+    return { field: index + 1 for index, field in enumerate(sorted(fields)) }
+
+if __name__ == '__main__':
+    prjRoot = os.path.abspath(os.path.dirname(__file__))
+    app.init(prjRoot + '/conf/app.ini')
+
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    context = { 'index': 'index', 'type': 'type', 'database': 'database', 'table': 'table' }
+
+    dbFields = []
+    for path in sorted(glob.glob(prjRoot + '/conf/handlers/*.yml')):
+        with open(path) as f:
+            collectDBFields(yaml.load(f, Loader), dbFields)
+
+    print('%-72s %12s %12s %8s' % ('db_field', 'resolve(us)', 'compile(us)', 'speedup'))
+    for dbField in sorted(set(dbFields), key=len, reverse=True):
+        values = sampleValues(dbField)
+        if values is None:
+            continue
+
+        func = compiler.compileFunction(dbField)
+        if func(values, context) != common.resolve(dbField, values=values, **context):
+            print('%-72s result mismatch' % dbField)
+            continue
+
+        resolveTime = timeit.timeit(lambda: common.resolve(dbField, values=values, **context), number=number)
+        compileTime = timeit.timeit(lambda: func(values, context), number=number)
+
+        print('%-72s %12.3f %12.3f %7.1fx' % (dbField[:72], resolveTime / number * 1e6, compileTime / number * 1e6,
+            resolveTime / compileTime))
@@ -2,7 +2,8 @@
 # -*- coding: utf-8 -*-
 
 """
-监听指定数据库的binlog
+监听指定数据库的binlog。
+可以同时监听多个数据库，同一个MySQL实例上的数据库共用一个binlog复制连接
 """
 
 from __future__ import print_function, division
@@ -16,7 +17,7 @@ import application.app as app
 
 def validate_parser():
     parser = argparse.ArgumentParser(description='监听指定MySQL的binlog，然后写入Kafka')
-    parser.add_argument('-d', '--database', type=str, action='store', required=True, help='指定的要监听binlog的数据库')
+    parser.add_argument('-d', '--database', type=str, action='append', required=True, help='指定的要监听binlog的数据库，多个数据库可以重复指定或者用逗号分隔')
     parser.add_argument('-f', '--force', action='store_true', help='是否强制更新存储在run目录下的binlog的position')
     return parser
 
@@ -27,19 +28,21 @@ if __name__ == '__main__':
     argParser = validate_parser()
     args = argParser.parse_args()
 
-    database = args.database
+    databases = []
+    for database in args.database:
+        databases.extend(db.strip() for db in database.split(',') if db.strip())
     force = args.force
-    print('database to listen to is %s' % database)
+    print('databases to listen to are %s' % ', '.join(databases))
     print('force to update binlog positions? %s' % ('Y' if force else 'N'))
 
     # 要在app.init后再import，这样可以使得logger生效
-    from services.listenservice import ListenService
-    svc = ListenService(database=database)
+    from services.listengroup import ListenGroup
+    svc = ListenGroup(databases)
 
     # 是否需要更新binlog的position
     svc.position(force=force)
 
     # 开始监听binlog
-    print("Start to listen to the binlog of %s" % database)    
+    print("Start to listen to the binlog of %s" % ', '.join(databases))    
     svc.listen()
 
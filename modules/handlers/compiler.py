@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+
+"""
+同步配置中db_field和filter的编译与分析，在加载同步配置时使用。
+这里的函数不能在配置文件中调用，配置文件中可以使用的函数见common。
+"""
+
+from __future__ import print_function, division
+
+import re
+import operator
+from numbers import Number
+
+import utils
+
+from application import IllegalConfigException
+from . import common
+from .common import _resolveFunction
+
+_FIELD_RE = re.compile(r'^[+-]?(\w+)$')
+
+# 只使用参数、不读取kwargs['values']的函数
+_ARGS_ONLY_FUNCTIONS = ('yesterday', 'max', 'min', 'sum', 'abs', 'executeSQL')
+
+def isField(funcString):
+    """
+    funcString是否直接引用一个字段（不是函数）
+    """
+    return bool(funcString) and _resolveFunction(funcString) is None and _FIELD_RE.match(funcString.strip()) is not None
+
+def getFields(funcString):
+    """
+    common.resolve(funcString)时需要读取的values中的字段。
+    无法确定时（例如自定义函数可以读取任意字段），返回None
+    """
+    fields = set()
+    if not funcString:
+        return fields
+
+    funcInfo = _resolveFunction(funcString)
+    if funcInfo is None:
+        match = _FIELD_RE.match(funcString.strip())
+        if match is None:
+            return None
+
+        fields.add(match.group(1))
+        return fields
+
+    funcName = funcInfo['name']
+    if funcName == 'echo':
+        return fields
+
+    if funcName not in _ARGS_ONLY_FUNCTIONS:
+        return None
+
+    for arg in funcInfo['args']:
+        argFields = getFields(arg)
+        if argFields is None:
+            return None
+        fields.update(argFields)
+
+    return fields
+
+def compileFunction(funcString):
+    """
+    把funcString编译为函数 f(values, context)，结果与 common.resolve(funcString, values=values, **context) 相同。
+    函数名、参数和echo的值在编译时解析，每次求值只需要调用函数。
+    context是传给配置文件中函数的其它参数，例如配置节的index、type、database、table
+    """
+    if not funcString:
+        return _none
+
+    funcInfo = _resolveFunction(funcString)
+    if funcInfo is None:
+        if funcString[0] in ('+', '-'):
+            return _compileSignedField(funcString[0], funcString[1:])
+
+        return lambda values, context: values[funcString]
+
+    funcName = funcInfo['name']
+    args = funcInfo['args']
+
+    if funcName == 'echo':
+        return _compileEcho(args)
+
+    func = getattr(common, funcName, None)
+    if func is None:
+        func = utils.functionForName(funcName)
+
+    if func is None:
+        def notFound(values, context):
+            raise IllegalConfigException('can NOT find function with name[%s]' % funcName)
+        return notFound
+
+    argFuncs = tuple(compileFunction(arg) for arg in args)
+
+    def call(values, context):
+        return func(*[argFunc(values, context) for argFunc in argFuncs], values=values, **context)
+    return call
+
+def _none(values, context):
+    return None
+
+def _compileSignedField(sign, field):
+    def signedField(values, context):
+        value = values[field]
+        if not isinstance(value, Number):
+            raise IllegalConfigException('field with a sign(+ or -) must be a number type: %s' % field)
+
+        return -value if sign == '-' else value
+    return signedField
+
+def _compileEcho(args):
+    try:
+        value = common.echo(*args)
+    except Exception:
+        # 与resolve一致，在求值时抛出异常
+        return lambda values, context: common.echo(*args)
+
+    # list、dict等可变的值，每次求值时生成新的对象
+    if isinstance(value, (list, dict, set)):
+        return lambda values, context: common.echo(*args)
+
+    return lambda values, context: value
+
+"""
+filter中支持的比较操作：数据的值 op 配置的值 为真时通过
+"""
+_FILTER_OPERATORS = {
+        '==': operator.eq,
+        '!=': operator.ne,
+        '<>': operator.ne,
+        '>': operator.gt,
+        '>=': operator.ge,
+        '<': operator.lt,
+        '<=': operator.le
+        }
+
+def compileFilter(filterDict):
+    """
+    把配置节的filter编译为函数 f(values)：
+    True 数据通过，False 数据被过滤。不支持的操作在编译时抛出异常
+    """
+    if not filterDict:
+        return _passAll
+
+    conditions = tuple(_compileFilterCondition(field, filterValue) for field, filterValue in filterDict.items())
+
+    def matchAll(values):
+        for condition in conditions:
+            if not condition(values):
+                return False
+        return True
+    return matchAll
+
+def _passAll(values):
+    return True
+
+def _compileFilterCondition(field, filterValue):
+    if isinstance(filterValue, list):
+        return lambda values: field in values and values[field] in filterValue
+
+    if isinstance(filterValue, dict):
+        comparisons = []
+        for op, value in filterValue.items():
+            if op not in _FILTER_OPERATORS:
+                raise IllegalConfigException('filter op NOT supported yet: %s' % op)
+            comparisons.append((_FILTER_OPERATORS[op], value))
+        comparisons = tuple(comparisons)
+
+        def compare(values):
+            if field not in values:
+                return False
+
+            dataValue = values[field]
+            for func, value in comparisons:
+                if not func(dataValue, value):
+                    return False
+            return True
+        return compare
+
+    return lambda values: field in values and values[field] == filterValue
@@ -15,6 +15,8 @@ import application.app as app
 from application import IllegalConfigException, IllegalArgumentException, LogicException
 from utils.failure import Failure
 from .loader import Loader
+from . import compiler
+from . import template
 from ..handlers import *
 from ..interfaces import *
 
@@ -29,11 +31,26 @@ _VALID_MAPPING_ES_FIELD = re.compile(r'^[_a-zA-Z]\w*$')
 """
 _SQL_STATEMENT_LIMIT_RE = re.compile(r'\s+limit\s+\d+\s*(,\s*\d+)?\s*$', re.I)
 
+"""
+加载时编译为模板的配置项
+"""
+_TEMPLATE_PROPERTIES = ('statement', 'document_id', 'routing', 'query', 'parent_query')
+
+class _FrozenDict(dict):
+    """
+    只读的dict，用于缓存后返回给多个调用方的结果
+    """
+    def _readonly(self, *args, **kwargs):
+        raise TypeError('%s is read-only' % self.__class__.__name__)
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _readonly
+
 @implementer(IHandlerConfig)
 class HandlerConfig(object):
     def __init__(self):
         self._data = {}
         self._forward = {}
+        self._routes = _FrozenDict()
 
         global _initCount
         _initCount += 1
@@ -89,6 +106,22 @@ class HandlerConfig(object):
                 configList = HandlerConfigList(index, esType, items)
                 self._forward[index][esType] = configList
 
+        self._resolveRoutes()
+
+    def _resolveRoutes(self):
+        """
+        (database, table) => 引用该表的所有配置节（包括nested配置节）。
+        配置加载后不再变化，没有被引用的表不在其中，查找时只需要一次dict查找
+        """
+        routes = {}
+        for database, table in self.getDatabaseTables():
+            items = []
+            for configList in self:
+                items += configList.getItemsByDatabaseAndTable(database, table)
+            routes[(database, table)] = tuple(items)
+
+        self._routes = _FrozenDict(routes)
+
     def indices(self):
         return self._forward.keys()
 
@@ -103,11 +136,75 @@ class HandlerConfig(object):
             return None
 
     def getConfigItemsByDatabaseAndTable(self, database, table):
-        items = []
+        return self._routes.get((database, table), ())
+
+    def getDatabaseTables(self):
+        """
+        所有配置节（包括nested配置节）引用的(database, table)
+        """
+        tables = set()
+        for configList in self:
+            tables.update(configList.getDatabaseTables())
+
+        return tables
+
+    def getProjectedFields(self, database, table, withPlainMapping=True):
+        """
+        增量更新时，database.table的binlog中会用到的字段。
+        无法确定时返回None，即需要所有的字段。
+        withPlainMapping为False时，不包括只在mapping中直接引用的字段
+        """
+        fields = set()
+        for configList in self:
+            listFields = configList.getProjectedFields(database, table, withPlainMapping)
+            if listFields is None:
+                return None
+            fields.update(listFields)
+
+        return fields
+
+    def getPartitionFields(self, database, table):
+        """
+        database.table的配置节中partition_key引用的字段，没有配置时返回None。
+        多个配置节的partition_key不一致时，返回None
+        """
+        partitionFields = set()
+        for configList in self:
+            for item in configList.getItemsByDatabaseAndTable(database, table):
+                fields = item.getPartitionFields()
+                if fields:
+                    partitionFields.add(fields)
+
+        if len(partitionFields) != 1:
+            if partitionFields:
+                _logger.warning('conflicting partition_key of %s.%s: %s', database, table, partitionFields)
+            return None
+
+        return partitionFields.pop()
+
+    def getFanoutTables(self, byDocument=False):
+        """
+        存在扇出(从表或者嵌套文档的记录与主表记录不在同一个partition中)的配置中引用的所有表
+        """
+        tables = set()
         for configList in self:
-            items += configList.getItemsByDatabaseAndTable(database, table)
+            if configList.hasFanout(byDocument):
+                tables.update(configList.getDatabaseTables())
 
-        return items
+        return tables
+
+    def getRebuildFields(self, database, table):
+        """
+        database.table中，值发生变化时需要删除后重新插入文档(anchor fields)，
+        或者可能改变过滤结果(filter)的字段
+        """
+        fields = set()
+        for configList in self:
+            for item in configList.getItemsByDatabaseAndTable(database, table):
+                fields.update(item.getAnchorFields())
+                fields.update((item.get('filter', None) or {}).keys())
+
+        return fields
 
     def toJson(self):
         return json.dumps(self._data)
@@ -127,6 +224,10 @@ class HandlerConfigList(object):
         self._allItems = []
         self._inverted = {}
         self._nestedLists = {}
+        # (key, 相关的字段, withSelf) => 被依赖的配置节
+        self._dependentItemsCache = {}
+        # (key, column) => column的(collation, data type)，批量获取数据时查询一次后缓存
+        self._columnInfoCache = {}
 
         self._load(items)
 
@@ -150,6 +251,81 @@ class HandlerConfigList(object):
 
         return items + nestedItems
 
+    def getDatabaseTables(self):
+        tables = set()
+        for database, tableItems in self._inverted.items():
+            for table in tableItems:
+                tables.add((database, table))
+
+        for nestedList in self._nestedLists.values():
+            tables.update(nestedList.getDatabaseTables())
+
+        return tables
+
+    def hasFanout(self, byDocument=False):
+        """
+        从表或者嵌套文档的记录是否可能与主表记录不在同一个partition中。
+        这些记录的变更会通过update_by_query等方式修改多个文档，不同partition之间无法保证顺序。
+        byDocument为True时，主表和从表都配置了partition_key的记录在同一个partition中
+        """
+        if not byDocument or not self._masterItem.getPartitionFields():
+            return bool(self._slaveItems) or bool(self._nestedLists)
+
+        for item in self._slaveItems:
+            if not item.getPartitionFields():
+                return True
+
+        for nestedList in self._nestedLists.values():
+            if not nestedList.getMasterItem().getPartitionFields() or nestedList.hasFanout(byDocument):
+                return True
+
+        return False
+
+    def getProjectedFields(self, database, table, withPlainMapping=True):
+        fields = set()
+        for item in self._inverted.get(database, {}).get(table, []):
+            itemFields = item.getProjectedFields(withPlainMapping)
+            if itemFields is None:
+                return None
+            fields.update(itemFields)
+
+            # 其它配置节的statement中引用的当前配置节的字段
+            fields.update(self._dependents.get(item.key, {}).keys())
+            if item.isMaster:
+                fields.update(self._dependents.get('__last', {}).keys())
+
+            # nested配置节的statement中引用的父配置节的字段
+            for mapItem in item['mapping']:
+                if mapItem['type'] == 'nested':
+                    fields.update(mapItem['db_field'].getParentDependents().keys())
+
+            # slave配置节query中引用的主配置节的字段，反向索引需要这些字段的完整取值
+            if item.isMaster and not withPlainMapping:
+                queryFields = self._getSlaveQueryFields()
+                for mapItem in item['mapping']:
+                    if mapItem['type'] != 'nested' and mapItem['es_field'] in queryFields:
+                        fields.update(compiler.getFields(mapItem['db_field']) or ())
+
+        for nestedList in self._nestedLists.values():
+            nestedFields = nestedList.getProjectedFields(database, table, withPlainMapping)
+            if nestedFields is None:
+                return None
+            fields.update(nestedFields)
+
+        return fields
+
+    def _getSlaveQueryFields(self):
+        """
+        slave配置节query中的ES字段
+        """
+        fields = set()
+        for item in self.getSlaveItems():
+            query = item.get('query', None)
+            if isinstance(query, dict):
+                fields.update(query.keys())
+
+        return fields
+
     def getConfigItemByKey(self, key):
         for item in self:
             if item['key'] == key:
@@ -157,6 +333,19 @@ class HandlerConfigList(object):
     
         return None
 
+    def getDependenceKey(self, key):
+        """
+        返回key对应的配置节所依赖的配置节的key（不包括__last和__parent）。
+        没有依赖时返回None
+        """
+        return self._dependences.get(key, None)
+
+    def getOrderedSlaveItems(self):
+        """
+        按照依赖关系排序的slave items：被依赖的配置节总是排在依赖它的配置节之前
+        """
+        return self._orderedSlaveItems
+
     def addNestedConfigList(self, esField, nestedList):
         if esField in self._nestedLists:
             raise IllegalConfigException('es_field[%s] of nested duplicated' % esField)
@@ -223,6 +412,31 @@ class HandlerConfigList(object):
         for item in self:
             self._resolveDependenceByItem(item)
 
+        self._resolveDependenceOrder()
+
+    def _resolveDependenceOrder(self):
+        """
+        从master item开始，广度优先遍历依赖关系，得到slave items的顺序
+        """
+        masterKey = self._masterItem['key']
+        orderedKeys = []
+        touchedSet = set([masterKey])
+        queue = [masterKey]
+        while queue:
+            key = queue.pop(0)
+            for dependentKey in sorted(self._getDirectDependentKeys(key)):
+                if dependentKey not in touchedSet:
+                    touchedSet.add(dependentKey)
+                    orderedKeys.append(dependentKey)
+                    queue.append(dependentKey)
+
+        self._orderedSlaveItems = [ self.getConfigItemByKey(key) for key in orderedKeys ]
+
+        # 不依赖其它配置节的slave items
+        for item in self._slaveItems:
+            if item.key not in touchedSet:
+                self._orderedSlaveItems.append(item)
+
     def _resolveDependenceByItem(self, item):
         key = item['key']
         statement = item['statement']
@@ -253,6 +467,9 @@ class HandlerConfigList(object):
         if len(dependKeys) > 1:
             raise IllegalConfigException('dependence count can NOT be greater than one: esIndex[%s], esType[%s], key[%s]' % (item.esIndex, item.esType, key))
 
+        if dependKeys:
+            self._dependences[key] = dependKeys.pop()
+
     def _checkValidDependences(self):
         """
         检查依赖关系是否合法
@@ -301,14 +518,38 @@ class HandlerConfigList(object):
         return False
 
     def getDependentItems(self, key, fields=None, withSelf=False):
+        """
+        依赖于key的所有配置节：{ key: item }。
+        结果只与key、fields中被依赖的字段有关，计算一次后缓存，返回的dict是只读的
+        """
+        if fields:
+            dependents = self._dependents.get(key, {})
+            cacheKey = (key, frozenset(field for field in fields if field in dependents), withSelf)
+        else:
+            cacheKey = (key, None, withSelf)
+
+        result = self._dependentItemsCache.get(cacheKey, None)
+        if result is not None:
+            return result
+
         dependKeys = self._getDependentKeys(key, set(), fields=fields)
 
         if withSelf:
             dependKeys.add(key)
 
-        result = { item['key']: item for item in self if item['key'] in dependKeys }
+        result = _FrozenDict((item['key'], item) for item in self if item['key'] in dependKeys)
+        self._dependentItemsCache[cacheKey] = result
         return result
 
+    def getColumnInfo(self, key, column):
+        """
+        配置节key的statement中column的(collation, data type)，没有缓存时返回None
+        """
+        return self._columnInfoCache.get((key, column), None)
+
+    def setColumnInfo(self, key, column, info):
+        self._columnInfoCache[(key, column)] = info
+
     def _getDirectDependentKeys(self, key, fields=None):
         chain = set()
 
@@ -389,12 +630,29 @@ class HandlerConfigItem(MutableMapping):
 
         self._nestedDependents = {}
 
+        self._templates = {}
+
+        # 编译后的mapping函数，以及传给函数的其它参数
+        self._mappingFunctions = {}
+        self._functionContext = {
+                'index': self.esIndex,
+                'type': self.esType,
+                'database': self._data.get('database', None),
+                'table': self._data.get('table', None)
+                }
+
         self._resolveMapping()
 
         self._checkValidation()
 
         self._computeAnchorFields()
 
+        for name in _TEMPLATE_PROPERTIES:
+            if self._data.get(name, None) is not None:
+                self._templates[name] = template.compile(self._data[name])
+
+        self._filter = compiler.compileFilter(self._data.get('filter', None))
+
     def _resolveMapping(self):
         mapping = self._data['mapping']
         for index, mapItem in enumerate(mapping):
@@ -427,6 +685,8 @@ class HandlerConfigItem(MutableMapping):
                         self._nestedDependents[field] = nestedConfigList
                     
                     self._nestedLists[esField] = nestedConfigList
+                else:
+                    self.getMappingFunction(mapItem['db_field'])
             elif isinstance(mapItem, basestring):
                 self._data['mapping'][index] = {
                         'db_field': mapItem,
@@ -435,6 +695,7 @@ class HandlerConfigItem(MutableMapping):
                         'eval_on_deleted': False,
                         'null_value': None
                         }
+                self.getMappingFunction(mapItem)
             else:
                 raise IllegalConfigException('mapping values MUST be dict or string: %s' % mapItem)
 
@@ -443,10 +704,17 @@ class HandlerConfigItem(MutableMapping):
 
     def __setitem__(self, key, value):
         self._data[key] = value
+        if key in _TEMPLATE_PROPERTIES:
+            self._templates[key] = template.compile(value)
+        elif key == 'filter':
+            self._filter = compiler.compileFilter(value)
 
     def __delitem__(self, key):
         if key in self._data:
             del self._data[key]
+        self._templates.pop(key, None)
+        if key == 'filter':
+            self._filter = compiler.compileFilter(None)
             
     def __iter__(self):
         return iter(self._data)
@@ -454,6 +722,32 @@ class HandlerConfigItem(MutableMapping):
     def __len__(self):
         return len(self._data)
 
+    def matchFilter(self, values):
+        """
+        数据是否通过filter：True 数据通过，False 数据被过滤
+        """
+        return self._filter(values)
+
+    def getMappingFunction(self, dbField):
+        """
+        编译后的db_field：f(values, context)，context为getFunctionContext()
+        """
+        func = self._mappingFunctions.get(dbField, None)
+        if func is None:
+            func = compiler.compileFunction(dbField)
+            self._mappingFunctions[dbField] = func
+
+        return func
+
+    def getFunctionContext(self):
+        return self._functionContext
+
+    def getTemplate(self, name):
+        """
+        编译后的配置项(statement、document_id、routing、query、parent_query)，配置项不存在时返回None
+        """
+        return self._templates.get(name, None)
+
     def __str__(self):
         return str({
             'key': self.key,
@@ -517,6 +811,10 @@ class HandlerConfigItem(MutableMapping):
             if 'routing' in self._data:
                 raise IllegalConfigException('routing property can NOT EXIST in non-master/nesetd config item: %s' % self)
 
+        # partition_key只能引用当前配置节的字段
+        if 'partition_key' in self._data:
+            self.getPartitionFields()
+
         # statment中不能带有limit子句
         statement = self._data['statement']
         if _SQL_STATEMENT_LIMIT_RE.search(statement) is not None:
@@ -525,6 +823,54 @@ class HandlerConfigItem(MutableMapping):
     def getAnchorFields(self):
         return self._anchorFields
 
+    def getPartitionFields(self):
+        """
+        partition_key中引用的字段，没有配置partition_key时返回None
+        """
+        partitionKey = self._data.get('partition_key', None)
+        if not partitionKey:
+            return None
+
+        fields = []
+        for percent, key, field in _DEPENDENCE_RE.findall(partitionKey):
+            if percent:
+                continue
+
+            if key and key != self.key:
+                raise IllegalConfigException('partition_key[%s] can NOT depend on other config item: %s' % (partitionKey, self))
+
+            fields.append(field)
+
+        return tuple(fields)
+
+    def getProjectedFields(self, withPlainMapping=True):
+        """
+        当前配置节的同步会用到的mysql行数据中的字段：
+        anchor fields、filter、mapping以及statement中引用的自身的字段。
+        mapping中的函数无法确定会用到哪些字段时，返回None。
+        withPlainMapping为False时，不包括mapping中直接引用的字段
+        """
+        fields = set(self._anchorFields)
+        fields.update((self._data.get('filter', None) or {}).keys())
+
+        for mapItem in self._data['mapping']:
+            if mapItem['type'] == 'nested':
+                continue
+
+            if not withPlainMapping and compiler.isField(mapItem['db_field']):
+                continue
+
+            mapFields = compiler.getFields(mapItem['db_field'])
+            if mapFields is None:
+                return None
+            fields.update(mapFields)
+
+        for percent, key, field in _DEPENDENCE_RE.findall(self._data['statement']):
+            if not percent and (not key or key == self.key):
+                fields.add(field)
+
+        return fields
+
     def _computeAnchorFields(self):
         """
         通过分析document_id, routing, query, parent_query等属性，
@@ -0,0 +1,318 @@
+# -*- coding: utf-8 -*-
+
+"""
+同步配置中的表达式：%key.field:(default)，%%表示%。
+加载同步配置时编译一次：字符串被拆分为字面量和引用，引用的配置节key、字段和默认值在编译时解析；
+渲染时按顺序取值和拼接，不再需要正则匹配。dict和list在渲染时生成新的对象，不需要deepcopy。
+SQL语句可以渲染为带占位符的SQL和参数（Template.bind），值的位置上的引用作为参数绑定。
+"""
+
+from __future__ import print_function, division
+
+import re
+
+from application import IllegalConfigException
+
+from . import common
+
+"""
+"""
+_EXP_RE = re.compile(r"(%%)|%(?:(\w+)\.)?(\w+)(?::\(((?:[^'\)][^\)]*)|(?:'.*?[^\\]'))\))?")
+
+"""
+"""
+_ORIGIN_VALUE_RE = re.compile(r"^%(?:(\w+)\.)?(\w+)(?::\(((?:[^'\)][^\)]*)|(?:'.*?[^\\]'))\))?$")
+
+"""
+SQL中引用的绑定方式(Template.bind)：
+_BIND_STRING  引号中的引用，值转换为字符串后作为参数绑定
+_BIND_VALUE   值的位置(比较运算符、BETWEEN、VALUES列表之后)上的引用，作为参数绑定，值不是标量(例如list)时原样拼接
+_SPLICE       其它的引用，例如标识符(FROM %table、ORDER BY %column、users_%suffix、反引号中)或者IN列表，原样拼接
+"""
+_BIND_STRING = 'string'
+_BIND_VALUE = 'value'
+_SPLICE = 'splice'
+
+_SQL_QUOTES = ('\'', '"', '`')
+_SQL_IDENTIFIER_BEFORE_RE = re.compile(r"[\w\.`]$")
+_SQL_IDENTIFIER_AFTER_RE = re.compile(r"^[\w`]")
+_SQL_IN_LIST_RE = re.compile(r"\bin\s*\([^()]*$", re.I)
+_SQL_VALUE_POSITION_RE = re.compile(r"(?:[=<>]|\b(?:like|regexp|between)|\bbetween\s+(?:\S+\s+)?and|\bvalues\s*\([^()]*)\s*$", re.I)
+
+class Reference(object):
+    """
+    对配置节数据的引用。key为None时引用当前配置节
+    """
+    __slots__ = ('key', 'field', 'default', 'source')
+
+    def __init__(self, key, field, default, source):
+        self.key = key
+        self.field = field
+        self.source = source
+
+        try:
+            self.default = common.echo(default)
+        except (ValueError, SyntaxError) as e:
+            raise IllegalConfigException('illegal default value[%s] in expression[%s]: %s' % (default, source, e))
+
+    def __repr__(self):
+        return '%%%s.%s' % (self.key, self.field) if self.key else '%' + self.field
+
+class Template(object):
+    """
+    字符串模板。整个字符串只有一个引用时，渲染结果是引用的原始值，否则是拼接后的字符串
+    """
+    __slots__ = ('source', 'references', '_segments', '_reference', '_literal', '_sqlSegments')
+
+    def __init__(self, source):
+        self.source = source
+        self._segments = None
+        self._reference = None
+        self._literal = None
+        self._sqlSegments = None
+
+        match = _ORIGIN_VALUE_RE.match(source)
+        if match:
+            self._reference = Reference(match.group(1), match.group(2), match.group(3), source)
+            self.references = (self._reference, )
+            return
+
+        segments = []
+        position = 0
+        for match in _EXP_RE.finditer(source):
+            literal = source[position:match.start()]
+            if match.group(1):
+                literal += '%'
+            if literal:
+                # 合并相邻的字面量
+                if segments and not isinstance(segments[-1], Reference):
+                    segments[-1] += literal
+                else:
+                    segments.append(literal)
+            if not match.group(1):
+                segments.append(Reference(match.group(2), match.group(3), match.group(4), source))
+            position = match.end()
+
+        literal = source[position:]
+        if literal:
+            if segments and not isinstance(segments[-1], Reference):
+                segments[-1] += literal
+            else:
+                segments.append(literal)
+
+        self.references = tuple(segment for segment in segments if isinstance(segment, Reference))
+        if self.references:
+            self._segments = tuple(segments)
+        else:
+            self._literal = ''.join(segments) if segments else source
+
+    def render(self, context, config, recursive=True):
+        """
+        context.resolveReference(reference, config, recursive)返回引用的值
+        """
+        if self._reference is not None:
+            return context.resolveReference(self._reference, config, recursive)
+
+        if self._literal is not None:
+            return self._literal
+
+        return u''.join([unicode(context.resolveReference(segment, config, recursive)) if isinstance(segment, Reference) else segment
+            for segment in self._segments])
+
+    def bind(self, context, config, recursive=True):
+        """
+        把SQL语句渲染为带占位符(%s)的SQL和参数，用于cursor.execute(sql, args)。
+        引号中的引用，以及值的位置上的标量引用（包括字符串和小数）作为参数绑定；
+        其它的引用（表名、列名、IN列表等）与render相同，原样拼接。
+        PyMySQL在客户端把参数转义后拼接到SQL中，MySQL服务端仍然每次解析SQL
+        """
+        if self._sqlSegments is None:
+            self._sqlSegments = self._compileSQL()
+
+        sql = []
+        args = []
+        for segment in self._sqlSegments:
+            if not isinstance(segment, tuple):
+                sql.append(segment)
+                continue
+
+            reference, mode = segment
+            value = context.resolveReference(reference, config, recursive)
+            if mode == _BIND_STRING:
+                sql.append('%s')
+                args.append(unicode(value))
+            elif mode == _BIND_VALUE and not isinstance(value, (list, tuple, set, frozenset, dict)):
+                sql.append('%s')
+                args.append(value)
+            else:
+                sql.append(unicode(value).replace('%', '%%'))
+
+        return u''.join(sql), tuple(args)
+
+    def _compileSQL(self):
+        """
+        SQL的片段：字面量（%转义为%%），或者 (引用, 绑定方式)。
+        引号中只有一个引用时去掉引号；引号中还有其它字符时改写为 CONCAT('...', %s, '...')
+        """
+        if self._reference is not None:
+            return ((self._reference, _SPLICE), )
+        if self._literal is not None:
+            return (self._literal.replace('%', '%%'), )
+
+        segments = []
+        # 当前所在的字符串(或者反引号中的标识符)的引号，以及其中的字面量和引用
+        quote = None
+        pieces = None
+        # 引用之前的SQL，用于判断引用是否在IN列表中
+        consumed = ''
+        parts = self._segments
+        for index, part in enumerate(parts):
+            if isinstance(part, Reference):
+                if quote is not None:
+                    pieces.append(part)
+                else:
+                    segments.append((part, self._getBindMode(parts, index, consumed)))
+                continue
+
+            consumed += part
+            position = 0
+            offset = 0
+            while offset < len(part):
+                char = part[offset]
+                if quote is None:
+                    if char in _SQL_QUOTES:
+                        segments.append(part[position:offset])
+                        quote = char
+                        pieces = []
+                        position = offset + 1
+                elif char == '\\' and quote != '`':
+                    offset += 1
+                elif char == quote:
+                    # '' 形式的引号
+                    if part[offset + 1:offset + 2] == quote:
+                        offset += 1
+                    else:
+                        pieces.append(part[position:offset])
+                        segments.extend(self._compileQuoted(quote, pieces))
+                        quote = None
+                        position = offset + 1
+                offset += 1
+
+            if quote is None:
+                segments.append(part[position:])
+            else:
+                pieces.append(part[position:])
+
+        if quote is not None:
+            # 没有结束的引号，原样拼接
+            segments.append(quote)
+            segments.extend((piece, _SPLICE) if isinstance(piece, Reference) else piece for piece in pieces)
+
+        # 合并相邻的字面量
+        sqlSegments = []
+        for segment in segments:
+            if isinstance(segment, tuple):
+                sqlSegments.append(segment)
+            elif segment:
+                segment = segment.replace('%', '%%')
+                if sqlSegments and not isinstance(sqlSegments[-1], tuple):
+                    sqlSegments[-1] += segment
+                else:
+                    sqlSegments.append(segment)
+
+        return tuple(sqlSegments)
+
+    @staticmethod
+    def _getBindMode(parts, index, consumed):
+        """
+        引号之外的引用：紧挨着字母、数字、下划线、点或者反引号时是标识符的一部分，
+        在 IN ( 之后时是IN列表，都原样拼接；
+        只有在比较运算符、LIKE、BETWEEN ... AND、VALUES (之后时作为参数绑定
+        """
+        before = parts[index - 1] if index > 0 else ''
+        after = parts[index + 1] if index + 1 < len(parts) else ''
+        if isinstance(before, Reference) or isinstance(after, Reference):
+            return _SPLICE
+
+        if _SQL_IDENTIFIER_BEFORE_RE.search(before) or _SQL_IDENTIFIER_AFTER_RE.match(after) or _SQL_IN_LIST_RE.search(consumed):
+            return _SPLICE
+
+        if _SQL_VALUE_POSITION_RE.search(consumed):
+            return _BIND_VALUE
+
+        return _SPLICE
+
+    @staticmethod
+    def _compileQuoted(quote, pieces):
+        """
+        引号中的字面量和引用
+        """
+        references = [piece for piece in pieces if isinstance(piece, Reference)]
+        if not references:
+            return [quote + u''.join(pieces) + quote]
+
+        if quote == '`':
+            return [quote] + [(piece, _SPLICE) if isinstance(piece, Reference) else piece for piece in pieces] + [quote]
+
+        if len(pieces) == 3 and not pieces[0] and not pieces[2]:
+            return [(pieces[1], _BIND_STRING)]
+
+        items = []
+        for piece in pieces:
+            if isinstance(piece, Reference):
+                items.append((piece, _BIND_STRING))
+            elif piece:
+                items.append(quote + piece + quote)
+
+        segments = ['CONCAT(']
+        for index, item in enumerate(items):
+            if index > 0:
+                segments.append(', ')
+            segments.append(item)
+        segments.append(')')
+        return segments
+
+class _DictTemplate(object):
+    __slots__ = ('_items', )
+
+    def __init__(self, items):
+        self._items = items
+
+    def render(self, context, config, recursive=True):
+        return { key: value.render(context, config, recursive) for key, value in self._items }
+
+class _ListTemplate(object):
+    __slots__ = ('_items', )
+
+    def __init__(self, items):
+        self._items = items
+
+    def render(self, context, config, recursive=True):
+        return [ item.render(context, config, recursive) for item in self._items ]
+
+class _Constant(object):
+    __slots__ = ('_value', )
+
+    def __init__(self, value):
+        self._value = value
+
+    def render(self, context, config, recursive=True):
+        return self._value
+
+_TEMPLATE_TYPES = (Template, _DictTemplate, _ListTemplate, _Constant)
+
+def isTemplate(value):
+    return isinstance(value, _TEMPLATE_TYPES)
+
+def compile(data):
+    """
+    编译字符串，或者包含字符串的dict、list。dict的key不会被替换
+    """
+    if isinstance(data, basestring):
+        return Template(data)
+    elif isinstance(data, dict):
+        return _DictTemplate(tuple((key, compile(value)) for key, value in data.iteritems()))
+    elif isinstance(data, list):
+        return _ListTemplate(tuple(compile(item) for item in data))
+    else:
+        return _Constant(data)
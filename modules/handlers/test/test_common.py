@@ -83,7 +83,3 @@ class CommonTests(unittest.TestCase):
         funcStr = "sum(max(f3, f4), -f2, echo(1))"
         result = common.resolve(funcStr, values=values, action='')
         self.assertEqual(result, 3) 
-
-
-
-
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, division
+
+import unittest
+
+import modules.handlers.common as common
+import modules.handlers.compiler as compiler
+from application import IllegalConfigException
+
+class CompilerTests(unittest.TestCase):
+    def test_compile(self):
+        values = {
+                'f1': '2018-12-12 08:23:12',
+                'f2': 2,
+                'f3': 3,
+                'f4': 4,
+                'f6': -3.1,
+                'f7': 'abcdef'
+                }
+        context = { 'action': '' }
+
+        for funcStr in ('', 'f7', '-f2', "echo(1)", "echo('1')", 'yesterday(f1)', 'max(f2, f3)', 'sum(f2, f3, f6)',
+                'sum(max(f3, f4), -f2, echo(1))', 'sum(min(f4, sum(f2, f3)), -f6)'):
+            self.assertEqual(compiler.compileFunction(funcStr)(values, context), common.resolve(funcStr, values=values, **context), funcStr)
+
+        # list的值每次生成新的对象
+        func = compiler.compileFunction('echo([1])')
+        func(values, context).append(3)
+        self.assertEqual(func(values, context), [1])
+
+        # 函数不存在时，在求值时抛出异常
+        func = compiler.compileFunction('not_exists_function(f2)')
+        self.assertRaises(IllegalConfigException, func, values, context)
+
+    def test_compile_filter(self):
+        values = { 'status': 1, 'type': 'a', 'amount': 100 }
+
+        self.assertTrue(compiler.compileFilter(None)(values))
+        self.assertTrue(compiler.compileFilter({ 'status': 1, 'type': ['a', 'b'] })(values))
+        self.assertFalse(compiler.compileFilter({ 'status': 2 })(values))
+        self.assertFalse(compiler.compileFilter({ 'not_exist': 1 })(values))
+        self.assertTrue(compiler.compileFilter({ 'amount': { '>': 10, '<=': 100 } })(values))
+        self.assertFalse(compiler.compileFilter({ 'amount': { '<>': 100 } })(values))
+
+        self.assertRaises(IllegalConfigException, compiler.compileFilter, { 'amount': { 'like': 1 } })
+
+    def test_is_field(self):
+        self.assertTrue(compiler.isField('f1'))
+        self.assertTrue(compiler.isField('-f2'))
+        self.assertFalse(compiler.isField(''))
+        self.assertFalse(compiler.isField('max(f2, f3)'))
+
+    def test_get_fields(self):
+        self.assertSetEqual(compiler.getFields('f1'), {'f1'})
+        self.assertSetEqual(compiler.getFields('-f2'), {'f2'})
+        self.assertSetEqual(compiler.getFields("echo('abc')"), set())
+        self.assertSetEqual(compiler.getFields('max(f2, abs(f3))'), {'f2', 'f3'})
+        self.assertSetEqual(compiler.getFields("executeSQL(echo('select 1 from t where id=%s'), f4)"), {'f4'})
+
+        self.assertIsNone(compiler.getFields('utils.timeutil.now(f1)'))
@@ -138,8 +138,110 @@ class HandlerConfigTests(unittest.TestCase):
         handlerConfig = HandlerConfig()
         self.assertRaisesRegexp(IllegalConfigException, 'mapping values MUST be dict or string', handlerConfig.loadFromFile, './modules/handlers/test/conf/invalid_mapping.yml')
 
+class HandlerConfigCacheTests(unittest.TestCase):
+    """
+    使用conf/handlers中的示例配置
+    """
+    def test_getDependentItemsCache(self):
+        handlerConfig = HandlerConfig()
+        handlerConfig.loadFromFile('./conf/handlers/index_carteam_user.yml')
+        configList = handlerConfig.getConfigListByIndexAndType('index_carteam_user', 'user')
+
+        items = configList.getDependentItems('users', ['id', 'non_exist_field'], withSelf=True)
+        self.assertSetEqual(set(items), {'users', 'relations_1', 'relations_2', 'admin_users', 'credit', 'loan_base'})
+        # 与依赖无关的字段不影响结果，返回同一个缓存的结果
+        self.assertIs(configList.getDependentItems('users', ['id'], withSelf=True), items)
+        self.assertIsNot(configList.getDependentItems('users', ['id']), items)
+        self.assertEqual(len(configList.getDependentItems('users', ['id'])), 5)
+
+        self.assertEqual(len(configList.getDependentItems('users', ['non_exist_field'])), 0)
+        self.assertSetEqual(set(configList.getDependentItems('relations_1', withSelf=True)), {'relations_1', 'admin_users'})
+        self.assertSetEqual(set(configList.getDependentItems('relations_1', ['status'], withSelf=True)), {'relations_1'})
+
+        self.assertRaises(TypeError, items.__setitem__, 'users', None)
+        self.assertRaises(TypeError, items.pop, 'users')
+        self.assertEqual(len(items), 6)
+
+    def test_getDatabaseTables(self):
+        handlerConfig = HandlerConfig()
+        handlerConfig.loadFromFile('./conf/handlers/index_vehicle.yml')
+
+        self.assertSetEqual(handlerConfig.getDatabaseTables(), {
+            ('track_service', 'vehicle_monitor'),
+            ('certify_service', 'vehicle'),
+            ('certify_service', 'vehicle_type'),
+            ('carteam_service', 'relation_captain_vehicle'),
+            })
+
+        self.assertSetEqual(handlerConfig.getProjectedFields('certify_service', 'vehicle_type'), {'id', 'name'})
+        self.assertSetEqual(handlerConfig.getProjectedFields('track_service', 'vehicle_monitor'), {'id', 'car_id', 'status', 'monitor_status', 'monitor_type'})
 
+    def test_getPartitionFields(self):
+        handlerConfig = HandlerConfig()
+        handlerConfig.loadFromFile('./conf/handlers/index_carteam_user.yml')
+
+        self.assertEqual(handlerConfig.getPartitionFields('carteam_service', 'users'), ('id', ))
+        self.assertEqual(handlerConfig.getPartitionFields('carteam_service', 'credit'), ('user_id', ))
+        self.assertIsNone(handlerConfig.getPartitionFields('carteam_service', 'not_exist'))
+
+    def test_getFanoutTables(self):
+        handlerConfig = HandlerConfig()
+        handlerConfig.loadFromFile('./conf/handlers/index_carteam_user.yml')
+        # auditor_relations等从表没有配置partition_key，document时也存在扇出
+        configList = handlerConfig.getConfigListByIndexAndType('index_carteam_user', 'user')
+        self.assertTrue(configList.hasFanout())
+        self.assertTrue(configList.hasFanout(byDocument=True))
+        tables = handlerConfig.getFanoutTables(byDocument=True)
+        self.assertIn(('carteam_service', 'users'), tables)
+        self.assertIn(('carteam_service', 'auditor_relations'), tables)
+        self.assertEqual(tables, configList.getDatabaseTables())
+
+        # 主表和从表都配置了partition_key时，document没有扇出
+        handlerConfig = HandlerConfig()
+        handlerConfig.loadFromJson(json.dumps({
+            'index_order': {
+                'order': [
+                    {
+                        'key': 'orders',
+                        'database': 'shop',
+                        'table': 'orders',
+                        'statement': 'select * from orders where id > %__last.id:(0)',
+                        'document_id': '%id',
+                        'partition_key': '%id',
+                        'mapping': [ 'id', 'amount' ]
+                    },
+                    {
+                        'key': 'items',
+                        'database': 'shop',
+                        'table': 'order_items',
+                        'statement': 'select * from order_items where order_id = %__master.id',
+                        'query': { 'id': '%order_id' },
+                        'partition_key': '%order_id',
+                        'mapping': [ 'sku' ]
+                    }
+                ]
+            }
+        }))
+        self.assertSetEqual(handlerConfig.getFanoutTables(byDocument=True), set())
+        self.assertSetEqual(handlerConfig.getFanoutTables(), {('shop', 'orders'), ('shop', 'order_items')})
+
+    def test_getConfigItemsByDatabaseAndTableRoutes(self):
+        handlerConfig = HandlerConfig()
+        handlerConfig.loadFromFile('./conf/handlers/config.yml')
 
+        items = handlerConfig.getConfigItemsByDatabaseAndTable('carteam_service', 'auditor_relations')
+        self.assertIsInstance(items, tuple)
+        self.assertListEqual([item.key for item in items], ['relations_1', 'relations_2'])
 
+        # nested配置节
+        items = handlerConfig.getConfigItemsByDatabaseAndTable('track_service', 'vehicle_monitor')
+        self.assertEqual(len(items), 1)
+        self.assertEqual(items[0].key, 'vehicle_monitor')
+        self.assertTrue(items[0].isNested())
 
+        # 没有被引用的表
+        self.assertEqual(handlerConfig.getConfigItemsByDatabaseAndTable('carteam_service', 'non_exist_table'), ())
+        self.assertEqual(handlerConfig.getConfigItemsByDatabaseAndTable('non_exist', 'users'), ())
 
+        self.assertEqual(sum(len(handlerConfig.getConfigItemsByDatabaseAndTable(database, table))
+            for database, table in handlerConfig.getDatabaseTables()), 10)
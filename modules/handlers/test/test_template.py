@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, division
+
+import unittest
+
+from application import IllegalConfigException
+from .. import template
+
+class _Context(object):
+    def __init__(self, data):
+        self.data = data
+
+    def resolveReference(self, reference, config, recursive=True):
+        values = self.data[reference.key or config['key']]
+        return values.get(reference.field, reference.default)
+
+class TemplateTests(unittest.TestCase):
+    def setUp(self):
+        self.context = _Context({
+            'users': { 'id': 1, 'name': u'张三' },
+            'relations': { 'user_id': 1 },
+            })
+        self.config = { 'key': 'users' }
+
+    def render(self, data):
+        return template.compile(data).render(self.context, self.config)
+
+    def test_origin_value(self):
+        # 整个字符串只有一个引用时，返回原始值
+        self.assertEqual(self.render('%id'), 1)
+        self.assertEqual(self.render('%relations.user_id'), 1)
+        self.assertEqual(self.render("%relations.status:(2)"), 2)
+        self.assertIsNone(self.render('%relations.status'))
+
+    def test_string(self):
+        self.assertEqual(self.render('select * from users where id = %id and name = \'%users.name\''),
+                u'select * from users where id = 1 and name = \'张三\'')
+        self.assertEqual(self.render("status = %status:('0') and rate like '10%%'"), u"status = 0 and rate like '10%'")
+        self.assertEqual(self.render('no expression'), 'no expression')
+        self.assertEqual(self.render('100%%'), '100%')
+
+    def test_data(self):
+        query = { 'user_id': '%relations.user_id', 'tags': ['%name', 'static', 3] }
+        result = self.render(query)
+        self.assertEqual(result, { 'user_id': 1, 'tags': [u'张三', 'static', 3] })
+
+        # 每次渲染都生成新的对象
+        result['tags'].append('other')
+        self.assertEqual(self.render(query)['tags'], [u'张三', 'static', 3])
+
+    def test_references(self):
+        compiled = template.compile('%users.id = %relations.user_id:(0)')
+        self.assertEqual([(ref.key, ref.field, ref.default) for ref in compiled.references], [('users', 'id', None), ('relations', 'user_id', 0)])
+
+    def test_bind(self):
+        bind = lambda source: template.Template(source).bind(self.context, self.config)
+
+        # 引号中的引用和其它标量的引用都作为参数绑定
+        self.assertEqual(bind("select * from users where id = %relations.user_id and name = '%name' and code like 'a%%'"),
+                (u"select * from users where id = %s and name = %s and code like 'a%%'", (1, u'张三')))
+        self.assertEqual(bind('select * from users where name = "%name"'), (u'select * from users where name = %s', (u'张三', )))
+        self.assertEqual(bind("select * from users where name = %name and rate > %relations.rate:(0.5)"),
+                (u'select * from users where name = %s and rate > %s', (u'张三', 0.5)))
+        self.assertEqual(bind("select * from users where name like '%%%name%%'"), (u"select * from users where name like CONCAT('%%', %s, '%%')", (u'张三', )))
+        self.assertEqual(bind("select * from users where name = 'it''s %name'"), (u"select * from users where name = CONCAT('it''s ', %s)", (u'张三', )))
+
+        # 标识符和IN列表中的引用原样拼接
+        self.assertEqual(bind("select * from users_%relations.status:('a') where id = 1"), (u'select * from users_a where id = 1', ()))
+        self.assertEqual(bind("select * from `users_%relations.status:('a')` where id = %id"), (u'select * from `users_a` where id = %s', (1, )))
+        self.assertEqual(bind("select * from users where id in (%relations.ids:('1, 2')) and status in (0, %relations.status:(1))"),
+                (u'select * from users where id in (1, 2) and status in (0, 1)', ()))
+        self.assertEqual(bind('select 1'), ('select 1', ()))
+
+        # 表名、列名等不在值的位置上的引用原样拼接
+        self.assertEqual(bind("select * from %relations.table:('users') where id = 1"), (u'select * from users where id = 1', ()))
+        self.assertEqual(bind("select * from users u join %relations.table:('relations') r on r.user_id = u.id"),
+                (u'select * from users u join relations r on r.user_id = u.id', ()))
+        self.assertEqual(bind("select * from users where id > 0 order by %relations.column:('name') desc"),
+                (u'select * from users where id > 0 order by name desc', ()))
+        self.assertEqual(bind("select status, count(*) from users group by %relations.column:('status')"),
+                (u'select status, count(*) from users group by status', ()))
+        self.assertEqual(bind("select * from users where %relations.column:('status') = %id"), (u'select * from users where status = %s', (1, )))
+
+        # BETWEEN、LIKE和VALUES中的值
+        self.assertEqual(bind("select * from users where id between %id and %relations.user_id and name like %name"),
+                (u'select * from users where id between %s and %s and name like %s', (1, 1, u'张三')))
+        self.assertEqual(bind("insert into users values (%id, %name)"), (u'insert into users values (%s, %s)', (1, u'张三')))
+
+    def test_illegal_default(self):
+        self.assertRaises(IllegalConfigException, template.compile, '%id:(not_a_literal)')
@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+
+"""
+批量写入ES。
+按文档数和字节数切分bulk请求，允许多个bulk请求同时进行，
+并且只重试bulk响应中失败的文档。
+"""
+
+from __future__ import print_function, division
+
+import time
+import threading
+
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from elasticsearch import TransportError, ConnectionError
+
+import application.app as app
+
+from application import LogicException
+from application.config import config
+
+_logger = app.getLogger('base')
+
+"""
+bulk响应中，这些状态码的文档可以重试
+"""
+_RETRY_STATUSES = (429, 502, 503, 504)
+
+"""
+最多记录多少条失败的文档信息
+"""
+_MAX_ERROR_SAMPLES = 10
+
+class BulkWriter(object):
+    """
+    缓存index/update/delete操作，攒够一批后通过_bulk接口写入ES。
+    concurrency大于1时，bulk请求在线程池中发送，最多同时有concurrency个请求在进行中；
+    concurrency等于1时，bulk请求在调用线程中同步发送，同一文档的操作顺序与调用顺序一致。
+    """
+    def __init__(self, esClient, chunkSize=None, maxChunkBytes=None, concurrency=None, maxRetries=None):
+        self._esClient = esClient
+        self._serializer = esClient.transport.serializer
+
+        self.chunkSize = chunkSize or int(config().get('elasticsearch', 'bulk_chunk_size', '1000'))
+        self.maxChunkBytes = maxChunkBytes or int(config().get('elasticsearch', 'bulk_max_chunk_bytes', '10485760'))
+        self.concurrency = concurrency or int(config().get('elasticsearch', 'bulk_concurrency', '4'))
+        self.maxRetries = maxRetries if maxRetries is not None else int(config().get('elasticsearch', 'bulk_max_retries', '3'))
+
+        self._buffer = []
+        self._bufferBytes = 0
+
+        self._executor = None
+        self._futures = []
+        self._rlock = threading.RLock()
+
+        self._batchCount = 0
+        self.succeeded = 0
+        self.failed = 0
+        self._errors = []
+
+    def index(self, index, docType, document, documentId=None, routing=None):
+        meta = self._buildMeta(index, docType, documentId, routing)
+        self.add({ 'index': meta }, document)
+
+    def update(self, index, docType, documentId, body, routing=None, retryOnConflict=None, ignoreMissing=False):
+        """
+        ignoreMissing: 文档不存在(404)时不作为失败
+        """
+        meta = self._buildMeta(index, docType, documentId, routing)
+        if retryOnConflict:
+            meta['retry_on_conflict'] = retryOnConflict
+        self.add({ 'update': meta }, body, ignoreMissing=ignoreMissing)
+
+    def delete(self, index, docType, documentId, routing=None):
+        meta = self._buildMeta(index, docType, documentId, routing)
+        self.add({ 'delete': meta })
+
+    def add(self, action, source=None, ignoreMissing=False):
+        """
+        action: bulk的元数据行，例如 { 'index': { '_index': ..., '_id': ... } }
+        source: 文档内容；delete操作时为None
+        ignoreMissing: 文档不存在(404)时不作为失败
+        """
+        self._raiseOnErrors()
+
+        opType, meta = action.items()[0]
+        docKey = (meta.get('_index'), meta.get('_type'), meta.get('_id'))
+
+        lines = [self._dumps(action)]
+        if source is not None:
+            lines.append(self._dumps(source))
+
+        self._buffer.append((lines, docKey, ignoreMissing))
+        self._bufferBytes += sum(len(line) + 1 for line in lines)
+
+        if len(self._buffer) >= self.chunkSize or self._bufferBytes >= self.maxChunkBytes:
+            self._submit()
+
+    def flush(self):
+        """
+        发送缓存中的所有操作，并等待所有进行中的bulk请求完成。
+        存在失败的文档时抛出LogicException。
+        """
+        self._submit()
+        self._waitFutures(0)
+        self._raiseOnErrors()
+
+    def close(self):
+        if self._executor:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        self._futures = []
+
+    def pending(self):
+        return len(self._buffer)
+
+    def _buildMeta(self, index, docType, documentId, routing):
+        meta = { '_index': index, '_type': docType }
+        if documentId is not None:
+            meta['_id'] = documentId
+        if routing is not None:
+            meta['routing'] = routing
+        return meta
+
+    def _dumps(self, data):
+        line = self._serializer.dumps(data)
+        if isinstance(line, unicode):
+            line = line.encode('utf-8')
+        return line
+
+    def _submit(self):
+        if not self._buffer:
+            return
+
+        chunk = self._buffer
+        self._buffer = []
+        self._bufferBytes = 0
+
+        self._batchCount += 1
+        batchNo = self._batchCount
+
+        if self.concurrency <= 1:
+            self._sendChunk(chunk, batchNo)
+            return
+
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.concurrency)
+
+        # 保证同时进行中的bulk请求数不超过concurrency
+        self._waitFutures(self.concurrency - 1)
+        self._futures.append(self._executor.submit(self._sendChunk, chunk, batchNo))
+
+    def _waitFutures(self, maxPending):
+        while len(self._futures) > maxPending:
+            done, notDone = wait(self._futures, return_when=FIRST_COMPLETED)
+            self._futures = list(notDone)
+            for future in done:
+                # 抛出线程中发生的异常
+                future.result()
+
+    def _sendChunk(self, chunk, batchNo):
+        startTime = time.time()
+        totalCount = len(chunk)
+        totalBytes = sum(len(line) + 1 for lines, _, _ in chunk for line in lines)
+
+        pending = chunk
+        retry = 0
+        errors = []
+        while True:
+            try:
+                body = '\n'.join(line for lines, _, _ in pending for line in lines) + '\n'
+                response = self._esClient.bulk(body=body)
+            except TransportError as e:
+                retryable = isinstance(e, ConnectionError) or e.status_code in _RETRY_STATUSES
+                if not retryable or retry >= self.maxRetries:
+                    raise
+
+                retry += 1
+                _logger.error('bulk batch[%s] request failed, retry[%s]: %s', batchNo, retry, e)
+                time.sleep(retry * 0.5)
+                continue
+
+            retryItems = []
+            failedDocs = set()
+            for entry, item in zip(pending, response['items']):
+                lines, docKey, ignoreMissing = entry
+                opType, result = item.items()[0]
+
+                if 'error' not in result or (ignoreMissing and result.get('status') == 404):
+                    # 同一文档前面的操作需要重试时，后面的操作也要随之重发，以保证顺序
+                    if docKey in failedDocs:
+                        retryItems.append(entry)
+                    continue
+
+                if result.get('status') in _RETRY_STATUSES and retry < self.maxRetries:
+                    retryItems.append(entry)
+                    failedDocs.add(docKey)
+                else:
+                    errors.append({ opType: result })
+
+            if not retryItems:
+                break
+
+            retry += 1
+            _logger.info('bulk batch[%s] retry[%s] %s failed items', batchNo, retry, len(retryItems))
+            time.sleep(retry * 0.5)
+            pending = retryItems
+
+        timeCost = time.time() - startTime
+        with self._rlock:
+            self.succeeded += totalCount - len(errors)
+            self.failed += len(errors)
+            self._errors.extend(errors[:_MAX_ERROR_SAMPLES - len(self._errors)])
+
+        _logger.info(
+                'bulk batch[%s] done: docs[%s], bytes[%s], failed[%s], retry[%s], time cost[%.3f], throughput[%.1f docs/s, %.1f KB/s]',
+                batchNo, totalCount, totalBytes, len(errors), retry, timeCost,
+                totalCount / timeCost if timeCost else 0,
+                totalBytes / 1024 / timeCost if timeCost else 0
+                )
+
+        if errors:
+            _logger.error('bulk batch[%s] failed items: %s', batchNo, errors[:_MAX_ERROR_SAMPLES])
+
+    def _raiseOnErrors(self):
+        with self._rlock:
+            if not self.failed:
+                return
+
+            errors = self._errors
+            failed = self.failed
+
+        raise LogicException('%s documents failed to write by bulk: %s' % (failed, errors))
@@ -4,10 +4,10 @@ from __future__ import print_function, division
 
 import re
 import time
-import copy
+import multiprocessing
+from numbers import Number
 from collections import MutableMapping
 from abc import abstractmethod
-from string import Template
 
 from elasticsearch import Elasticsearch, ConflictError, NotFoundError
 from elasticsearch.client import IndicesClient
@@ -18,25 +18,106 @@ from zope.interface import implementer
 import application.app as app
 import modules.remote as remote
 import modules.handlers.common as common
+import modules.handlers.compiler as compiler
+import modules.handlers.template as template
 
 from application.connection import ConnectinoPool
-from application import IllegalConfigException
+from application.config import config as appConfig
+from application import IllegalConfigException, LogicException
 from modules.interfaces import IHandler
 from ...handlers import INSERT, UPDATE, DELETE, COMMON
+from ..template import _EXP_RE, _ORIGIN_VALUE_RE
+from .bulkwriter import BulkWriter
+from .reverseindex import ReverseIndex
+from .scriptregistry import ScriptRegistry
 
 _logger = app.getLogger('base')
 
 """
+增量更新时使用的painless脚本，注册为stored script。
+脚本只依赖参数，不依赖同步配置和发生变化的字段，所以所有的脚本在加载配置时就可以注册：
+_ASSIGN_SCRIPT          使用params.data中的字段更新文档
+_NESTED_ADD_SCRIPT      在文档的嵌套字段params.field中添加params.doc
+_NESTED_REMOVE_SCRIPT   删除文档的嵌套字段params.field中与params.query匹配的元素
+_NESTED_ASSIGN_SCRIPT   使用params.data更新文档的嵌套字段params.field中与params.query匹配的元素
 """
-_EXP_RE = re.compile(r"(%%)|%(?:(\w+)\.)?(\w+)(?::\(((?:[^'\)][^\)]*)|(?:'.*?[^\\]'))\))?")
+_ASSIGN_SCRIPT = "for (entry in params.data.entrySet()) { ctx._source[entry.getKey()] = entry.getValue(); }"
+_NESTED_ADD_SCRIPT = "if (ctx._source[params.field] == null) { ctx._source[params.field] = []; } ctx._source[params.field].add(params.doc);"
+_NESTED_REMOVE_SCRIPT = (
+        "if (ctx._source[params.field] == null) { ctx._source[params.field] = []; } "
+        "ctx._source[params.field].removeIf(item -> { "
+        "for (entry in params.query.entrySet()) { if (item[entry.getKey()] != entry.getValue()) { return false; } } "
+        "return true; });"
+        )
+_NESTED_ASSIGN_SCRIPT = (
+        "if (ctx._source[params.field] != null) { for (item in ctx._source[params.field]) { "
+        "boolean matched = true; "
+        "for (entry in params.query.entrySet()) { if (item[entry.getKey()] != entry.getValue()) { matched = false; } } "
+        "if (matched) { item.putAll(params.data); } } }"
+        )
+_SCRIPTS = (_ASSIGN_SCRIPT, _NESTED_ADD_SCRIPT, _NESTED_REMOVE_SCRIPT, _NESTED_ASSIGN_SCRIPT)
 
 """
 """
-_ORIGIN_VALUE_RE = re.compile(r"^%(?:(\w+)\.)?(\w+)(?::\(((?:[^'\)][^\)]*)|(?:'.*?[^\\]'))\))?$")
+_PARENT_EXP_RE = re.compile(r"(\w+)\s*=\s*%__parent\.(\w+)|%__parent\.(\w+)\s*=\s*(\w+)")
 
 """
+主表statement中的keyset分页条件，例如：id > %__last.id:(0)
 """
-_PARENT_EXP_RE = re.compile(r"(\w+)\s*=\s*%__parent\.(\w+)|%__parent\.(\w+)\s*=\s*(\w+)")
+_LAST_EXP_RE = re.compile(r"([\w\.]+)\s*>\s*%__last\.(\w+)(?::\(((?:[^'\)][^\)]*)|(?:'.*?[^\\]'))\))?")
+
+"""
+"""
+_SQL_ORDER_BY_RE = re.compile(r"\border\s+by\b", re.I)
+
+"""
+statement中的join（包括逗号分隔的多个表）
+"""
+_JOIN_RE = re.compile(r"\bjoin\b|\bfrom\s+[\w\.]+(?:\s+(?:as\s+)?\w+)?\s*,", re.I)
+
+"""
+可以改写为IN查询的依赖条件，例如：user_id = %__master.id 或者 name = '%relations_1.name'
+"""
+_BATCH_EXP_RE = re.compile(r"([\w\.]+)\s*=\s*(['\"]?)%(\w+)\.(\w+)(?::\(((?:[^'\)][^\)]*)|(?:'.*?[^\\]'))\))?\2")
+
+"""
+只有形如 select * from ... 的statement才能批量查询，
+并且不能包含聚合、排序、分页等子句
+"""
+_BATCHABLE_STATEMENT_RE = re.compile(r"^\s*select\s+\*\s+from\s", re.I)
+_NOT_BATCHABLE_STATEMENT_RE = re.compile(r"\b(?:group\s+by|having|order\s+by|limit|union|distinct)\b", re.I)
+
+"""
+改写为IN查询后语义可能改变的条件：OR，以及子查询
+"""
+_NOT_BATCHABLE_CONDITION_RE = re.compile(r"\bor\b|\(\s*select\b", re.I)
+
+"""
+批量查询时，依赖条件中的列以该别名出现在查询结果中，用来把记录分配给依赖它的记录
+"""
+_BATCH_KEY_ALIAS = '__mee_batch_key'
+
+"""
+批量查询时，IN子句中最多包含的值的个数
+"""
+_MAX_IN_VALUES = 1000
+
+"""
+批量查询时，不带引号的条件只对以下类型的列改写为IN查询：
+数字类型的列按照数字匹配，字符类型的列两边都转为字符串匹配
+"""
+_NUMERIC_COLUMN_TYPES = ('tinyint', 'smallint', 'mediumint', 'int', 'bigint', 'decimal', 'float', 'double')
+_CHARACTER_COLUMN_TYPES = ('char', 'varchar', 'tinytext', 'text', 'mediumtext', 'longtext')
+
+"""
+主表statement中的 select * from，分片时用来改写为 MIN/MAX 查询
+"""
+_SELECT_ALL_RE = re.compile(r"^\s*select\s+\*\s+from\s", re.I)
+
+"""
+并行全量更新时，子进程中使用的MySQLHandler（fork时从父进程继承）
+"""
+_shardHandler = None
 
 """
 """
@@ -48,29 +129,40 @@ class CommonHandler(object):
         self._statusConfig = statusConfig
         self._binlogHandler = BinlogHandler(self._statusConfig)
 
-    def syncFromMySQL(self):
+    def syncFromMySQL(self, workers=1):
         handlerConfig = self._statusConfig.handlerConfig
         for configList in handlerConfig:
             handler = MySQLHandler(configList, self._statusConfig)
-            handler.sync()
+            handler.sync(workers)
     
+    def registerScripts(self):
+        self._binlogHandler.registerScripts()
+
     def syncFromBinlog(self, binlogEvent):
         self._binlogHandler.sync(binlogEvent)
 
+    def syncFromBinlogBatch(self, binlogEvents):
+        self._binlogHandler.syncBatch(binlogEvents)
+
+    def isWatched(self, database, table):
+        return bool(self._statusConfig.handlerConfig.getConfigItemsByDatabaseAndTable(database, table))
+
 class _ElasticSearchUtilsMixin(object):
     """
     need instances:
     self._statusConfig
     self._esClient
     self._esIndexClient
+    self._bulkWriter (可以为None。不为None时，文档级别的写操作放入bulk缓存中)
+    self._reverseIndex (可以为None。不为None时，维护slave配置节的反向索引)
     """
 
     def _writeToIndex(self, masterItem, document, context):
-        documentId = context.exp_value(masterItem['document_id'], masterItem)
+        if self._bulkWriter:
+            self._bulkWriteToIndex(masterItem, document, context)
+            return
 
-        routing = masterItem.get('routing', None)
-        if routing:
-            routing = context.exp_value(routing, masterItem)
+        documentId, routing = self._getDocumentIdAndRouting(masterItem, context)
 
         _logger.debug('write document: id[%s], routing[%s], document[%s]', documentId, routing, document)
 
@@ -82,11 +174,89 @@ class _ElasticSearchUtilsMixin(object):
                 routing=routing
                 )
 
+    def _bulkWriteToIndex(self, masterItem, document, context):
+        """
+        将文档放入bulk缓存中，攒够一批后再批量写入ES
+        """
+        documentId, routing = self._getDocumentIdAndRouting(masterItem, context)
+
+        _logger.debug('bulk write document: id[%s], routing[%s], document[%s]', documentId, routing, document)
+
+        self._bulkWriter.index(
+                self._getESIndexFullname(masterItem.esIndex),
+                masterItem.esType,
+                document,
+                documentId=documentId,
+                routing=routing
+                )
+
+    def _addToReverseIndex(self, masterItem, document, context):
+        if self._reverseIndex:
+            documentId, routing = self._getDocumentIdAndRouting(masterItem, context)
+            self._reverseIndex.add(masterItem, document, documentId, routing)
+
+    def _updateByReverseIndex(self, config, query, script):
+        """
+        通过反向索引找到受影响的文档，逐个放入bulk缓存中进行局部更新。
+        索引不可用时返回False，此时需要使用update_by_query
+        """
+        if not self._reverseIndex or not self._bulkWriter:
+            return False
+
+        documents = self._reverseIndex.lookup(config, query)
+        if documents is None:
+            return False
+
+        for documentId, routing in documents.items():
+            # 索引中可能存在已经被删除的文档
+            self._bulkWriter.update(
+                    self._getESIndexFullname(config.esIndex),
+                    config.esType,
+                    documentId,
+                    { 'script': script },
+                    routing=routing,
+                    retryOnConflict=_MAX_RETRY_COUNT,
+                    ignoreMissing=True
+                    )
+
+        return True
+
+    def _getMasterFieldValues(self, masterItem, values, skipEsFields=()):
+        """
+        主配置节mapping中，非nested字段在ES文档中的值。
+        skipEsFields: 不需要计算的字段，例如delta编码的UPDATE中没有变化的字段
+        """
+        fieldValues = {}
+        for mapItem in masterItem['mapping']:
+            if mapItem['type'] != 'nested' and mapItem['es_field'] not in skipEsFields:
+                fieldValues[mapItem['es_field']] = CommonUtils.getDBFieldValue(mapItem['db_field'], values, masterItem, mapItem['null_value'])
+
+        return fieldValues
+
+    def _getDocumentIdAndRouting(self, masterItem, context):
+        documentId = context.exp_value(masterItem.getTemplate('document_id'), masterItem)
+
+        routing = masterItem.get('routing', None)
+        if routing:
+            routing = context.exp_value(masterItem.getTemplate('routing'), masterItem)
+
+        return documentId, routing
+
     def _deleteFromIndex(self, masterItem, context):
-        documentId = context.exp_value(masterItem['document_id'], masterItem)
+        documentId = context.exp_value(masterItem.getTemplate('document_id'), masterItem)
         routing = masterItem.get('routing', None)
         if routing:
-            routing = context.exp_value(routing, masterItem)
+            routing = context.exp_value(masterItem.getTemplate('routing'), masterItem)
+
+        if self._bulkWriter:
+            # bulk中删除不存在的文档不会返回错误
+            self._bulkWriter.delete(
+                    self._getESIndexFullname(masterItem.esIndex),
+                    masterItem.esType,
+                    documentId,
+                    routing=routing
+                    )
+            return
             
         try:
             self._esClient.delete(
@@ -101,10 +271,35 @@ class _ElasticSearchUtilsMixin(object):
         except:
             raise
 
+    def _updateDocument(self, masterItem, documentId, routing, body):
+        if self._bulkWriter:
+            self._bulkWriter.update(
+                    self._getESIndexFullname(masterItem.esIndex),
+                    masterItem.esType,
+                    documentId,
+                    body,
+                    routing=routing,
+                    retryOnConflict=_MAX_RETRY_COUNT
+                    )
+            return
+
+        self._esClient.update(
+                index=self._getESIndexFullname(masterItem.esIndex),
+                doc_type=masterItem.esType,
+                id=documentId,
+                routing=routing,
+                body=body,
+                retry_on_conflict=_MAX_RETRY_COUNT
+                )
+
     def _getESIndexFullname(self, index):
         return index + '_' + self._statusConfig.esIndexSuffix
              
     def _updateByQuery(self, esIndex, esType, body):
+        if self._bulkWriter:
+            # update_by_query之前，先写入bulk缓存中的文档，以保证操作的顺序
+            self._bulkWriter.flush()
+
         esIndex = self._getESIndexFullname(esIndex)
 
         retry = 0
@@ -135,7 +330,7 @@ class _HandlerUtilsMixin(object):
         if parentQuery:
             itemKey = nestedItem.key
             context = HandlerContext(nestedItem, { itemKey: values })
-            parentQuery = context.exp_data(parentQuery, nestedItem)
+            parentQuery = context.exp_data(nestedItem.getTemplate('parent_query'), nestedItem)
             return parentQuery
 
         statement = nestedItem['statement']
@@ -158,13 +353,13 @@ class _HandlerUtilsMixin(object):
 
         # TODO 这里有个bug：当parentItem是master item时，可能不存在query配置
         # 暂时的解决方案是在nestedItem中增加配置parent_query
-        parentQuery = context.exp_data(parentItem['query'], parentItem)
+        parentQuery = context.exp_data(parentItem.getTemplate('query'), parentItem)
         return parentQuery
 
     def _getDiffFields(self, beforeValues, afterValues):
         fields = []
         for field in beforeValues.keys():
-            if beforeValues[field] != afterValues[field]:
+            if beforeValues[field] != afterValues.get(field, None):
                 fields.append(field)
 
         return fields
@@ -212,63 +407,586 @@ class MySQLHandler(_ElasticSearchUtilsMixin, object):
 
         self._esClient = remote.getElasticClient()
         self._esIndexClient = IndicesClient(self._esClient)
+        self._bulkWriter = None
+        self._reverseIndex = ReverseIndex(statusConfig.esIndexSuffix) if ReverseIndex.enabled() else None
 
-    def sync(self):
+    def sync(self, workers=1):
+        """
+        workers大于1时，按照主表keyset列的取值范围分片，每个分片在一个子进程中同步
+        """
         print('begin to sync index[%s, %s] from mysql' % (self._esIndex, self._esType))
 
         startTime = time.time()
 
-        count = 0
-        masterItem = self._configList.getMasterItem()
-        dataFetcher = MySQLDataFetcher(self._configList)
-        for doc, context in dataFetcher.buildDocument():
-            # 写入ES
-            self._writeToIndex(masterItem, doc, context)
+        shards = None
+        if workers > 1:
+            shards = MySQLDataFetcher(self._configList).getShards(workers)
 
-            count += 1
-            if count % 50 == 0:
-                print('%s rows have been done' % (count,))
+        if shards:
+            count = self._syncShards(shards, workers)
+        else:
+            count = self._syncShard(None)
 
         endTime = time.time()
         print('finish to sync index[%s, %s] from mysql, count[%s], time cost[%s]\n\n' % (self._esIndex, self._esType, count, endTime - startTime))
 
+        self._reconcile(count)
+
+        if self._reverseIndex:
+            self._reverseIndex.markReady(self._esIndex, self._esType)
+
+    def _syncShard(self, shard):
+        """
+        同步一个分片的数据（shard为None时同步所有数据），返回写入的文档数
+        """
+        count = 0
+        masterItem = self._configList.getMasterItem()
+        dataFetcher = MySQLDataFetcher(self._configList, shard=shard)
+        self._bulkWriter = BulkWriter(self._esClient)
+        try:
+            for doc, context in dataFetcher.buildDocument():
+                # 批量写入ES
+                self._bulkWriteToIndex(masterItem, doc, context)
+                self._addToReverseIndex(masterItem, doc, context)
+
+                count += 1
+                if count % self._bulkWriter.chunkSize == 0:
+                    print('%s rows have been done, shard[%s]' % (count, shard))
+
+            # 等待所有的bulk请求完成
+            self._bulkWriter.flush()
+
+            if self._reverseIndex:
+                self._reverseIndex.flush()
+        finally:
+            self._bulkWriter.close()
+
+        return count
+
+    def _syncShards(self, shards, workers):
+        global _shardHandler
+        _shardHandler = self
+
+        _logger.info('sync index[%s, %s] with %s workers, shards: %s', self._esIndex, self._esType, workers, shards)
+
+        pool = multiprocessing.Pool(min(workers, len(shards)), initializer=_initShardProcess)
+        try:
+            count = 0
+            for shard, shardCount in pool.imap_unordered(_syncShardInProcess, shards):
+                count += shardCount
+                print('shard[%s] done, count[%s]' % (shard, shardCount))
+
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+            _shardHandler = None
+
+        return count
+
+    def _reconcile(self, count):
+        """
+        核对写入的文档数与ES中的文档数。
+        document_id重复时，ES中的文档数会少于写入的文档数
+        """
+        indexName = self._getESIndexFullname(self._esIndex)
+        self._esIndexClient.refresh(index=indexName)
+        esCount = self._esClient.count(index=indexName, doc_type=self._esType)['count']
+
+        if esCount != count:
+            _logger.error('count mismatched after syncing index[%s, %s] from mysql: written[%s], elasticsearch[%s]', indexName, self._esType, count, esCount)
+            print('WARNING: count mismatched, written[%s], elasticsearch[%s]' % (count, esCount))
+        else:
+            _logger.info('count matched after syncing index[%s, %s] from mysql: %s', indexName, self._esType, count)
+
+def _initShardProcess():
+    """
+    子进程不能使用从父进程继承的MySQL和ES连接
+    """
+    ConnectinoPool().reset()
+    _shardHandler._esClient = remote.getElasticClient()
+    _shardHandler._esIndexClient = IndicesClient(_shardHandler._esClient)
+
+def _syncShardInProcess(shard):
+    return shard, _shardHandler._syncShard(shard)
+
 class MySQLDataFetcher(object):
-    def __init__(self, configList, **predefinedCtx):
+    def __init__(self, configList, shard=None, **predefinedCtx):
+        """
+        shard: (low, high)，只获取keyset列的取值在(low, high]范围内的主表记录，
+        low或者high为None时表示不限制
+        """
         self._configList = configList
         self._predefinedCtx = predefinedCtx
 
         self._configItems = { item.key: item for item in configList.getAllItems() }
 
-    def getAllDocuments(self):
+        self._fetchSize = int(appConfig().get('handler', 'fetch_size', '5000'))
+        self._nestedLimit = int(appConfig().get('handler', 'nested_limit', '1000'))
+
+        self._batchLoader = MySQLBatchLoader(configList)
+
+        # keyset分页的列，按照该列排序才能保证 %__last 的语义
+        masterStatement = configList.getMasterItem()['statement']
+        matches = _LAST_EXP_RE.search(masterStatement)
+        self._lastColumn = matches.group(1) if matches else None
+        self._lastField = matches.group(2) if matches else None
+        if self._lastColumn and not _SQL_ORDER_BY_RE.search(masterStatement):
+            self._orderBy = self._lastColumn
+        else:
+            self._orderBy = None
+
+        self._shard = shard
+        self._masterStatement = masterStatement
+        if shard and shard[1] is not None:
+            # 在keyset条件上增加分片的上界：(id > %__last.id AND id <= high)
+            self._masterStatement = '%s(%s AND %s <= %d)%s' % (
+                    masterStatement[:matches.start()],
+                    matches.group(0),
+                    self._lastColumn,
+                    shard[1],
+                    masterStatement[matches.end():]
+                    )
+        self._masterStatement = template.Template(self._masterStatement)
+
+    def getShards(self, count):
+        """
+        根据keyset列的 MIN/MAX，把主表记录平均分为count个分片。
+        只支持整数类型的keyset列；无法分片时返回None
+        """
+        masterItem = self._configList.getMasterItem()
+        statement = masterItem['statement']
+        if not self._orderBy or not _SELECT_ALL_RE.match(statement) or _NOT_BATCHABLE_STATEMENT_RE.search(statement):
+            _logger.info('statement of master item[%s] can NOT be sharded: %s', masterItem.key, statement)
+            return None
+
+        context = self._newContext({})
+        statement = context.exp_value(statement, masterItem)
+        statement = _SELECT_ALL_RE.sub('SELECT MIN(%s) AS min_value, MAX(%s) AS max_value FROM ' % (self._lastColumn, self._lastColumn), statement)
+
+        _logger.debug('get shard range: %s', statement)
+
+        conn = ConnectinoPool().connection(masterItem['database'])
+        with conn.cursor() as cursor:
+            cursor.execute(statement)
+            row = cursor.fetchone()
+
+        minValue = row['min_value'] if row else None
+        maxValue = row['max_value'] if row else None
+        if not isinstance(minValue, (int, long)) or not isinstance(maxValue, (int, long)):
+            _logger.info('keyset column[%s] of master item[%s] can NOT be sharded: min[%s], max[%s]', self._lastColumn, masterItem.key, minValue, maxValue)
+            return None
+
+        # 分片为 (bounds[i], bounds[i + 1]]，第一个分片不限制下界，最后一个分片不限制上界
+        total = maxValue - minValue + 1
+        count = min(count, total)
+        bounds = [ minValue - 1 + total * i // count for i in range(count + 1) ]
+        bounds[0] = None
+        bounds[-1] = None
+
+        return [ (bounds[i], bounds[i + 1]) for i in range(count) ]
+
+    def getAllDocuments(self, limit=None):
+        """
+        获取所有的文档，最多返回limit个（默认为配置项[handler] nested_limit）。
+        超出limit的文档被丢弃，并记录warning日志
+        """
+        limit = limit or self._nestedLimit
+
         docs = []
         for doc, context in self.buildDocument():
+            if len(docs) >= limit:
+                _logger.warning('get too many documents at one time, only the first %s are kept: esIndex[%s], esType[%s], context[%s]',
+                        limit, self._configList.esIndex, self._configList.esType, self._predefinedCtx)
+                break
             docs.append(doc)
-            if len(docs) > 50:
-                raise LogicException('get too many (greater than 50) documents at one time')
         return docs
 
     def buildDocument(self):
         masterKey = self._configList.getMasterKey()
+        masterItem = self._configItems[masterKey]
+
+        lastMasterRow = {}
+        if self._shard and self._shard[0] is not None:
+            lastMasterRow = { self._lastField: self._shard[0] }
 
-        context = HandlerContext(self._configItems)
         while True:
-            # 获取上一次的主表记录，并重新初始化context
-            lastMasterRow = context.get(masterKey, {})
+            # 根据上一页的最后一条主表记录，一次获取一页主表记录
+            context = self._newContext(lastMasterRow)
+            rows = context.fetchRows(masterItem, self._fetchSize, orderBy=self._orderBy, statement=self._masterStatement)
+            if not rows:
+                # 主表记录为空，那么返回
+                break
 
-            # 重新初始化context
-            context.clearData()
-            context.update(self._predefinedCtx)
-            context.update({ '__last': lastMasterRow })
+            contexts = []
+            for row in rows:
+                context = self._newContext(lastMasterRow)
+                context[masterKey] = row
+                contexts.append(context)
 
-            # 首先获取主表的一条记录
-            row = context.getData(masterKey)
-            if not row:
-                # 主表记录为空，那么返回
+                lastMasterRow = row
+
+            # 批量获取这一页主表记录所依赖的slave数据
+            self._batchLoader.load(contexts)
+
+            for context in contexts:
+                document = context.fillDataToDocument()
+
+                yield document, context
+
+            if len(rows) < self._fetchSize or not self._lastColumn:
+                # 最后一页；或者statement中没有 %__last，无法翻页
                 break
 
-            document = context.fillDataToDocument()
+    def _newContext(self, lastMasterRow):
+        context = HandlerContext(self._configItems)
+        context.update(self._predefinedCtx)
+        context.update({ '__last': lastMasterRow })
+        return context
+
+class MySQLBatchLoader(object):
+    """
+    全量更新时，为一页主表记录批量获取slave配置节的数据。
+    statement中的 `column = %key.field` 条件被改写为 `column IN (...)`，
+    每个slave配置节对每一页只执行一次查询，再按照column的值把结果分配给每条主表记录。
+    无法改写的statement，仍然在构造文档时逐条执行。
+    """
+    def __init__(self, configList):
+        self._configList = configList
+        self._connPool = ConnectinoPool()
+
+        self._statements = []
+        for item in configList.getOrderedSlaveItems():
+            statement = _BatchStatement.parse(item, configList)
+            if statement:
+                self._statements.append(statement)
+            else:
+                _logger.debug('statement of config item[%s] can NOT be batched: %s', item.key, item['statement'])
+
+        self._nestedLoaders = []
+        for item in configList.getAllItems():
+            for mapItem in item['mapping']:
+                if mapItem['type'] != 'nested':
+                    continue
+
+                nestedList = mapItem['db_field']
+                statement = _BatchStatement.parse(nestedList.getMasterItem(), nestedList)
+                if statement:
+                    self._nestedLoaders.append(_NestedBatchLoader(item.key, mapItem['es_field'], nestedList, statement))
+                else:
+                    _logger.debug('nested statement of es_field[%s] can NOT be batched: %s', mapItem['es_field'], nestedList.getMasterItem()['statement'])
+
+    def load(self, contexts):
+        """
+        contexts: 一页主表记录对应的HandlerContext，每个context中已经包含了主表记录。
+        按照依赖关系的顺序，把slave配置节的数据写入每个context；
+        然后为已经获取到的父记录批量获取nested数据
+        """
+        for statement in self._statements:
+            self._loadItem(statement, contexts)
+
+        for nestedLoader in self._nestedLoaders:
+            nestedLoader.load(contexts)
+
+    def _loadItem(self, statement, contexts):
+        item = statement.item
+        dependKey = statement.dependKey
+
+        # 被依赖的数据没有被批量获取时，只能逐条执行
+        pairs = [ (statement.getValue(context[dependKey]), context) for context in contexts if dependKey in context ]
+        pairs = [ (value, context) for value, context in pairs if value is not None ]
+        if not pairs:
+            return
+
+        conn = self._connPool.connection(item['database'])
+        statement.resolveCollation(conn)
+
+        # 按照依赖字段的值，对context进行分组
+        groups = {}
+        for value, context in pairs:
+            if not statement.isBindable(value):
+                continue
+
+            groups.setdefault(statement.normalize(value), (value, []))[1].append(context)
+
+        if not groups:
+            return
+
+        values = [ value for value, _ in groups.values() ]
+        rowsByValue = {}
+        for start in range(0, len(values), _MAX_IN_VALUES):
+            sql, args = statement.bind(values[start:start + _MAX_IN_VALUES])
+            _logger.debug('batch executeStatement: %s', sql)
+
+            with conn.cursor() as cursor:
+                cursor.execute(sql, args)
+                for row in cursor.fetchall():
+                    # 和逐条执行时的LIMIT 1一致，只取第一条记录
+                    rowsByValue.setdefault(statement.normalize(row.pop(_BATCH_KEY_ALIAS, None)), row)
+
+        for normalizedValue, (_, groupContexts) in groups.items():
+            row = rowsByValue.get(normalizedValue, {})
+            for context in groupContexts:
+                context[item.key] = row
+
+class _NestedBatchLoader(object):
+    """
+    为一页父记录批量获取nested数据：
+    nested主配置节中的 `column = %__parent.field` 被改写为 `column IN (...)`，
+    查询结果按照column的值分配给每条父记录，然后构造nested文档，
+    结果写入父记录的 __nested_<es_field> 中（与HandlerContext.getNestedData一致）
+    """
+    def __init__(self, parentKey, esField, nestedList, statement):
+        self._parentKey = parentKey
+        self._nestedDataKey = '__nested_' + esField
+        self._nestedList = nestedList
+        self._statement = statement
+        self._connPool = ConnectinoPool()
+
+        self._configItems = { item.key: item for item in nestedList.getAllItems() }
+        self._masterKey = nestedList.getMasterKey()
+        self._slaveLoader = MySQLBatchLoader(nestedList)
+        self._limit = int(appConfig().get('handler', 'nested_limit', '1000'))
+
+        matches = _LAST_EXP_RE.search(nestedList.getMasterItem()['statement'])
+        self._orderBy = matches.group(1) if matches else None
+
+    def load(self, contexts):
+        statement = self._statement
+
+        # 父记录没有被批量获取时，只能逐条执行
+        pairs = []
+        for context in contexts:
+            parentData = context.get(self._parentKey, None)
+            if not parentData or self._nestedDataKey in parentData:
+                continue
+
+            value = statement.getValue(parentData)
+            if value is not None:
+                pairs.append((value, parentData))
+
+        if not pairs:
+            return
+
+        statement.resolveCollation(self._connPool.connection(statement.item['database']))
+
+        # 按照依赖字段的值，对父记录进行分组
+        groups = {}
+        for value, parentData in pairs:
+            if not statement.isBindable(value):
+                continue
+
+            parents = groups.setdefault(statement.normalize(value), (value, {}))[1]
+            parents[id(parentData)] = parentData
+
+        if not groups:
+            return
+
+        rowsByValue = self._query([ value for value, _ in groups.values() ])
+
+        nestedContexts = []
+        for normalizedValue, (_, parents) in groups.items():
+            rows = rowsByValue.get(normalizedValue, [])
+            for parentData in parents.values():
+                lastRow = {}
+                for row in rows:
+                    context = HandlerContext(self._configItems)
+                    context.update({ '__parent': parentData, '__last': lastRow })
+                    context[self._masterKey] = row
+                    nestedContexts.append((parentData, context))
+                    lastRow = row
+
+                parentData[self._nestedDataKey] = []
+
+        # nested中的slave配置节，同样批量获取
+        self._slaveLoader.load([ context for _, context in nestedContexts ])
+
+        for parentData, context in nestedContexts:
+            parentData[self._nestedDataKey].append(context.fillDataToDocument())
+
+    def _query(self, values):
+        statement = self._statement
+        conn = self._connPool.connection(statement.item['database'])
+
+        rowsByValue = {}
+        truncated = set()
+        for start in range(0, len(values), _MAX_IN_VALUES):
+            sql, args = statement.bind(values[start:start + _MAX_IN_VALUES])
+            if self._orderBy:
+                sql += ' ORDER BY %s' % self._orderBy
+            _logger.debug('batch executeStatement: %s', sql)
+
+            with conn.cursor() as cursor:
+                cursor.execute(sql, args)
+                for row in cursor.fetchall():
+                    normalizedValue = statement.normalize(row.pop(_BATCH_KEY_ALIAS, None))
+                    rows = rowsByValue.setdefault(normalizedValue, [])
+                    if len(rows) >= self._limit:
+                        truncated.add(normalizedValue)
+                        continue
+                    rows.append(row)
+
+        if truncated:
+            _logger.warning('get too many nested documents at one time, only the first %s are kept: esIndex[%s], esType[%s], key[%s], values[%s]',
+                    self._limit, self._nestedList.esIndex, self._nestedList.esType, self._masterKey, list(truncated)[:10])
+
+        return rowsByValue
+
+class _BatchStatement(object):
+    """
+    可以批量执行的statement：prefix + `column IN (...)` + suffix。
+    column以别名 __mee_batch_key 出现在查询结果中
+    """
+    def __init__(self, item, configList, dependKey, column, quoted, field, defaultValue, prefix, suffix):
+        self.item = item
+        self.configList = configList
+        self.dependKey = dependKey
+        self.column = column
+        self.columnName = column.split('.')[-1]
+        self.quoted = quoted
+        self.field = field
+        self.defaultValue = common.echo(defaultValue)
+        # 执行时作为带占位符的SQL，%需要转义
+        prefix = _BATCHABLE_STATEMENT_RE.sub('SELECT *, %s AS %s FROM ' % (column, _BATCH_KEY_ALIAS), prefix, count=1)
+        self.prefix = prefix.replace('%', '%%')
+        self.suffix = suffix.replace('%', '%%')
+
+        # column的collation和类型，resolveCollation之前为None，按照原值匹配
+        self.collation = None
+        self.dataType = None
+        self.caseInsensitive = False
+        self.padSpace = False
 
-            yield document, context
+    @staticmethod
+    def parse(item, configList):
+        statement = item['statement']
+
+        isNestedMaster = item.isMaster and item.isNested()
+        if isNestedMaster:
+            # nested的主配置节依赖于父记录
+            dependKey = '__parent'
+        else:
+            dependKey = configList.getDependenceKey(item.key)
+        if not dependKey:
+            return None
+
+        if not _BATCHABLE_STATEMENT_RE.match(statement) or _NOT_BATCHABLE_STATEMENT_RE.search(statement):
+            return None
+
+        if _NOT_BATCHABLE_CONDITION_RE.search(statement):
+            return None
+
+        # 只允许出现一个引用，并且必须是 column = %key.field 的形式。
+        # nested的主配置节一次查询出所有记录，其中的 %__last 总是取默认值
+        references = [ m for m in _EXP_RE.finditer(statement)
+                if m.group(0) != '%%' and not (isNestedMaster and m.group(2) == '__last') ]
+        matches = [ m for m in _BATCH_EXP_RE.finditer(statement) if m.group(3) != '__last' ]
+        if len(references) != 1 or len(matches) != 1:
+            return None
+
+        match = matches[0]
+        refKey = match.group(3)
+        if refKey == '__master':
+            refKey = configList.getMasterKey()
+        if refKey != dependKey:
+            return None
+
+        context = HandlerContext([item], { '__last': {} })
+        return _BatchStatement(
+                item,
+                configList,
+                dependKey,
+                column=match.group(1),
+                quoted=bool(match.group(2)),
+                field=match.group(4),
+                defaultValue=match.group(5),
+                prefix=context.exp_value(statement[:match.start()], item),
+                suffix=context.exp_value(statement[match.end():], item)
+                )
+
+    def getValue(self, dependData):
+        """
+        和HandlerContext.exp_value一致：被依赖的数据为空时，使用默认值
+        """
+        if not dependData:
+            return self.defaultValue
+
+        return dependData.get(self.field, self.defaultValue)
+
+    def isBindable(self, value):
+        """
+        不带引号时，只有数字，并且column是数字或者字符类型时改写为IN查询，其它情况仍然逐条执行。
+        需要先调用resolveCollation
+        """
+        if value is None:
+            return False
+
+        if self.quoted:
+            return True
+
+        if not isinstance(value, Number) or isinstance(value, bool):
+            return False
+
+        return self.dataType in _NUMERIC_COLUMN_TYPES or self.dataType in _CHARACTER_COLUMN_TYPES
+
+    def resolveCollation(self, conn):
+        """
+        从information_schema中查询column的collation和类型，决定匹配查询结果时是否忽略大小写和末尾的空格，
+        以及不带引号时是否按照字符串匹配。结果缓存在配置节所在的HandlerConfigList中。
+        column属于其它的表（例如join）或者无法确定时，按照原值匹配
+        """
+        if self.collation is not None:
+            return
+
+        info = self.configList.getColumnInfo(self.item.key, self.column)
+        if info is None:
+            info = ('', '')
+            table = self.item['table']
+            if not _JOIN_RE.search(self.item['statement']):
+                try:
+                    with conn.cursor() as cursor:
+                        cursor.execute('SELECT COLLATION_NAME AS collation_name, DATA_TYPE AS data_type FROM information_schema.COLUMNS '
+                                'WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND COLUMN_NAME = %s', (table, self.columnName))
+                        row = cursor.fetchone() or {}
+                    info = (row.get('collation_name', None) or '', (row.get('data_type', None) or '').lower())
+                except Exception as e:
+                    # 查询失败时不缓存，下次重试
+                    _logger.warning('fail to get collation of column[%s] in table[%s]: %s', self.columnName, table, e)
+                    info = None
+
+            if info is not None:
+                self.configList.setColumnInfo(self.item.key, self.column, info)
+
+        self.collation, self.dataType = info or ('', '')
+        self.caseInsensitive = self.collation.endswith('_ci')
+        # MySQL 8的 *_0900_* collation是NO PAD，其它的collation比较时忽略末尾的空格
+        self.padSpace = bool(self.collation) and '_0900_' not in self.collation
+
+    def normalize(self, value):
+        if value is None:
+            return None
+
+        if self.quoted or not isinstance(value, Number) or self.dataType in _CHARACTER_COLUMN_TYPES:
+            value = unicode(value)
+            if self.caseInsensitive:
+                value = value.lower()
+            if self.padSpace:
+                value = value.rstrip(' ')
+
+        return value
+
+    def bind(self, values):
+        """
+        带占位符的IN查询和参数，值的个数相同时SQL相同
+        """
+        if self.quoted:
+            args = tuple(unicode(value) for value in values)
+        else:
+            args = tuple(values)
+
+        return '%s%s IN (%s)%s' % (self.prefix, self.column, ', '.join(('%s', ) * len(values)), self.suffix), args
 
 class HandlerContext(MutableMapping):
     def __init__(self, configs, data=None):
@@ -397,94 +1115,82 @@ class HandlerContext(MutableMapping):
         if key in self:
             return self[key]
 
-        _logger.debug('statement origin value: %s', statement)
-        statement = self.exp_value(statement, config)
-        _logger.debug('statement exp value: %s', statement)
-
-        data = None
-        if statement:
-            statement += ' LIMIT 1 '
-
-            _logger.debug('executeStatement: %s', statement)
-
-            conn = self._connPool.connection(database)
-            with conn.cursor() as cursor:
-                cursor.execute(statement)
-                data = cursor.fetchall()
-                _logger.debug('executeStatement data: %s', data)
+        data = self._query(config, 1)
 
         self[key] = data[0] if data else {}
 
         return self[key]
 
-    def exp_data(self, data, config, recursive=False, deepcopy=True):
-        if deepcopy:
-            data = copy.deepcopy(data)
-
-        if isinstance(data, list):
-            for index, item in enumerate(data):
-                data[index] = self.exp_data(item, config, recursive=recursive, deepcopy=False)
-        elif isinstance(data, dict):
-            for key, item in data.iteritems():
-                data[key] = self.exp_data(item, config, recursive=recursive, deepcopy=False)
-        elif isinstance(data, basestring):
-            data = self.exp_value(data, config, recursive=recursive)
-        else:
-            pass # do nothing, just return data
+    def fetchRows(self, config, limit, orderBy=None, statement=None):
+        """
+        执行配置节(ConfigItem)中的MySQL语句(或者指定的statement)，返回最多limit条记录。
+        查询结果不会写入context
+        """
+        return self._query(config, limit, orderBy=orderBy, statement=statement)
 
-        return data
+    def _query(self, config, limit, orderBy=None, statement=None):
+        database = config['database']
+        statement = statement or config.getTemplate('statement')
+        if not template.isTemplate(statement):
+            statement = template.Template(statement)
 
-    def exp_value(self, value, currConfig, recursive=True):
-        def get_origin_value(key, fieldName, defaultValue):
-            _logger.debug('get_origin: key[%s], fieldName[%s], default[%s]', key, fieldName, defaultValue)
+        _logger.debug('statement origin value: %s', statement.source)
+        statement, args = statement.bind(self, config)
+        _logger.debug('statement exp value: %s, args: %s', statement, args)
 
-            defaultValue = common.echo(defaultValue)
-            if not key:
-                key = currConfig['key']
+        if not statement:
+            return ()
 
-            _logger.debug('get_origin: key[%s], fieldName[%s], default[%s]', key, fieldName, defaultValue)
+        if orderBy:
+            statement += ' ORDER BY %s' % orderBy
+        statement += ' LIMIT %d ' % limit
 
-            if recursive:
-                if key not in self:
-                    oc = self._configs.get(key, None)
-                    if not oc:
-                        raise LogicException('exp value NOT found: [%s]' % value)
-                    self.executeStatement(oc)
+        _logger.debug('executeStatement: %s', statement)
 
-            if key not in self:
-                raise LogicException('exp value NOT found: [%s]' % value)
+        conn = self._connPool.connection(database)
+        with conn.cursor() as cursor:
+            cursor.execute(statement, args)
+            data = cursor.fetchall()
+            _logger.debug('executeStatement data: %s', data)
 
-            data = self[key]
-            if not data:
-                return defaultValue
-            
-            ret = data.get(fieldName, defaultValue)
-            return ret
+        return data
+
+    def exp_data(self, data, config, recursive=False, deepcopy=True):
+        """
+        data是编译后的模板(HandlerConfigItem.getTemplate)，或者包含表达式的dict、list、字符串。
+        渲染结果总是新的对象，deepcopy参数不再需要
+        """
+        if not template.isTemplate(data):
+            data = template.compile(data)
 
-        def sub_exp(matchobj):
-            if matchobj.group(0) == '%%':
-                return '%'
+        return data.render(self, config, recursive)
 
-            key = matchobj.group(2)
-            fieldName = matchobj.group(3)
-            defaultValue = matchobj.group(4)
+    def exp_value(self, value, currConfig, recursive=True):
+        if not template.isTemplate(value):
+            value = template.Template(value)
 
-            ret = get_origin_value(key, fieldName, defaultValue)
-            return unicode(ret)
+        return value.render(self, currConfig, recursive)
 
-        _logger.debug('exp_value: value[%s], currconfig[%s]', value, currConfig)
+    def resolveReference(self, reference, currConfig, recursive=True):
+        """
+        表达式中引用的值。被引用的数据为空时，使用默认值
+        """
+        key = reference.key or currConfig['key']
+        if key not in self:
+            if recursive:
+                oc = self._configs.get(key, None)
+                if not oc:
+                    raise LogicException('exp value NOT found: [%s]' % reference.source)
+                self.executeStatement(oc)
 
-        matches = _ORIGIN_VALUE_RE.match(value)
-        if matches:
-            key = matches.group(1)
-            fieldName = matches.group(2)
-            defaultValue = matches.group(3)
-            value = get_origin_value(key, fieldName, defaultValue)
-        else:
-            value = _EXP_RE.sub(sub_exp, value)
+            if key not in self:
+                raise LogicException('exp value NOT found: [%s]' % reference.source)
 
-        _logger.debug('exp_value result: value[%s], context[%s]', value, self)
-        return value
+        data = self[key]
+        if not data:
+            return reference.default
+
+        return data.get(reference.field, reference.default)
 
     def __str__(self):
         return str({
@@ -497,15 +1203,52 @@ class BinlogHandler(object):
         self._statusConfig = statusConfig
         self._handlerConfig = statusConfig.handlerConfig
 
-        self._insertEventProcessor = InsertEventProcessor(statusConfig)
-        self._deleteEventProcessor = DeleteEventProcessor(statusConfig)
+        # 增量更新时，bulk请求在当前线程中同步发送，以保证同一文档的操作顺序
+        esClient = remote.getElasticClient()
+        self._bulkWriter = BulkWriter(esClient, concurrency=1)
+        self._reverseIndex = ReverseIndex(statusConfig.esIndexSuffix) if ReverseIndex.enabled() else None
+
+        # 每次加载配置时(包括配置发生变化后)创建，增量更新之前通过registerScripts注册stored script
+        self._scriptRegistry = ScriptRegistry(esClient)
+
+        self._insertEventProcessor = InsertEventProcessor(statusConfig, self._bulkWriter, self._reverseIndex, self._scriptRegistry)
+        self._deleteEventProcessor = DeleteEventProcessor(statusConfig, self._bulkWriter, self._reverseIndex, self._scriptRegistry)
         self._updateEventProcessor = UpdateEventProcessor(
                 statusConfig, 
                 self._insertEventProcessor, 
-                self._deleteEventProcessor
+                self._deleteEventProcessor,
+                self._bulkWriter,
+                self._reverseIndex,
+                self._scriptRegistry
                 )
 
+    def registerScripts(self):
+        """
+        注册增量更新使用的所有stored script，并删除不再使用的脚本
+        """
+        self._scriptRegistry.registerAll(_SCRIPTS)
+
     def sync(self, binlogEvent):
+        self._syncEvent(binlogEvent)
+        self._flush()
+
+    def syncBatch(self, binlogEvents):
+        """
+        一批binlog中，文档级别的写操作(index/update/delete)通过一次bulk请求写入ES。
+        返回时，所有的操作都已经写入ES
+        """
+        for binlogEvent in binlogEvents:
+            self._syncEvent(binlogEvent)
+
+        self._flush()
+
+    def _flush(self):
+        self._bulkWriter.flush()
+
+        if self._reverseIndex:
+            self._reverseIndex.flush()
+
+    def _syncEvent(self, binlogEvent):
         database = binlogEvent['database']
         table = binlogEvent['table']
         configItems = self._handlerConfig.getConfigItemsByDatabaseAndTable(database, table)
@@ -526,9 +1269,7 @@ class BinlogHandler(object):
         values = binlogEvent['values']
 
         for config in configItems:
-            filterDict = config.get('filter', None)
-            filtered = CommonUtils.filterData(filterDict, values)                    
-            if not filtered:
+            if not config.matchFilter(values):
                 continue
 
             _logger.debug('config[%s], binlog[%s]', config, binlogEvent)
@@ -538,9 +1279,7 @@ class BinlogHandler(object):
         values = binlogEvent['values']
 
         for config in configItems:
-            filterDict = config.get('filter', None)
-            filtered = CommonUtils.filterData(filterDict, values)                    
-            if not filtered:
+            if not config.matchFilter(values):
                 continue
 
             _logger.debug('config[%s], binlog[%s]', config, binlogEvent)
@@ -551,11 +1290,8 @@ class BinlogHandler(object):
         afterValues = binlogEvent['values']
 
         for config in configItems:
-            filterDict = config.get('filter', None)
-            _logger.debug('filterDict[%s] of config[%s]', filterDict, config)
-
-            isBeforeFiltered = CommonUtils.filterData(filterDict, beforeValues)
-            isAfterFiltered = CommonUtils.filterData(filterDict, afterValues)
+            isBeforeFiltered = config.matchFilter(beforeValues)
+            isAfterFiltered = config.matchFilter(afterValues)
 
             _logger.debug('isBeforeFiltered: %s ; isAfterFiltered: %s', isBeforeFiltered, isAfterFiltered)
 
@@ -585,12 +1321,15 @@ class BinlogHandler(object):
             self._updateEventProcessor.process(config, binlogEvent)
 
 class _BaseEventProcessor(_ElasticSearchUtilsMixin, _HandlerUtilsMixin, object):
-    def __init__(self, statusConfig):
+    def __init__(self, statusConfig, bulkWriter=None, reverseIndex=None, scriptRegistry=None):
         self._statusConfig = statusConfig
         self._esClient = remote.getElasticClient()
         self._esIndexClient = IndicesClient(self._esClient)
+        self._bulkWriter = bulkWriter
+        self._reverseIndex = reverseIndex
+        self._scriptRegistry = scriptRegistry
 
-        self._scripts = {}
+        self._nestedQueries = {}
 
     def process(self, config, binlogEvent):
         if config.isMaster:
@@ -619,13 +1358,30 @@ class _BaseEventProcessor(_ElasticSearchUtilsMixin, _HandlerUtilsMixin, object):
 
         return key
 
-    def _getInlineScript(self, config, extraKeys=None):
-        key = self._getScriptKey(config, extraKeys)
-        return self._scripts.get(key, None)
+    def _getNestedQueryTemplate(self, config):
+        """
+        编译后的nested配置节的bool查询
+        """
+        key = self._getScriptKey(config, None)
+        nestedQuery = self._nestedQueries.get(key, None)
+        if nestedQuery is None:
+            nestedQuery = template.compile(self._getNestedBoolQuery(config))
+            self._nestedQueries[key] = nestedQuery
 
-    def _setInlineScript(self, config, script, extraKeys=None):
-        key = self._getScriptKey(config, extraKeys)
-        self._scripts[key] = script
+        return nestedQuery
+
+    def _getScript(self, inlineScript, params):
+        """
+        有scriptRegistry时，请求中只引用stored script的id
+        """
+        if self._scriptRegistry:
+            return self._scriptRegistry.getScript(inlineScript, params)
+
+        return {
+                'lang': 'painless', 
+                'inline': inlineScript,
+                'params': params
+                }
 
     @abstractmethod
     def _processMasterItem(self, config, binlogEvent):
@@ -644,8 +1400,8 @@ class _BaseEventProcessor(_ElasticSearchUtilsMixin, _HandlerUtilsMixin, object):
         pass
 
 class InsertEventProcessor(_BaseEventProcessor):
-    def __init__(self, statusConfig):
-        super(InsertEventProcessor, self).__init__(statusConfig)
+    def __init__(self, statusConfig, bulkWriter=None, reverseIndex=None, scriptRegistry=None):
+        super(InsertEventProcessor, self).__init__(statusConfig, bulkWriter, reverseIndex, scriptRegistry)
 
     def _processMasterItem(self, config, binlogEvent):
         """
@@ -660,6 +1416,7 @@ class InsertEventProcessor(_BaseEventProcessor):
         document = context.fillDataToDocument()
 
         self._writeToIndex(config, document, context)
+        self._addToReverseIndex(config, document, context)
 
     def _processNestedMasterItem(self, config, binlogEvent):
         """
@@ -695,9 +1452,12 @@ class InsertEventProcessor(_BaseEventProcessor):
 
         context = HandlerContext(relativedConfigs, { configKey: values })
 
-        query = context.exp_data(config['query'], config)
+        query = context.exp_data(config.getTemplate('query'), config)
         script = self._getSlaveItemScript(config, relativedConfigs, context)
 
+        if self._updateByReverseIndex(config, query, script):
+            return
+
         body = {
                 'query': self._getBoolQuery(query),
                 'script': script
@@ -720,8 +1480,7 @@ class InsertEventProcessor(_BaseEventProcessor):
         relativedConfigs = configList.getDependentItems(configKey, withSelf=True)
         context = HandlerContext(relativedConfigs, { configKey: values })
 
-        nestedQuery = self._getNestedBoolQuery(config)
-        nestedQuery = context.exp_data(nestedQuery, config)
+        nestedQuery = context.exp_data(self._getNestedQueryTemplate(config), config)
 
         script = self._getNestedSlaveItemScript(config, relativedConfigs, context)
 
@@ -736,21 +1495,8 @@ class InsertEventProcessor(_BaseEventProcessor):
         """
         InsertEventProcessor
         """
-        configList = config.getLocatedConfigList()
-        parentField = configList.getParentField()
-
-        inlineScript = self._getInlineScript(config)
-        if not inlineScript:
-            inlineTemplate = Template("if (ctx._source.${field} == null) ctx._source.${field} = []; ctx._source.${field}.add(params.${field})")
-            inlineScript = inlineTemplate.substitute(field=parentField)
-            self._setInlineScript(config, inlineScript)
-
-        script = {
-                'lang': 'painless', 
-                'inline': inlineScript,
-                'params': { parentField: nestedDoc }
-                }
-        return script
+        parentField = config.getLocatedConfigList().getParentField()
+        return self._getScript(_NESTED_ADD_SCRIPT, { 'field': parentField, 'doc': nestedDoc })
 
     def _getSlaveItemScript(self, config, relativedConfigs, context):
         """
@@ -758,21 +1504,6 @@ class InsertEventProcessor(_BaseEventProcessor):
         """
         relativedConfigs = relativedConfigs.values()
 
-        inlineScript = self._getInlineScript(config)
-
-        if not inlineScript:
-            inlineList = []
-            for conf in relativedConfigs:
-                mapping = conf['mapping']
-                for item in mapping:
-                    itemType = item['type']
-                    esField = item['es_field']
-
-                    inlineList.append("ctx._source.%s = params.%s" % (esField, esField))
-
-            inlineScript = ';'.join(inlineList)
-            self._setInlineScript(config, inlineScript)
-
         params = {}
         for conf in relativedConfigs:
             confKey = conf['key']
@@ -790,51 +1521,16 @@ class InsertEventProcessor(_BaseEventProcessor):
                 else:
                     params[esField] = CommonUtils.getDBFieldValue(dbField, values, conf, nullValue)
 
-        script = {
-                'lang': 'painless', 
-                'inline': inlineScript,
-                'params': params
-                }
-        return script
+        return self._getScript(_ASSIGN_SCRIPT, { 'data': params })
 
     def _getNestedSlaveItemScript(self, config, relativedConfigs, context):
         """
         InsertEventProcessor
         """
-        query = context.exp_data(config['query'], config)
-
-        inlineScript = self._getInlineScript(config)
-        if not inlineScript:
-            inlineTemplate = Template("""
-            for (item in ctx._source.${parent_field}) { 
-              if (${query_condition}) {
-                ${item_evaluation};
-              } 
-            }
-            """)
-
-            queryConditions = []
-            for key in query:
-                queryConditions.append('item.%s == params.query.%s' % (key, key))
-
-            itemEvaluations = []
-            for conf in relativedConfigs.values():
-                mapping = conf['mapping']
-                for item in mapping:
-                    esField = item['es_field']
-
-                    # no nested type in nested config item
-                    itemEvaluations.append("item.%s = params.data.%s" % (esField, esField))
-
-            parentField = config.getLocatedConfigList().getParentField()
-            inlineScript = inlineTemplate.substitute(
-                    parent_field=parentField,
-                    query_condition='&&'.join(queryConditions),
-                    item_evaluation=';'.join(itemEvaluations)
-                    )
-            self._setInlineScript(config, inlineScript)
+        query = context.exp_data(config.getTemplate('query'), config)
 
         params = {
+                'field': config.getLocatedConfigList().getParentField(),
                 'query': query,
                 'data': {}
                 }
@@ -850,16 +1546,11 @@ class InsertEventProcessor(_BaseEventProcessor):
                 # no nested type in nested config item
                 params['data'][esField] = CommonUtils.getDBFieldValue(dbField, values, conf, nullValue)
 
-        script = {
-                'lang': 'painless', 
-                'inline': inlineScript,
-                'params': params
-                }
-        return script
+        return self._getScript(_NESTED_ASSIGN_SCRIPT, params)
 
 class DeleteEventProcessor(_BaseEventProcessor):
-    def __init__(self, statusConfig):
-        super(DeleteEventProcessor, self).__init__(statusConfig)
+    def __init__(self, statusConfig, bulkWriter=None, reverseIndex=None, scriptRegistry=None):
+        super(DeleteEventProcessor, self).__init__(statusConfig, bulkWriter, reverseIndex, scriptRegistry)
 
     def _processMasterItem(self, config, binlogEvent):
         """
@@ -872,6 +1563,10 @@ class DeleteEventProcessor(_BaseEventProcessor):
 
         self._deleteFromIndex(config, context)
 
+        if self._reverseIndex:
+            documentId = context.exp_value(config.getTemplate('document_id'), config)
+            self._reverseIndex.remove(config, self._getMasterFieldValues(config, values), documentId)
+
     def _processNestedMasterItem(self, config, binlogEvent):
         """
         DeleteEventProcessor
@@ -883,8 +1578,7 @@ class DeleteEventProcessor(_BaseEventProcessor):
 
         script = self._getNestedMasterItemScript(config, context)
 
-        nestedQuery = self._getNestedBoolQuery(config)
-        nestedQuery = context.exp_data(nestedQuery, config)
+        nestedQuery = context.exp_data(self._getNestedQueryTemplate(config), config)
 
         body = {
                 'query': nestedQuery,
@@ -906,7 +1600,10 @@ class DeleteEventProcessor(_BaseEventProcessor):
 
         script = self._getSlaveItemScript(config, relativedConfigs, context)
 
-        query = context.exp_data(config['query'], config)
+        query = context.exp_data(config.getTemplate('query'), config)
+        if self._updateByReverseIndex(config, query, script):
+            return
+
         body = {
                 'query': self._getBoolQuery(query),
                 'script': script
@@ -927,8 +1624,7 @@ class DeleteEventProcessor(_BaseEventProcessor):
 
         script = self._getNestedSlaveItemScript(config, relativedConfigs, context)
 
-        nestedQuery = self._getNestedBoolQuery(config)
-        nestedQuery = context.exp_data(nestedQuery, config)
+        nestedQuery = context.exp_data(self._getNestedQueryTemplate(config), config)
 
         body = {
                 'query': nestedQuery,
@@ -941,50 +1637,15 @@ class DeleteEventProcessor(_BaseEventProcessor):
         """
         DeleteEventProcessor
         """
-        query = context.exp_data(config['query'], config)
-
-        configList = config.getLocatedConfigList()
-        parentField = configList.getParentField()
-
-        inlineScript = self._getInlineScript(config)
-        if not inlineScript:
-            inlineTemplate = Template("""if (ctx._source.${field} == null) { ctx._source.${field} = []; } ctx._source.${field}.removeIf(item -> ${query_condition});""")
-
-            queryConditions = []
-            for key in query:
-                queryConditions.append('item.%s == params.query.%s' % (key, key))
+        query = context.exp_data(config.getTemplate('query'), config)
 
-            inlineScript = inlineTemplate.substitute(
-                    field=parentField,
-                    query_condition='&&'.join(queryConditions)
-                    ) 
-            self._setInlineScript(config, inlineScript)
-
-        script = {
-                'lang': 'painless', 
-                'inline': inlineScript,
-                'params': {
-                    'query': query
-                    }
-                }
-        return script
+        parentField = config.getLocatedConfigList().getParentField()
+        return self._getScript(_NESTED_REMOVE_SCRIPT, { 'field': parentField, 'query': query })
 
     def _getSlaveItemScript(self, config, relativedConfigs, context):
         """
         DeleteEventProcessor
         """
-        inlineScript = self._getInlineScript(config)
-        if not inlineScript:
-            inlineList = []
-            for conf in relativedConfigs.values():
-                mapping = conf['mapping']
-                for item in mapping:
-                    esField = item['es_field']
-                    inlineList.append("ctx._source.%s = params.%s" % (esField, esField))
-
-            inlineScript = ';'.join(inlineList) + ';'
-            self._setInlineScript(config, inlineScript)
-
         params = {}
         for conf in relativedConfigs.values():
             confKey = conf['key']
@@ -1006,51 +1667,16 @@ class DeleteEventProcessor(_BaseEventProcessor):
                 else:
                     params[esField] = nullValue
 
-        script = {
-                'lang': 'painless', 
-                'inline': inlineScript,
-                'params': params
-                }
-        return script
+        return self._getScript(_ASSIGN_SCRIPT, { 'data': params })
 
     def _getNestedSlaveItemScript(self, config, relativedConfigs, context):
         """
         DeleteEventProcessor
         """
-        query = context.exp_data(config['query'], config)
-
-        inlineScript = self._getInlineScript(config)
-        if not inlineScript:
-            inlineTemplate = Template("""
-            for (item in ctx._source.${parent_field}) {
-                if (${query_condition}) {
-                    ${item_evaluation};
-                }
-            }
-            """)
-
-            queryConditions = []
-            for key in query:
-                queryConditions.append('item.%s == params.query.%s' % (key, key))
-
-            itemEvaluations = []
-            for conf in relativedConfigs.values():
-                mapping = conf['mapping']
-                for item in mapping:
-                    esField = item['es_field']
-
-                    # no nested type in nested config item
-                    itemEvaluations.append("item.%s = params.data.%s" % (esField, esField))
-
-            parentField = config.getLocatedConfigList().getParentField()
-            inlineScript = inlineTemplate.substitute(
-                    parent_field=parentField,
-                    query_condition='&&'.join(queryConditions),
-                    item_evaluation=';'.join(itemEvaluations)
-                    )
-            self._setInlineScript(config, inlineScript)
+        query = context.exp_data(config.getTemplate('query'), config)
 
         params = {
+                'field': config.getLocatedConfigList().getParentField(),
                 'query': query,
                 'data': {}
                 }
@@ -1070,19 +1696,15 @@ class DeleteEventProcessor(_BaseEventProcessor):
                 else:
                     params['data'][esField] = nullValue
 
-        script = {
-                'lang': 'painless', 
-                'inline': inlineScript,
-                'params': params
-                }
-        return script
+        return self._getScript(_NESTED_ASSIGN_SCRIPT, params)
 
 class UpdateEventProcessor(_BaseEventProcessor):
-    def __init__(self, statusConfig, insertProcessor, deleteProcessor):
+    def __init__(self, statusConfig, insertProcessor, deleteProcessor, bulkWriter=None, reverseIndex=None, scriptRegistry=None):
         self._insertProcessor = insertProcessor
         self._deleteProcessor = deleteProcessor
+        self._mappingFields = {}
 
-        super(UpdateEventProcessor, self).__init__(statusConfig)
+        super(UpdateEventProcessor, self).__init__(statusConfig, bulkWriter, reverseIndex, scriptRegistry)
 
     def _updateTotally(self, config, binlogEvent):
         database = binlogEvent['database']
@@ -1093,6 +1715,27 @@ class UpdateEventProcessor(_BaseEventProcessor):
         self._deleteProcessor.process(config, CommonUtils.buildBinlogEventLog(database, table, 'DELETE', beforeValues))
         self._insertProcessor.process(config, CommonUtils.buildBinlogEventLog(database, table, 'INSERT', afterValues))
 
+    def _getUnchangedEsFields(self, config, values):
+        """
+        delta编码的UPDATE只包含发生变化的字段以及同步时总是需要的字段。
+        mapping中引用的字段不在values中时，该字段没有变化，不需要更新
+        """
+        cacheKey = self._getScriptKey(config, None)
+        mappingFields = self._mappingFields.get(cacheKey, None)
+        if mappingFields is None:
+            mappingFields = []
+            for item in config['mapping']:
+                if item['type'] != 'nested':
+                    dbFields = compiler.getFields(item['db_field'])
+                    if dbFields:
+                        mappingFields.append((item['es_field'], dbFields))
+            self._mappingFields[cacheKey] = mappingFields
+
+        if not values:
+            return set()
+
+        return set(esField for esField, dbFields in mappingFields if not dbFields.issubset(values))
+
     def _needUpdateTotally(self, config, fields):
         anchorFields = config.getAnchorFields()
         _logger.debug("fields: %s", fields)
@@ -1129,19 +1772,23 @@ class UpdateEventProcessor(_BaseEventProcessor):
         script = self._getMasterItemScript(config, fields, relativedConfigs, context)
         body = { 'script': script }
 
-        documentId = context.exp_value(config['document_id'], config)
+        documentId = context.exp_value(config.getTemplate('document_id'), config)
         routing = config.get('routing', None)
         if routing:
-            routing = context.exp_value(config['routing'], config)
-
-        self._esClient.update(
-                index=self._getESIndexFullname(config.esIndex),
-                doc_type=config.esType,
-                id=documentId,
-                routing=routing,
-                body=body,
-                retry_on_conflict=_MAX_RETRY_COUNT
-                )
+            routing = context.exp_value(config.getTemplate('routing'), config)
+
+        self._updateDocument(config, documentId, routing, body)
+
+        if self._reverseIndex:
+            # delta编码时，反向索引用到的字段总是包含在消息中(HandlerConfigList.getProjectedFields)
+            unchangedFields = self._getUnchangedEsFields(config, afterValues)
+            self._reverseIndex.update(
+                    config,
+                    self._getMasterFieldValues(config, beforeValues, unchangedFields),
+                    self._getMasterFieldValues(config, afterValues, unchangedFields),
+                    documentId,
+                    routing
+                    )
 
     def _processNestedMasterItem(self, config, binlogEvent):
         """
@@ -1166,8 +1813,7 @@ class UpdateEventProcessor(_BaseEventProcessor):
 
         script = self._getNestedMasterItemScript(config, fields, relativedConfigs, context)
 
-        nestedQuery = self._getNestedBoolQuery(config)
-        nestedQuery = context.exp_data(nestedQuery, config)
+        nestedQuery = context.exp_data(self._getNestedQueryTemplate(config), config)
 
         body = {
                 'query': nestedQuery,
@@ -1199,7 +1845,9 @@ class UpdateEventProcessor(_BaseEventProcessor):
 
         script = self._getSlaveItemScript(config, fields, relativedConfigs, context)
 
-        query = context.exp_data(config['query'], config)
+        query = context.exp_data(config.getTemplate('query'), config)
+        if self._updateByReverseIndex(config, query, script):
+            return
 
         body = {
                 'query': self._getBoolQuery(query),
@@ -1231,8 +1879,7 @@ class UpdateEventProcessor(_BaseEventProcessor):
 
         script = self._getNestedSlaveItemScript(config, fields, relativedConfigs, context)
 
-        nestedQuery = self._getNestedBoolQuery(config)
-        nestedQuery = context.exp_data(nestedQuery, config)
+        nestedQuery = context.exp_data(self._getNestedQueryTemplate(config), config)
 
         body = {
                 'query': nestedQuery,
@@ -1247,24 +1894,7 @@ class UpdateEventProcessor(_BaseEventProcessor):
         """
         dependentNestedLists = config.getNestedDependentLists(fields=fields)
 
-        inlineScript = self._getInlineScript(config, extraKeys=fields)
-        if not inlineScript:
-            inlineList = []
-            for conf in relativedConfigs.values():
-                mapping = conf['mapping']
-                for item in mapping:
-                    esField = item['es_field']
-                    itemType = item['type']
-
-                    if conf is config and itemType == 'nested':
-                        nestedList = conf.getNestedListByEsField(esField)
-                        if nestedList in dependentNestedLists:
-                            inlineList.append("ctx._source.%s = params.%s" % (esField, esField))
-                    else:
-                        inlineList.append("ctx._source.%s = params.%s" % (esField, esField))
-
-            inlineScript = ';'.join(inlineList) + ';'
-            self._setInlineScript(config, inlineScript, extraKeys=fields)
+        unchangedFields = self._getUnchangedEsFields(config, context.getData(config.key))
 
         params = {}
         for conf in relativedConfigs.values():
@@ -1276,6 +1906,9 @@ class UpdateEventProcessor(_BaseEventProcessor):
                 dbField = item['db_field']
                 itemType = item['type']
                 nullValue = item['null_value']
+
+                if conf is config and esField in unchangedFields:
+                    continue
         
                 if itemType == 'nested':
                     if conf is config:
@@ -1287,51 +1920,18 @@ class UpdateEventProcessor(_BaseEventProcessor):
                 else:
                     params[esField] = CommonUtils.getDBFieldValue(dbField, values, conf, nullValue)
 
-        script = {
-                'lang': 'painless', 
-                'inline': inlineScript,
-                'params': params
-                }
-        return script
+        return self._getScript(_ASSIGN_SCRIPT, { 'data': params })
 
     def _getNestedMasterItemScript(self, config, fields, relativedConfigs, context):
         """
         UpdateEventProcessor
         """
-        query = context.exp_data(config['query'], config)
+        query = context.exp_data(config.getTemplate('query'), config)
 
-        inlineScript = self._getInlineScript(config, extraKeys=fields)
-        if not inlineScript:
-            inlineTemplate = Template("""
-            for (item in ctx._source.${parent_field}) {
-                if (${query_condition}) {
-                    ${item_evaluation};
-                }
-            }
-            """)
-
-            queryConditions = []
-            for key in query:
-                queryConditions.append('item.%s == params.query.%s' % (key, key))
-
-            itemEvaluations = []
-            for conf in relativedConfigs.values():
-                mapping = conf['mapping']
-                for item in mapping:
-                    esField = item['es_field']
-
-                    # no nested type in nested config item
-                    itemEvaluations.append("item.%s = params.data.%s" % (esField, esField))
-
-            parentField = config.getLocatedConfigList().getParentField()
-            inlineScript = inlineTemplate.substitute(
-                    parent_field=parentField,
-                    query_condition='&&'.join(queryConditions),
-                    item_evaluation=';'.join(itemEvaluations)
-                    )
-            self._setInlineScript(config, inlineScript, extraKeys=fields)
+        unchangedFields = self._getUnchangedEsFields(config, context.getData(config.key))
 
         params = {
+                'field': config.getLocatedConfigList().getParentField(),
                 'query': query,
                 'data': {}
                 }
@@ -1343,16 +1943,14 @@ class UpdateEventProcessor(_BaseEventProcessor):
                 esField = item['es_field']
                 dbField = item['db_field']
                 nullValue = item['null_value']
+
+                if conf is config and esField in unchangedFields:
+                    continue
         
                 # no nested type in nested config item
                 params['data'][esField] = CommonUtils.getDBFieldValue(dbField, values, conf, nullValue)
 
-        script = {
-                'lang': 'painless', 
-                'inline': inlineScript,
-                'params': params
-                }
-        return script
+        return self._getScript(_NESTED_ASSIGN_SCRIPT, params)
 
     def _getSlaveItemScript(self, config, fields, relativedConfigs, context):
         """
@@ -1372,15 +1970,7 @@ class CommonUtils(object):
         if not values or not dbField:
             return nullValue
 
-        kwargs = {
-                'values': values,
-                'index': config.esIndex,
-                'type': config.esType,
-                'database': config['database'],
-                'table': config['table']
-                }
-
-        retValue = common.resolve(dbField, **kwargs)
+        retValue = config.getMappingFunction(dbField)(values, config.getFunctionContext())
         if retValue is None:
             return nullValue
         else:
@@ -1394,52 +1984,3 @@ class CommonUtils(object):
                 'type': eventType,
                 'values': values
                 }
-
-    @staticmethod
-    def filterData(filterDict, values):
-        """
-        是否过滤指定数据
-        True 数据通过
-        False 数据被过滤
-        """
-        _logger.debug('filterDict[%s] ; values[%s]', filterDict, values)
-        if filterDict:
-            for filterKey in filterDict.keys():
-                if filterKey not in values:
-                    return False
-
-                filterValue = filterDict[filterKey]
-                dataValue = values[filterKey]
-                if isinstance(filterValue, list):
-                    if dataValue not in filterValue:
-                        return False
-                elif isinstance(filterValue, dict):
-                    for op in filterValue.keys():
-                        value = filterValue[op]
-                        if op == '==':
-                            if dataValue != value:
-                                return False
-                        elif op == '!=' or op == '<>':
-                            if dataValue == value:
-                                return False
-                        elif op == '>':
-                            if dataValue <= value:
-                                return False
-                        elif op == '>=':
-                            if dataValue < value:
-                                return False
-                        elif op == '<':
-                            if dataValue >= value:
-                                return False
-                        elif op == '<=':
-                            if dataValue > value:
-                                return False
-                        else:
-                            raise IllegalConfigException('filter op NOT supported yet: %s' % op)
-                else:
-                    if dataValue != filterValue:
-                        return False
-
-        # 默认通过
-        return True
-
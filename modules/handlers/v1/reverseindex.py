@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+
+"""
+slave配置节的反向索引：(配置节, query的值) => 受影响的ES文档的id和routing。
+slave配置节对应的mysql行数据发生变化时，可以直接对这些文档做局部更新，
+而不必通过update_by_query在ES中查找。
+
+只有query中的字段全部来自主配置节mapping的slave配置节，才会被索引。
+索引保存在redis中，在全量更新以及主配置节的增量更新时维护；
+全量更新完成之前，索引是冷的，仍然使用update_by_query。
+"""
+
+from __future__ import print_function, division
+
+import hashlib
+import simplejson as json
+
+import application.app as app
+import modules.remote as remote
+
+from application.config import config
+
+_logger = app.getLogger('base')
+
+_KEY_PREFIX = '__mee_ri_'
+
+class ReverseIndex(object):
+    def __init__(self, esIndexSuffix, redisClient=None):
+        self._esIndexSuffix = esIndexSuffix
+        self._redisClient = redisClient if redisClient else remote.getRedisClient()
+        self._pipeline = None
+        self._pending = 0
+
+        # (esIndex, esType) => { slave配置节的key: query中的字段 }
+        self._indexedItems = {}
+        self._readyCache = {}
+
+    @staticmethod
+    def enabled():
+        return config().getBoolean('sync', 'reverse_index', False)
+
+    @staticmethod
+    def clear(redisClient, esIndexSuffix):
+        """
+        删除es index后缀为esIndexSuffix的所有反向索引
+        """
+        keys = list(redisClient.scan_iter(match=_KEY_PREFIX + esIndexSuffix + '_*', count=1000))
+        for start in range(0, len(keys), 1000):
+            redisClient.delete(*keys[start:start + 1000])
+
+    def add(self, masterItem, document, documentId, routing):
+        """
+        主配置节的文档写入ES后，把文档加入到相关slave配置节的索引中
+        """
+        for itemKey, fields in self._getIndexedItems(masterItem).items():
+            key = self._getKey(masterItem, itemKey, fields, document)
+            self._getPipeline().hset(key, documentId, routing or '')
+
+        self._autoFlush()
+
+    def remove(self, masterItem, fieldValues, documentId):
+        """
+        主配置节的文档从ES中删除后，把文档从相关slave配置节的索引中移除。
+        fieldValues: 文档中的字段值，至少包含query中的字段
+        """
+        for itemKey, fields in self._getIndexedItems(masterItem).items():
+            key = self._getKey(masterItem, itemKey, fields, fieldValues)
+            self._getPipeline().hdel(key, documentId)
+
+        self._autoFlush()
+
+    def update(self, masterItem, beforeValues, afterValues, documentId, routing):
+        """
+        主配置节的文档发生变化后，把文档移动到新的query值对应的索引中
+        """
+        for itemKey, fields in self._getIndexedItems(masterItem).items():
+            missingFields = [ field for field in fields if field not in afterValues ]
+            if missingFields:
+                _logger.error('fields%s of reverse index[%s] NOT found in update of document[%s], index NOT updated', missingFields, itemKey, documentId)
+                continue
+
+            beforeKey = self._getKey(masterItem, itemKey, fields, beforeValues)
+            afterKey = self._getKey(masterItem, itemKey, fields, afterValues)
+            if beforeKey != afterKey:
+                self._getPipeline().hdel(beforeKey, documentId)
+                self._getPipeline().hset(afterKey, documentId, routing or '')
+
+        self._autoFlush()
+
+    def lookup(self, item, query):
+        """
+        返回slave配置节item中，query对应的文档 { documentId: routing }。
+        item没有被索引，或者索引是冷的时候，返回None
+        """
+        masterItem = item.getLocatedConfigList().getMasterItem()
+        fields = self._getIndexedItems(masterItem).get(item.key, None)
+        if fields is None or not self.isReady(masterItem.esIndex, masterItem.esType):
+            return None
+
+        # 先写入缓存中的变更
+        self.flush()
+
+        key = self._getKey(masterItem, item.key, fields, query)
+        documents = self._redisClient.hgetall(key)
+
+        _logger.debug('lookup reverse index: key[%s], query[%s], documents[%s]', key, query, len(documents))
+
+        return { documentId: routing or None for documentId, routing in documents.items() }
+
+    def flush(self):
+        if self._pipeline is not None:
+            self._pipeline.execute()
+            self._pipeline = None
+            self._pending = 0
+
+    def markReady(self, esIndex, esType):
+        """
+        全量更新完成后调用，之后增量更新时才会使用索引
+        """
+        self.flush()
+        self._redisClient.set(self._getReadyKey(esIndex, esType), 1)
+        self._readyCache[(esIndex, esType)] = True
+
+    def isReady(self, esIndex, esType):
+        cacheKey = (esIndex, esType)
+        if not self._readyCache.get(cacheKey, False):
+            self._readyCache[cacheKey] = bool(self._redisClient.exists(self._getReadyKey(esIndex, esType)))
+
+        return self._readyCache[cacheKey]
+
+    def _getPipeline(self):
+        if self._pipeline is None:
+            self._pipeline = self._redisClient.pipeline(transaction=False)
+        return self._pipeline
+
+    def _autoFlush(self):
+        self._pending += 1
+        if self._pending >= 1000:
+            self.flush()
+
+    def _getIndexedItems(self, masterItem):
+        cacheKey = (masterItem.esIndex, masterItem.esType)
+        if cacheKey not in self._indexedItems:
+            configList = masterItem.getLocatedConfigList()
+
+            masterFields = set()
+            for mapItem in masterItem['mapping']:
+                if mapItem['type'] != 'nested':
+                    masterFields.add(mapItem['es_field'])
+
+            indexedItems = {}
+            for item in configList.getSlaveItems():
+                query = item.get('query', None)
+                if isinstance(query, dict) and query and set(query.keys()).issubset(masterFields):
+                    indexedItems[item.key] = tuple(sorted(query.keys()))
+
+            self._indexedItems[cacheKey] = indexedItems
+
+        return self._indexedItems[cacheKey]
+
+    def _getKey(self, masterItem, itemKey, fields, values):
+        data = json.dumps([ unicode(values.get(field, None)) for field in fields ])
+        digest = hashlib.sha1(data.encode('utf-8')).hexdigest()
+        return '%s%s_%s_%s_%s_%s' % (_KEY_PREFIX, self._esIndexSuffix, masterItem.esIndex, masterItem.esType, itemKey, digest)
+
+    def _getReadyKey(self, esIndex, esType):
+        return '%s%s_%s_%s__ready' % (_KEY_PREFIX, self._esIndexSuffix, esIndex, esType)
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+
+"""
+把增量更新时使用的painless脚本保存为ES的stored script，
+请求中只引用脚本的id，避免ES对同一个脚本反复编译。
+"""
+
+from __future__ import print_function, division
+
+import hashlib
+
+import application.app as app
+
+_logger = app.getLogger('base')
+
+_SCRIPT_ID_PREFIX = 'mee_'
+
+class ScriptRegistry(object):
+    """
+    脚本的id由脚本内容的hash生成，内容相同的脚本只注册一次。
+    所有的脚本在加载配置时通过registerAll注册，同步过程中不会访问ES
+    """
+    def __init__(self, esClient):
+        self._esClient = esClient
+        self._registered = frozenset()
+
+    def getScript(self, source, params):
+        """
+        返回引用stored script的script参数，没有注册的脚本使用inline script
+        """
+        scriptId = self.getScriptId(source)
+        if scriptId not in self._registered:
+            _logger.warning('script NOT registered, use inline script: %s', source)
+            return {
+                    'lang': 'painless',
+                    'inline': source,
+                    'params': params
+                    }
+
+        return {
+                'id': scriptId,
+                'params': params
+                }
+
+    def registerAll(self, sources):
+        """
+        注册sources中还没有保存在ES中的脚本，并删除ES中不再使用的脚本(id以mee_开头)
+        """
+        scriptIds = {}
+        for source in sources:
+            scriptIds[self.getScriptId(source)] = source
+
+        stored = self._loadRegistered()
+        for scriptId, source in scriptIds.items():
+            if scriptId not in stored:
+                _logger.info('register stored script[%s]: %s', scriptId, source)
+                self._esClient.put_script(
+                        id=scriptId,
+                        body={ 'script': { 'lang': 'painless', 'source': source } }
+                        )
+
+        for scriptId in stored:
+            if scriptId not in scriptIds:
+                _logger.info('delete unused stored script[%s]', scriptId)
+                self._esClient.delete_script(id=scriptId, ignore=404)
+
+        self._registered = frozenset(scriptIds)
+
+    @staticmethod
+    def getScriptId(source):
+        if isinstance(source, unicode):
+            source = source.encode('utf-8')
+        return _SCRIPT_ID_PREFIX + hashlib.sha1(source).hexdigest()
+
+    def _loadRegistered(self):
+        state = self._esClient.cluster.state(metric='metadata', filter_path='metadata.stored_scripts')
+        scripts = state.get('metadata', {}).get('stored_scripts', {})
+        return set(scriptId for scriptId in scripts if scriptId.startswith(_SCRIPT_ID_PREFIX))
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, division
+
+import unittest
+
+from ..commonhandler import _BatchStatement
+
+_DEPENDENCES = { 'user': 'master', 'city': 'user' }
+
+class _Item(dict):
+    def __init__(self, key, statement, isMaster=False, isNested=False):
+        super(_Item, self).__init__(key=key, table=key, statement=statement)
+        self.key = key
+        self.isMaster = isMaster
+        self._isNested = isNested
+
+    def isNested(self):
+        return self._isNested
+
+class _ConfigList(object):
+    def __init__(self, dependences):
+        self._dependences = dependences
+        self._columnInfos = {}
+
+    def getMasterKey(self):
+        return 'master'
+
+    def getDependenceKey(self, key):
+        return self._dependences.get(key)
+
+    def getColumnInfo(self, key, column):
+        return self._columnInfos.get((key, column), None)
+
+    def setColumnInfo(self, key, column, info):
+        self._columnInfos[(key, column)] = info
+
+class _Cursor(object):
+    def __init__(self, conn):
+        self._conn = conn
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, sql, args=None):
+        self._conn.queries.append((sql, args))
+
+    def fetchone(self):
+        return { 'collation_name': self._conn.collation, 'data_type': self._conn.dataType }
+
+class _Conn(object):
+    def __init__(self, collation, dataType='varchar'):
+        self.collation = collation
+        self.dataType = dataType
+        self.queries = []
+
+    def cursor(self):
+        return _Cursor(self)
+
+class BatchStatementTests(unittest.TestCase):
+    def setUp(self):
+        self.configList = _ConfigList(_DEPENDENCES)
+
+    def _parse(self, key, statement, configList=None):
+        return _BatchStatement.parse(_Item(key, statement), configList or self.configList)
+
+    def _parseNew(self, key, statement):
+        """
+        使用新的HandlerConfigList，不使用缓存的collation
+        """
+        return self._parse(key, statement, _ConfigList(_DEPENDENCES))
+
+    def test_parse_master(self):
+        statement = self._parse('user', 'select * from user u where u.id = %__master.user_id and u.status = 1')
+        self.assertEqual(statement.dependKey, 'master')
+        self.assertEqual(statement.column, 'u.id')
+        self.assertEqual(statement.columnName, 'id')
+        self.assertEqual(statement.field, 'user_id')
+        self.assertFalse(statement.quoted)
+        self.assertEqual(statement.bind([1, 2]), ('SELECT *, u.id AS __mee_batch_key FROM user u where u.id IN (%s, %s) and u.status = 1', (1, 2)))
+
+    def test_parse_quoted(self):
+        statement = self._parse('city', "select * from city where name = '%user.city:(0)' and code like 'a%%'")
+        self.assertTrue(statement.quoted)
+        self.assertEqual(statement.getValue({}), 0)
+        self.assertEqual(statement.getValue({ 'city': 'Bei' }), 'Bei')
+        self.assertEqual(statement.bind(['a', 'b']), ("SELECT *, name AS __mee_batch_key FROM city where name IN (%s, %s) and code like 'a%%'", (u'a', u'b')))
+
+        # collation未知时，按照原值匹配
+        self.assertNotEqual(statement.normalize('Bei  '), statement.normalize('bei'))
+        self.assertEqual(statement.normalize(3), u'3')
+
+    def test_parse_nested_master(self):
+        item = _Item('monitor', 'select * from monitor where id > %__last.id:(0) and car_id = %__parent.id and status = 1', isMaster=True, isNested=True)
+        statement = _BatchStatement.parse(item, self.configList)
+        self.assertEqual(statement.dependKey, '__parent')
+        self.assertEqual(statement.field, 'id')
+        self.assertEqual(statement.bind([3]), ('SELECT *, car_id AS __mee_batch_key FROM monitor where id > 0 and car_id IN (%s) and status = 1', (3, )))
+
+    def test_not_batchable(self):
+        self.assertIsNone(self._parse('user', 'select name from user where id = %__master.user_id'))
+        self.assertIsNone(self._parse('user', 'select * from user where id = %__master.user_id order by id'))
+        self.assertIsNone(self._parse('user', 'select * from user where id > %__master.user_id'))
+        self.assertIsNone(self._parse('user', 'select * from user where id = %__master.user_id and type = %__master.type'))
+        self.assertIsNone(self._parse('user', 'select * from user where id = %__master.user_id or status = 1'))
+        self.assertIsNone(self._parse('user', 'select * from user where id = %__master.user_id and status in (select status from s)'))
+        self.assertIsNotNone(self._parse('user', 'select * from user where id = %__master.user_id order_status = 1'))
+
+    def test_collation(self):
+        statement = self._parse('city', "select * from city where name = '%user.city'")
+        self.assertFalse(statement.caseInsensitive)
+
+        statement.resolveCollation(_Conn('utf8mb4_general_ci'))
+        self.assertEqual(statement.normalize('Bei  '), statement.normalize('bei'))
+
+        statement = self._parseNew('city', "select * from city where name = '%user.city'")
+        statement.resolveCollation(_Conn('utf8mb4_0900_ai_ci'))
+        self.assertEqual(statement.normalize('Bei'), statement.normalize('bei'))
+        self.assertNotEqual(statement.normalize('bei  '), statement.normalize('bei'))
+
+        statement = self._parseNew('city', "select * from city where name = '%user.city'")
+        statement.resolveCollation(_Conn('utf8mb4_bin'))
+        self.assertNotEqual(statement.normalize('Bei'), statement.normalize('bei'))
+        self.assertEqual(statement.normalize('bei  '), statement.normalize('bei'))
+
+        # join时无法确定列属于哪个表
+        statement = self._parseNew('city', "select * from city c join province p on c.pid = p.id where c.name = '%user.city'")
+        conn = _Conn('utf8mb4_general_ci')
+        statement.resolveCollation(conn)
+        self.assertEqual(conn.queries, [])
+        self.assertFalse(statement.caseInsensitive)
+        self.assertIsNone(self._parse('city', 'select * from city where id = %__master.city_id'))
+        self.assertIsNone(self._parse('user', 'select * from user where id > %__last.id:(0) and id = %__master.user_id'))
+
+    def test_collation_cache(self):
+        statement = self._parse('city', "select * from city where name = '%user.city'")
+        statement.resolveCollation(_Conn('utf8mb4_general_ci'))
+
+        # 重新构造的statement使用HandlerConfigList中缓存的结果
+        statement = self._parse('city', "select * from city where name = '%user.city'")
+        conn = _Conn('utf8mb4_bin')
+        statement.resolveCollation(conn)
+        self.assertEqual(conn.queries, [])
+        self.assertTrue(statement.caseInsensitive)
+
+    def test_bindable(self):
+        statement = self._parse('user', 'select * from user where id = %__master.user_id')
+        # column的类型未知时逐条执行
+        self.assertFalse(statement.isBindable(1))
+
+        statement.resolveCollation(_Conn(None, 'bigint'))
+        self.assertTrue(statement.isBindable(1))
+        self.assertFalse(statement.isBindable('1 or 1 = 1'))
+        self.assertFalse(statement.isBindable(None))
+        self.assertFalse(statement.isBindable(True))
+        self.assertEqual(statement.normalize(5), 5)
+
+        statement = self._parseNew('user', 'select * from user where id = %__master.user_id')
+        statement.resolveCollation(_Conn(None, 'datetime'))
+        self.assertFalse(statement.isBindable(20200101))
+
+    def test_unquoted_character_column(self):
+        # 不带引号的数字与字符类型的列比较，查询结果中的值是字符串
+        statement = self._parse('user', 'select * from user where code = %__master.user_code')
+        statement.resolveCollation(_Conn('utf8mb4_general_ci', 'varchar'))
+        self.assertTrue(statement.isBindable(5))
+        self.assertEqual(statement.normalize(5), statement.normalize(u'5'))
+        self.assertEqual(statement.bind([5]), ('SELECT *, code AS __mee_batch_key FROM user where code IN (%s)', (5, )))
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, division
+
+import unittest
+import simplejson as json
+
+from elasticsearch.serializer import JSONSerializer
+
+from application import LogicException
+from ..bulkwriter import BulkWriter
+
+class _Transport(object):
+    serializer = JSONSerializer()
+
+class _FakeESClient(object):
+    """
+    记录bulk请求；failures中的文档id，在前几次请求中返回指定的状态码
+    """
+    def __init__(self, failures=None):
+        self.transport = _Transport()
+        self.requests = []
+        self.failures = failures if failures else {}
+
+    def bulk(self, body):
+        lines = [ json.loads(line) for line in body.strip().split('\n') ]
+        self.requests.append(lines)
+
+        items = []
+        for line in lines:
+            if not isinstance(line, dict) or len(line) != 1 or line.keys()[0] not in ('index', 'update', 'delete'):
+                continue
+
+            opType, meta = line.items()[0]
+            docId = meta.get('_id')
+            statuses = self.failures.get(docId, [])
+            if statuses:
+                status = statuses.pop(0)
+                items.append({ opType: { '_id': docId, 'status': status, 'error': { 'type': 'error_%s' % status } } })
+            else:
+                items.append({ opType: { '_id': docId, 'status': 201 } })
+
+        return { 'errors': False, 'items': items }
+
+class BulkWriterTests(unittest.TestCase):
+    def test_chunk_by_count(self):
+        client = _FakeESClient()
+        writer = BulkWriter(client, chunkSize=3, maxChunkBytes=1024 * 1024, concurrency=1, maxRetries=0)
+        for i in range(7):
+            writer.index('index', 'doc', { 'id': i }, documentId=str(i))
+        writer.flush()
+
+        self.assertEqual(len(client.requests), 3)
+        self.assertEqual(writer.succeeded, 7)
+        self.assertEqual(writer.failed, 0)
+
+    def test_chunk_by_bytes(self):
+        client = _FakeESClient()
+        writer = BulkWriter(client, chunkSize=1000, maxChunkBytes=100, concurrency=1, maxRetries=0)
+        for i in range(4):
+            writer.index('index', 'doc', { 'text': 'x' * 60 }, documentId=str(i))
+        writer.flush()
+
+        self.assertEqual(len(client.requests), 4)
+
+    def test_concurrency(self):
+        client = _FakeESClient()
+        writer = BulkWriter(client, chunkSize=2, maxChunkBytes=1024 * 1024, concurrency=3, maxRetries=0)
+        try:
+            for i in range(10):
+                writer.index('index', 'doc', { 'id': i }, documentId=str(i), routing=str(i))
+            writer.flush()
+        finally:
+            writer.close()
+
+        self.assertEqual(len(client.requests), 5)
+        self.assertEqual(writer.succeeded, 10)
+
+    def test_retry_failed_items_only(self):
+        client = _FakeESClient(failures={ '2': [429] })
+        writer = BulkWriter(client, chunkSize=10, maxChunkBytes=1024 * 1024, concurrency=1, maxRetries=2)
+        for i in range(4):
+            writer.index('index', 'doc', { 'id': i }, documentId=str(i))
+        writer.flush()
+
+        self.assertEqual(len(client.requests), 2)
+        retried = client.requests[1]
+        self.assertEqual(len(retried), 2)
+        self.assertEqual(retried[0]['index']['_id'], '2')
+        self.assertEqual(writer.succeeded, 4)
+
+    def test_retry_keeps_document_order(self):
+        client = _FakeESClient(failures={ '1': [429] })
+        writer = BulkWriter(client, chunkSize=10, maxChunkBytes=1024 * 1024, concurrency=1, maxRetries=2)
+        writer.index('index', 'doc', { 'v': 1 }, documentId='1')
+        writer.index('index', 'doc', { 'v': 2 }, documentId='2')
+        writer.update('index', 'doc', '1', { 'doc': { 'v': 3 } })
+        writer.flush()
+
+        retried = client.requests[1]
+        self.assertEqual([ line.keys()[0] for line in retried[::2] ], ['index', 'update'])
+
+    def test_permanent_failure(self):
+        client = _FakeESClient(failures={ '1': [400] })
+        writer = BulkWriter(client, chunkSize=10, maxChunkBytes=1024 * 1024, concurrency=1, maxRetries=2)
+        writer.index('index', 'doc', { 'v': 1 }, documentId='1')
+        writer.index('index', 'doc', { 'v': 2 }, documentId='2')
+
+        self.assertRaises(LogicException, writer.flush)
+        self.assertEqual(len(client.requests), 1)
+        self.assertEqual(writer.failed, 1)
+
+    def test_ignore_missing(self):
+        client = _FakeESClient(failures={ '1': [404], '2': [404] })
+        writer = BulkWriter(client, chunkSize=10, maxChunkBytes=1024 * 1024, concurrency=1, maxRetries=2)
+        writer.update('index', 'doc', '1', { 'doc': { 'v': 1 } }, ignoreMissing=True)
+        writer.update('index', 'doc', '2', { 'doc': { 'v': 2 } })
+
+        self.assertRaises(LogicException, writer.flush)
+        self.assertEqual(writer.succeeded, 1)
+        self.assertEqual(writer.failed, 1)
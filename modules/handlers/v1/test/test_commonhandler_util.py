@@ -5,6 +5,8 @@ from __future__ import print_function, division
 import unittest
 from dateutil.parser import parse
 
+import modules.handlers.compiler as compiler
+
 from ..commonhandler import *
 from ..commonhandler import _EXP_RE, _SQL_STATEMENT_LIMIT_RE
 from ...handlerconfig import *
@@ -90,7 +92,7 @@ class CommonHandlerUtilTests(unittest.TestCase):
                 'status': 1,
                 'choise': 2
                 }
-        result = self.handler._filterData(filterDict, value)
+        result = compiler.compileFilter(filterDict)(value)
         self.assertTrue(result)
 
         value = {
@@ -100,5 +102,5 @@ class CommonHandlerUtilTests(unittest.TestCase):
                 'status': 0,
                 'choise': 2
                 }
-        result = self.handler._filterData(filterDict, value)
+        result = compiler.compileFilter(filterDict)(value)
         self.assertFalse(result)
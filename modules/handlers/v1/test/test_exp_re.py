@@ -6,7 +6,8 @@ import ast
 import unittest
 from dateutil.parser import parse
 
-from ..commonhandler import _EXP_RE, _SQL_STATEMENT_LIMIT_RE, _PARENT_EXP_RE, _ORIGIN_VALUE_RE
+from ..commonhandler import _EXP_RE, _PARENT_EXP_RE, _ORIGIN_VALUE_RE, _LAST_EXP_RE, _SQL_ORDER_BY_RE
+from ...handlerconfig import _SQL_STATEMENT_LIMIT_RE
 
 class HandlerRegTests(unittest.TestCase):
     def test_exp_re(self):
@@ -87,3 +88,21 @@ class HandlerRegTests(unittest.TestCase):
         self.assertEqual(matches.group(2), 'id')
         self.assertEqual(matches.group(3), "'abc'")
 
+    def test_last_reg(self):
+        s = 'select * from users where id > %__last.id:(0) and role_id = 1'
+        matches = _LAST_EXP_RE.search(s)
+        self.assertEqual(matches.group(1), 'id')
+        self.assertEqual(matches.group(2), 'id')
+        self.assertEqual(matches.group(0), 'id > %__last.id:(0)')
+
+        s = 'select * from users u where u.uid>%__last.uid and u.role_id = 1'
+        matches = _LAST_EXP_RE.search(s)
+        self.assertEqual(matches.group(1), 'u.uid')
+        self.assertEqual(matches.group(2), 'uid')
+
+        s = 'select * from vehicle_type where id = %__master.vehicle_type_id'
+        self.assertIsNone(_LAST_EXP_RE.search(s))
+
+    def test_order_by_reg(self):
+        self.assertIsNotNone(_SQL_ORDER_BY_RE.search('select * from users where id > 0 Order  By id'))
+        self.assertIsNone(_SQL_ORDER_BY_RE.search('select * from orders where border_id > 0'))
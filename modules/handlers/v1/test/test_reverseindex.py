@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, division
+
+import unittest
+import simplejson as json
+
+from modules.handlers.handlerconfig import HandlerConfig
+from services import binlogcodec
+from ..commonhandler import _ElasticSearchUtilsMixin, UpdateEventProcessor
+from ..reverseindex import ReverseIndex
+
+class _FakePipeline(object):
+    def __init__(self, redis):
+        self._redis = redis
+        self._commands = []
+
+    def hset(self, *args):
+        self._commands.append(('hset', args))
+
+    def hdel(self, *args):
+        self._commands.append(('hdel', args))
+
+    def execute(self):
+        for name, args in self._commands:
+            getattr(self._redis, name)(*args)
+        self._commands = []
+
+class _FakeRedis(object):
+    def __init__(self):
+        self.data = {}
+
+    def pipeline(self, transaction=True):
+        return _FakePipeline(self)
+
+    def hset(self, key, field, value):
+        self.data.setdefault(key, {})[field] = value
+
+    def hdel(self, key, field):
+        self.data.get(key, {}).pop(field, None)
+
+    def hgetall(self, key):
+        return dict(self.data.get(key, {}))
+
+    def set(self, key, value):
+        self.data[key] = value
+
+    def exists(self, key):
+        return key in self.data
+
+class ReverseIndexTests(unittest.TestCase):
+    def setUp(self):
+        handlerConfig = HandlerConfig()
+        handlerConfig.loadFromFile('./conf/handlers/index_vehicle.yml')
+        configList = handlerConfig.getConfigListByIndexAndType('index_vehicle', 'vehicle')
+
+        self.masterItem = configList.getMasterItem()
+        self.typeItem = configList.getConfigItemByKey('vehicle_type')
+        self.redis = _FakeRedis()
+        self.reverseIndex = ReverseIndex('suffix', redisClient=self.redis)
+
+    def test_cold(self):
+        self.reverseIndex.add(self.masterItem, { 'vehicle_type_id': 3 }, 'vehicle_1', None)
+        self.assertIsNone(self.reverseIndex.lookup(self.typeItem, { 'vehicle_type_id': 3 }))
+
+    def test_lookup(self):
+        self.reverseIndex.add(self.masterItem, { 'vehicle_type_id': 3, 'vehicle_id': 1 }, 'vehicle_1', None)
+        self.reverseIndex.add(self.masterItem, { 'vehicle_type_id': 3, 'vehicle_id': 2 }, 'vehicle_2', 'r2')
+        self.reverseIndex.add(self.masterItem, { 'vehicle_type_id': 4, 'vehicle_id': 3 }, 'vehicle_3', None)
+        self.reverseIndex.markReady('index_vehicle', 'vehicle')
+
+        self.assertEqual(self.reverseIndex.lookup(self.typeItem, { 'vehicle_type_id': 3 }), { 'vehicle_1': None, 'vehicle_2': 'r2' })
+
+        self.reverseIndex.update(self.masterItem, { 'vehicle_type_id': 3, 'vehicle_id': 1 }, { 'vehicle_type_id': 4, 'vehicle_id': 1 }, 'vehicle_1', None)
+        self.reverseIndex.remove(self.masterItem, { 'vehicle_type_id': 3, 'vehicle_id': 2 }, 'vehicle_2')
+
+        self.assertEqual(self.reverseIndex.lookup(self.typeItem, { 'vehicle_type_id': 3 }), {})
+        self.assertEqual(self.reverseIndex.lookup(self.typeItem, { 'vehicle_type_id': 4 }), { 'vehicle_1': None, 'vehicle_3': None })
+
+class DeltaReverseIndexTests(unittest.TestCase):
+    """
+    delta编码的UPDATE与多个字段的query
+    """
+    def setUp(self):
+        handlerConfig = HandlerConfig()
+        handlerConfig.loadFromJson(json.dumps({
+            'index_order': {
+                'order': [
+                    {
+                        'key': 'orders',
+                        'database': 'shop',
+                        'table': 'orders',
+                        'statement': 'select * from orders where id > %__last.id:(0)',
+                        'document_id': '%id',
+                        'mapping': [ { 'db_field': 'id', 'es_field': 'order_id' }, 'shop_id', 'region_id', 'amount' ]
+                    },
+                    {
+                        'key': 'shop',
+                        'database': 'shop',
+                        'table': 'shop',
+                        'statement': 'select * from shop where id = %__master.shop_id',
+                        'query': { 'shop_id': '%id', 'region_id': '%region_id' },
+                        'mapping': [ { 'db_field': 'name', 'es_field': 'shop_name' } ]
+                    }
+                ]
+            }
+        }))
+        self.handlerConfig = handlerConfig
+        configList = handlerConfig.getConfigListByIndexAndType('index_order', 'order')
+        self.masterItem = configList.getMasterItem()
+        self.shopItem = configList.getConfigItemByKey('shop')
+
+        self.reverseIndex = ReverseIndex('suffix', redisClient=_FakeRedis())
+        self.processor = UpdateEventProcessor.__new__(UpdateEventProcessor)
+        self.processor._mappingFields = {}
+        self.processor._statusConfig = None
+
+    def test_delta_update(self):
+        # query中没有在statement中引用的字段，也总是包含在delta编码的消息中
+        requiredFields = self.handlerConfig.getProjectedFields('shop', 'orders', withPlainMapping=False)
+        self.assertIn('region_id', requiredFields)
+        self.assertNotIn('amount', requiredFields)
+
+        before = { 'id': 1, 'shop_id': 3, 'region_id': 5, 'amount': 10 }
+        after = { 'id': 1, 'shop_id': 4, 'region_id': 5, 'amount': 10 }
+        document = _ElasticSearchUtilsMixin()._getMasterFieldValues(self.masterItem, before)
+        self.reverseIndex.add(self.masterItem, document, 'order_1', None)
+        self.reverseIndex.markReady('index_order', 'order')
+
+        changed = binlogcodec.getChangedFields(before, after)
+        values, beforeDelta = binlogcodec.encodeUpdate(before, after, changed, requiredFields, ['id'])
+        binlog = binlogcodec.decode(json.dumps({ 'type': 'UPDATE', 'delta': 1, 'values': values, 'before': beforeDelta }))
+        self.assertNotIn('amount', binlog['values'])
+
+        unchangedFields = self.processor._getUnchangedEsFields(self.masterItem, binlog['values'])
+        self.assertSetEqual(unchangedFields, {'amount'})
+        self.reverseIndex.update(
+                self.masterItem,
+                self.processor._getMasterFieldValues(self.masterItem, binlog['before'], unchangedFields),
+                self.processor._getMasterFieldValues(self.masterItem, binlog['values'], unchangedFields),
+                'order_1',
+                None
+                )
+
+        self.assertEqual(self.reverseIndex.lookup(self.shopItem, { 'shop_id': 3, 'region_id': 5 }), {})
+        self.assertEqual(self.reverseIndex.lookup(self.shopItem, { 'shop_id': 4, 'region_id': 5 }), { 'order_1': None })
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, division
+
+import unittest
+
+from ..scriptregistry import ScriptRegistry
+
+class _FakeCluster(object):
+    def __init__(self, scripts):
+        self._scripts = scripts
+
+    def state(self, metric=None, filter_path=None):
+        return { 'metadata': { 'stored_scripts': self._scripts } }
+
+class _FakeElasticsearch(object):
+    def __init__(self, scripts=None):
+        self.scripts = scripts if scripts else {}
+        self.cluster = _FakeCluster(self.scripts)
+        self.putCount = 0
+
+    def put_script(self, id, body):
+        self.putCount += 1
+        self.scripts[id] = body['script']
+
+    def delete_script(self, id, ignore=None):
+        del self.scripts[id]
+
+class ScriptRegistryTests(unittest.TestCase):
+    def test_registerAll(self):
+        es = _FakeElasticsearch()
+        registry = ScriptRegistry(es)
+
+        source = 'ctx._source.name = params.name;'
+        registry.registerAll([source, 'ctx._source.age = params.age;'])
+        self.assertEqual(es.putCount, 2)
+
+        script = registry.getScript(source, { 'name': 'a' })
+        self.assertEqual(script, { 'id': ScriptRegistry.getScriptId(source), 'params': { 'name': 'a' } })
+        self.assertNotIn('inline', script)
+
+        # 重新加载配置时，已经注册的脚本不再注册
+        ScriptRegistry(es).registerAll([source])
+        self.assertEqual(es.putCount, 2)
+
+    def test_getScript_unregistered(self):
+        es = _FakeElasticsearch()
+        registry = ScriptRegistry(es)
+
+        source = 'ctx._source.name = params.name;'
+        script = registry.getScript(source, { 'name': 'a' })
+        self.assertEqual(script, { 'lang': 'painless', 'inline': source, 'params': { 'name': 'a' } })
+        self.assertEqual(es.putCount, 0)
+
+    def test_delete_unused(self):
+        source = 'ctx._source.name = params.name;'
+        unused = 'ctx._source.age = params.age;'
+        es = _FakeElasticsearch({
+            ScriptRegistry.getScriptId(source): { 'lang': 'painless', 'source': source },
+            ScriptRegistry.getScriptId(unused): { 'lang': 'painless', 'source': unused },
+            'other_script': { 'lang': 'painless', 'source': unused }
+            })
+
+        ScriptRegistry(es).registerAll([source])
+        self.assertEqual(es.putCount, 0)
+        # 只删除mee_开头的脚本
+        self.assertSetEqual(set(es.scripts), { ScriptRegistry.getScriptId(source), 'other_script' })
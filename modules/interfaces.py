@@ -101,9 +101,15 @@ class IHandler(Interface):
     """
     处理同步事宜的处理器接口
     """
-    def syncFromMySQL():
+    def syncFromMySQL(workers=1):
         """
-        从mysql中获取数据进行全量更新
+        从mysql中获取数据进行全量更新。
+        workers大于1时，使用多个进程并行更新
+        """
+
+    def registerScripts():
+        """
+        增量更新之前(加载配置时)调用，注册增量更新使用的stored script
         """
 
     def syncFromBinlog(binlogEvent):
@@ -111,6 +117,17 @@ class IHandler(Interface):
         增量更新：将binlog event中的数据同步到ES中
         """
 
+    def syncFromBinlogBatch(binlogEvents):
+        """
+        增量更新：将一批binlog event中的数据同步到ES中，
+        文档级别的写操作通过bulk请求批量写入
+        """
+
+    def isWatched(database, table):
+        """
+        同步配置中是否有配置节引用了database.table
+        """
+
 
 
 
@@ -27,7 +27,15 @@ def getRedisClient():
 
 def getKafkaProducer():
     host = config().get('kafka', 'host')
-    return utils.kafkaclient.KafkaProducer(host)
+    settings = {
+            'queue.buffering.max.ms': int(config().get('kafka', 'producer_linger_ms', '50')),
+            'batch.num.messages': int(config().get('kafka', 'producer_batch_num_messages', '1000')),
+            'queue.buffering.max.messages': int(config().get('kafka', 'producer_queue_max_messages', '100000')),
+            'message.send.max.retries': int(config().get('kafka', 'producer_send_max_retries', '10')),
+            # 重试时保证同一个partition中消息的顺序
+            'max.in.flight.requests.per.connection': 1,
+            }
+    return utils.kafkaclient.KafkaProducer(host, settings)
 
 def getKafkaConsumer(groupId, autoCommit=True, autoOffsetReset='earliest'):
     host = config().get('kafka', 'host')
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+
+"""
+ListenService的binlog position检查点。
+position先缓存在内存中，达到保存间隔或事件数后，写入临时文件再rename，
+保证run目录中的文件始终是完整的某一次检查点；可选地同时写入redis，
+其它机器上的ListenService接管时可以从redis中恢复。
+"""
+
+from __future__ import print_function, division
+
+import os
+import re
+import time
+import simplejson as json
+
+import application.app as app
+
+from application import IllegalConfigException
+
+_logger = app.getLogger('base')
+
+# 旧版本的格式 file:pos
+_LEGACY_POS_RE = re.compile(r'^([^:\s]+):(\d+)')
+
+_FSYNC_POLICIES = ('always', 'never')
+
+class BinlogCheckpoint(object):
+    def __init__(self, path, interval=1.0, eventCount=1000, fsync='always', redisClient=None, redisKey=None, beforeFlush=None):
+        """
+        path: 检查点文件
+        interval: 两次保存之间的最长秒数
+        eventCount: 两次保存之间的最大事件数
+        fsync: always 每次保存都fsync文件和目录；never 由操作系统决定何时写入磁盘
+        redisClient, redisKey: 同时写入redis，None表示不写入
+        beforeFlush: 写入检查点之前调用，例如先把binlog spool写入磁盘
+        """
+        if fsync not in _FSYNC_POLICIES:
+            raise IllegalConfigException('checkpoint fsync policy must be one of %s, but %s' % (_FSYNC_POLICIES, fsync))
+
+        self._path = path
+        self._interval = interval
+        self._eventCount = eventCount
+        self._fsync = fsync
+        self._redisClient = redisClient
+        self._redisKey = redisKey
+        self._beforeFlush = beforeFlush
+
+        self._pending = None
+        self._pendingCount = 0
+        self._lastSaveTime = time.time()
+
+    def load(self):
+        """
+        返回最后保存的检查点 { 'log_file': ..., 'log_pos': ..., 'gtid': ... }，没有时返回None
+        """
+        checkpoint = self._loadFromFile()
+        if checkpoint is None and self._redisClient is not None:
+            data = self._redisClient.get(self._redisKey)
+            checkpoint = self._parse(data) if data else None
+            if checkpoint is not None:
+                _logger.info('load binlog checkpoint from redis[%s]: %s', self._redisKey, checkpoint)
+
+        return checkpoint
+
+    def save(self, logFile, logPos, gtid=None):
+        """
+        记录新的position，达到保存间隔或事件数时写入
+        """
+        self._pending = { 'log_file': logFile, 'log_pos': logPos, 'gtid': gtid }
+        self._pendingCount += 1
+
+        if self._pendingCount >= self._eventCount or time.time() - self._lastSaveTime >= self._interval:
+            self.flush()
+
+    def flush(self):
+        if self._pending is None:
+            return
+
+        if self._beforeFlush is not None:
+            self._beforeFlush()
+
+        data = json.dumps(self._pending)
+        tmpPath = self._path + '.tmp'
+        with open(tmpPath, 'w') as f:
+            f.write(data)
+            if self._fsync == 'always':
+                f.flush()
+                os.fsync(f.fileno())
+        os.rename(tmpPath, self._path)
+        if self._fsync == 'always':
+            self._fsyncDir()
+
+        if self._redisClient is not None:
+            self._redisClient.set(self._redisKey, data)
+
+        _logger.info('save binlog checkpoint: %s', data)
+
+        self._pending = None
+        self._pendingCount = 0
+        self._lastSaveTime = time.time()
+
+    def _loadFromFile(self):
+        try:
+            with open(self._path) as f:
+                data = f.read()
+        except IOError:
+            return None
+
+        return self._parse(data)
+
+    def _parse(self, data):
+        data = data.strip()
+        if not data:
+            return None
+
+        try:
+            checkpoint = json.loads(data)
+            if isinstance(checkpoint, dict):
+                return checkpoint
+        except ValueError:
+            pass
+
+        match = _LEGACY_POS_RE.match(data)
+        if match:
+            return { 'log_file': match.group(1), 'log_pos': int(match.group(2)), 'gtid': None }
+
+        _logger.warning('illegal binlog checkpoint: %s', data)
+        return None
+
+    def _fsyncDir(self):
+        dirPath = os.path.dirname(os.path.abspath(self._path))
+        fd = os.open(dirPath, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
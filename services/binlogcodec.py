@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+
+"""
+kafka中binlog消息的编码和解码。
+
+消息格式：
+    json     (v1) 完整的binlog json文档
+    msgpack  (v2) database、table、type放在kafka消息的header中，
+                  消息体是msgpack编码的timestamp、primary_key、values、before等，
+                  datetime、date、decimal使用msgpack的扩展类型
+两种格式的消息都带有header，SyncService不需要解码消息体，就可以丢弃无关的消息；
+没有header的旧消息按照json解码。解码后的binlog与v1的json消息完全相同。
+
+delta编码的UPDATE（'delta': 1）：
+    values 主键、发生变化的字段以及同步时总是需要的字段更新后的值
+    before 只包含发生变化的字段更新前的值
+解码时，before中没有的字段使用values中的值补齐，
+得到的before和values包含相同的字段，未包含的字段（没有变化）不会被同步。
+"""
+
+from __future__ import print_function, division
+
+import struct
+import msgpack
+import simplejson as json
+
+import utils.timeutil as timeutil
+
+from datetime import datetime, date
+from decimal import Decimal
+
+from application import IllegalArgumentException
+
+FORMAT_JSON = 'json'
+FORMAT_MSGPACK = 'msgpack'
+
+_FORMAT_VERSIONS = {
+        FORMAT_JSON: '1',
+        FORMAT_MSGPACK: '2',
+        }
+
+HEADER_VERSION = 'mee.v'
+HEADER_DATABASE = 'mee.db'
+HEADER_TABLE = 'mee.table'
+HEADER_TYPE = 'mee.type'
+
+_TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# msgpack的扩展类型
+_EXT_DATETIME = 1
+_EXT_DATE = 2
+_EXT_DECIMAL = 3
+
+_DATETIME_STRUCT = struct.Struct('>HBBBBBI')
+_DATE_STRUCT = struct.Struct('>HBB')
+
+def encode(binlog, messageFormat=FORMAT_JSON):
+    """
+    返回(消息体, headers)。binlog['timestamp']是binlog事件的unix时间戳
+    """
+    if messageFormat not in _FORMAT_VERSIONS:
+        raise IllegalArgumentException('message format must be one of %s, but %s' % (_FORMAT_VERSIONS.keys(), messageFormat))
+
+    headers = [
+            (HEADER_VERSION, _FORMAT_VERSIONS[messageFormat]),
+            (HEADER_DATABASE, binlog['database'].encode('utf-8')),
+            (HEADER_TABLE, binlog['table'].encode('utf-8')),
+            (HEADER_TYPE, binlog['type']),
+            ]
+
+    if messageFormat == FORMAT_JSON:
+        data = dict(binlog)
+        data['timestamp'] = datetime.fromtimestamp(binlog['timestamp']).strftime(_TIMESTAMP_FORMAT)
+        return json.dumps(data, default=timeutil.dateHandler).encode('utf-8'), headers
+
+    body = {}
+    for key, value in binlog.items():
+        if key not in ('storage', 'database', 'table', 'type'):
+            body[key] = value
+
+    # 字符串与json格式一样按照utf-8编码，解码后为unicode
+    return msgpack.packb(body, use_bin_type=False, default=_encodeExt), headers
+
+def getRouting(headers):
+    """
+    从headers中获取(database, table, type)，没有header的旧消息返回None
+    """
+    if not headers:
+        return None
+
+    headers = dict(headers)
+    if HEADER_VERSION not in headers:
+        return None
+
+    return (
+            headers[HEADER_DATABASE].decode('utf-8'),
+            headers[HEADER_TABLE].decode('utf-8'),
+            headers[HEADER_TYPE].decode('utf-8')
+            )
+
+def decode(data, headers=None):
+    headerDict = dict(headers) if headers else {}
+    if headerDict.get(HEADER_VERSION, None) == _FORMAT_VERSIONS[FORMAT_MSGPACK]:
+        binlog = msgpack.unpackb(data, raw=False, ext_hook=_decodeExt)
+        binlog['storage'] = 'mysql'
+        binlog['database'] = headerDict[HEADER_DATABASE].decode('utf-8')
+        binlog['table'] = headerDict[HEADER_TABLE].decode('utf-8')
+        binlog['type'] = headerDict[HEADER_TYPE].decode('utf-8')
+        binlog['timestamp'] = datetime.fromtimestamp(binlog['timestamp']).strftime(_TIMESTAMP_FORMAT)
+    else:
+        binlog = json.loads(data)
+
+    if binlog.pop('delta', None):
+        before = dict(binlog['values'])
+        before.update(binlog['before'])
+        binlog['before'] = before
+
+    return binlog
+
+def getChangedFields(beforeValues, afterValues):
+    return set(field for field, value in afterValues.items() if beforeValues.get(field, None) != value)
+
+def encodeUpdate(beforeValues, afterValues, changedFields, requiredFields, primaryKey):
+    """
+    返回delta编码的(values, before)
+    """
+    values = {}
+    for field, value in afterValues.items():
+        if field in changedFields or field in requiredFields or field in primaryKey:
+            values[field] = value
+
+    before = { field: beforeValues.get(field, None) for field in changedFields }
+    return values, before
+
+def _encodeExt(obj):
+    if isinstance(obj, datetime):
+        data = _DATETIME_STRUCT.pack(obj.year, obj.month, obj.day, obj.hour, obj.minute, obj.second, obj.microsecond)
+        return msgpack.ExtType(_EXT_DATETIME, data)
+    elif isinstance(obj, date):
+        return msgpack.ExtType(_EXT_DATE, _DATE_STRUCT.pack(obj.year, obj.month, obj.day))
+    elif isinstance(obj, Decimal):
+        return msgpack.ExtType(_EXT_DECIMAL, str(obj))
+
+    raise TypeError('%r is not msgpack serializable' % obj)
+
+def _decodeExt(code, data):
+    """
+    与json格式解码后的值保持一致：datetime和date解码为字符串，decimal解码为float
+    """
+    if code == _EXT_DATETIME:
+        return timeutil.dateHandler(datetime(*_DATETIME_STRUCT.unpack(data)))
+    elif code == _EXT_DATE:
+        return timeutil.dateHandler(date(*_DATE_STRUCT.unpack(data)))
+    elif code == _EXT_DECIMAL:
+        return float(data)
+
+    return msgpack.ExtType(code, data)
@@ -0,0 +1,396 @@
+# -*- coding: utf-8 -*-
+
+"""
+ListenService的本地binlog spool。
+编码后的kafka消息先追加写入run目录中的spool，binlog的position即可保存；
+SpoolSender在单独的线程中按顺序把spool中的消息发送到kafka，
+kafka不可用时，ListenService继续读取binlog，不会因为kafka的故障退出、导致binlog被MySQL清理。
+
+spool由多个segment文件组成，文件名是segment中第一条消息的偏移量(所有segment统一编址)。
+每条消息：4字节长度 + 4字节crc32 + msgpack编码的[key, headers, value]。
+cursor文件记录已经被kafka确认的偏移量，完全被确认的segment会被删除。
+未确认的消息超过maxBytes时，append阻塞，直到未确认的消息降到resumeBytes以下(backpressure)。
+"""
+
+from __future__ import print_function, division
+
+import os
+import glob
+import time
+import zlib
+import struct
+import bisect
+import threading
+import msgpack
+import simplejson as json
+
+import application.app as app
+
+from application import IllegalConfigException, LogicException
+
+from .deliverytracker import DeliveryTracker
+
+_logger = app.getLogger('base')
+
+_RECORD_HEADER = struct.Struct('>II')
+
+_SEGMENT_SUFFIX = '.seg'
+_CURSOR_FILE = 'cursor'
+
+_FSYNC_POLICIES = ('always', 'never')
+
+class BinlogSpool(object):
+    def __init__(self, directory, segmentBytes=67108864, maxBytes=1073741824, resumeBytes=None, fsync='always', cursorInterval=1.0):
+        """
+        directory: spool目录
+        segmentBytes: 每个segment文件的大小，超过后写入新的segment
+        maxBytes: 未确认消息的最大字节数，超过后append阻塞
+        resumeBytes: 阻塞的append在未确认消息降到该字节数以下后继续，默认为maxBytes的80%
+        fsync: always sync时fsync segment和cursor文件；never 由操作系统决定何时写入磁盘
+        cursorInterval: 两次保存cursor之间的最长秒数
+        """
+        if fsync not in _FSYNC_POLICIES:
+            raise IllegalConfigException('spool fsync policy must be one of %s, but %s' % (_FSYNC_POLICIES, fsync))
+
+        self._directory = directory
+        self._segmentBytes = segmentBytes
+        self._maxBytes = maxBytes
+        self._resumeBytes = resumeBytes if resumeBytes is not None else int(maxBytes * 0.8)
+        self._fsync = fsync
+        self._cursorInterval = cursorInterval
+
+        self._cond = threading.Condition()
+
+        # 所有segment的起始偏移量
+        self._segments = []
+        self._writeFile = None
+        self._writeOffset = 0
+        self._committedOffset = 0
+        self._savedOffset = 0
+        self._cursorTime = time.time()
+
+        self._readFile = None
+        self._readSegment = None
+        self._readOffset = 0
+
+        self._appended = 0
+        self._blockedCount = 0
+        self._blockedSeconds = 0.0
+
+        self._open()
+
+    def append(self, key, headers, value):
+        payload = msgpack.packb([key, headers, value], use_bin_type=True)
+        record = _RECORD_HEADER.pack(len(payload), zlib.crc32(payload) & 0xffffffff) + payload
+
+        self._waitForSpace()
+
+        with self._cond:
+            if self._writeOffset - self._segments[-1] >= self._segmentBytes:
+                self._roll()
+
+            self._writeFile.write(record)
+            self._writeFile.flush()
+            self._writeOffset += len(record)
+            self._appended += 1
+
+    def read(self, maxCount):
+        """
+        从当前读取位置读取最多maxCount条消息，返回[(消息之后的偏移量, key, headers, value)]，不阻塞
+        """
+        with self._cond:
+            end = self._writeOffset
+            segments = list(self._segments)
+
+        records = []
+        while self._readOffset < end and len(records) < maxCount:
+            segment = segments[bisect.bisect_right(segments, self._readOffset) - 1]
+            if segment != self._readSegment:
+                self._openReader(segment)
+
+            length, crc = _RECORD_HEADER.unpack(self._readFile.read(_RECORD_HEADER.size))
+            payload = self._readFile.read(length)
+            if len(payload) != length or zlib.crc32(payload) & 0xffffffff != crc:
+                raise LogicException('corrupted spool record at offset %d of %s' % (self._readOffset, self._directory))
+
+            key, headers, value = msgpack.unpackb(payload, raw=False)
+            self._readOffset += _RECORD_HEADER.size + length
+            records.append((self._readOffset, key, [tuple(header) for header in headers], value))
+
+        return records
+
+    def commit(self, offset):
+        """
+        offset之前的消息已经被kafka确认
+        """
+        with self._cond:
+            if offset <= self._committedOffset:
+                return
+
+            self._committedOffset = offset
+            self._cond.notify_all()
+
+            # 删除已经完全被确认的segment，当前写入的segment除外
+            while len(self._segments) > 1 and self._segments[1] <= offset:
+                os.remove(self._getSegmentPath(self._segments.pop(0)))
+
+            if time.time() - self._cursorTime >= self._cursorInterval:
+                self._saveCursor()
+
+    def rewind(self):
+        """
+        从最后确认的位置重新读取
+        """
+        with self._cond:
+            self._readOffset = self._committedOffset
+
+        self._closeReader()
+
+    def sync(self):
+        """
+        把已经append的消息和cursor写入磁盘
+        """
+        with self._cond:
+            if self._fsync == 'always':
+                os.fsync(self._writeFile.fileno())
+            self._saveCursor()
+
+    def stats(self):
+        with self._cond:
+            return {
+                    'segments': len(self._segments),
+                    'backlog_bytes': self._writeOffset - self._committedOffset,
+                    'appended': self._appended,
+                    'blocked_count': self._blockedCount,
+                    'blocked_seconds': round(self._blockedSeconds, 3),
+                    }
+
+    def close(self):
+        self.sync()
+        with self._cond:
+            self._writeFile.close()
+        self._closeReader()
+
+    def _waitForSpace(self):
+        with self._cond:
+            if self._writeOffset - self._committedOffset < self._maxBytes:
+                return
+
+            _logger.warning("spool[%s] is full(%d bytes), wait for kafka", self._directory, self._writeOffset - self._committedOffset)
+            self._blockedCount += 1
+            start = time.time()
+            while self._writeOffset - self._committedOffset > self._resumeBytes:
+                self._cond.wait(1.0)
+            self._blockedSeconds += time.time() - start
+
+    def _open(self):
+        if not os.path.isdir(self._directory):
+            os.makedirs(self._directory)
+
+        self._segments = sorted(int(os.path.basename(path)[:-len(_SEGMENT_SUFFIX)])
+                for path in glob.glob(os.path.join(self._directory, '*' + _SEGMENT_SUFFIX)))
+        cursor = self._loadCursor()
+
+        if not self._segments:
+            self._segments = [cursor]
+            self._writeOffset = cursor
+        else:
+            self._writeOffset = self._segments[-1] + self._recover(self._segments[-1])
+
+        self._committedOffset = min(max(cursor, self._segments[0]), self._writeOffset)
+        self._savedOffset = self._committedOffset
+        self._readOffset = self._committedOffset
+        self._writeFile = open(self._getSegmentPath(self._segments[-1]), 'ab')
+
+        if self._writeOffset > self._committedOffset:
+            _logger.info("spool[%s] has %d bytes to send", self._directory, self._writeOffset - self._committedOffset)
+
+    def _recover(self, segment):
+        """
+        返回segment中完整消息的长度，并截掉进程崩溃时写了一半的消息
+        """
+        path = self._getSegmentPath(segment)
+        size = 0
+        with open(path, 'rb') as f:
+            while True:
+                header = f.read(_RECORD_HEADER.size)
+                if len(header) < _RECORD_HEADER.size:
+                    break
+
+                length, crc = _RECORD_HEADER.unpack(header)
+                payload = f.read(length)
+                if len(payload) != length or zlib.crc32(payload) & 0xffffffff != crc:
+                    break
+
+                size += _RECORD_HEADER.size + length
+
+        if size != os.path.getsize(path):
+            _logger.warning("truncate spool segment[%s] from %d to %d bytes", path, os.path.getsize(path), size)
+            with open(path, 'r+b') as f:
+                f.truncate(size)
+
+        return size
+
+    def _roll(self):
+        """
+        调用者持有self._cond
+        """
+        self._writeFile.flush()
+        if self._fsync == 'always':
+            os.fsync(self._writeFile.fileno())
+        self._writeFile.close()
+
+        self._segments.append(self._writeOffset)
+        self._writeFile = open(self._getSegmentPath(self._writeOffset), 'ab')
+
+    def _openReader(self, segment):
+        self._closeReader()
+        self._readFile = open(self._getSegmentPath(segment), 'rb')
+        self._readFile.seek(self._readOffset - segment)
+        self._readSegment = segment
+
+    def _closeReader(self):
+        if self._readFile is not None:
+            self._readFile.close()
+        self._readFile = None
+        self._readSegment = None
+
+    def _loadCursor(self):
+        try:
+            with open(os.path.join(self._directory, _CURSOR_FILE)) as f:
+                return int(json.loads(f.read())['offset'])
+        except (IOError, ValueError, KeyError, TypeError):
+            return 0
+
+    def _saveCursor(self):
+        """
+        调用者持有self._cond
+        """
+        self._cursorTime = time.time()
+        if self._committedOffset == self._savedOffset:
+            return
+
+        path = os.path.join(self._directory, _CURSOR_FILE)
+        with open(path + '.tmp', 'w') as f:
+            f.write(json.dumps({ 'offset': self._committedOffset }))
+            if self._fsync == 'always':
+                f.flush()
+                os.fsync(f.fileno())
+        os.rename(path + '.tmp', path)
+        self._savedOffset = self._committedOffset
+
+    def _getSegmentPath(self, segment):
+        return os.path.join(self._directory, '%020d%s' % (segment, _SEGMENT_SUFFIX))
+
+class SpoolSender(object):
+    """
+    按顺序把spool中的消息发送到kafka。
+    发送失败时不退出，等待已发送的消息都有结果后，从最后确认的位置重新发送
+    """
+    def __init__(self, spool, kafkaProducer, topic, maxInFlight=10000, batchSize=1000, retryBackoff=1.0, statsInterval=60):
+        self._spool = spool
+        self._kafkaProducer = kafkaProducer
+        self._topic = topic
+        self._maxInFlight = maxInFlight
+        self._batchSize = batchSize
+        self._retryBackoff = retryBackoff
+        self._statsInterval = statsInterval
+
+        self._deliveryTracker = DeliveryTracker()
+        self._stopped = threading.Event()
+
+        self.delivered = 0
+        self.retries = 0
+        # 无法恢复的错误(例如spool文件损坏)，发送线程退出
+        self.error = None
+
+    def run(self):
+        try:
+            self._run()
+        except Exception as e:
+            _logger.error("spool sender of topic[%s] exited: %s", self._topic, e)
+            self.error = e
+
+    def _run(self):
+        statsTime = time.time()
+        while not self._stopped.is_set():
+            if self._deliveryTracker.error is not None:
+                self._retry()
+                continue
+
+            records = []
+            if self._deliveryTracker.inFlight < self._maxInFlight:
+                records = self._spool.read(self._batchSize)
+
+            for offset, key, headers, value in records:
+                self._produce(offset, key, headers, value)
+
+            self._kafkaProducer.poll(0 if records else 0.1)
+            self._commit()
+
+            if time.time() - statsTime >= self._statsInterval:
+                statsTime = time.time()
+                _logger.info("spool stats: %s", self.stats())
+
+    def stop(self, timeout=10):
+        """
+        停止发送，等待已发送的消息被确认
+        """
+        self._stopped.set()
+
+        deadline = time.time() + timeout
+        while self._deliveryTracker.inFlight > self._deliveryTracker.failed and time.time() < deadline:
+            self._kafkaProducer.poll(0.1)
+        self._commit()
+
+    def stats(self):
+        stats = self._spool.stats()
+        stats.update({
+            'in_flight': self._deliveryTracker.inFlight,
+            'delivered': self.delivered,
+            'retries': self.retries,
+            })
+        return stats
+
+    def _produce(self, offset, key, headers, value):
+        entry = self._deliveryTracker.track(offset, 1)
+        callback = lambda err, msg: self._onDelivery(entry, err)
+
+        while not self._stopped.is_set():
+            try:
+                self._kafkaProducer.produce(self._topic, value, key, headers=headers, callback=callback)
+                return
+            except BufferError:
+                # producer本地的缓存已满
+                self._kafkaProducer.poll(0.1)
+            except Exception as e:
+                _logger.error("Fail to push to topic[%s]: %s", self._topic, e)
+                self._deliveryTracker.fail(e)
+                return
+
+        self._deliveryTracker.fail('sender stopped')
+
+    def _onDelivery(self, entry, err):
+        if err:
+            self._deliveryTracker.fail(err)
+        else:
+            self._deliveryTracker.ack(entry)
+            self.delivered += 1
+
+    def _commit(self):
+        offset = self._deliveryTracker.confirmed()
+        if offset is not None:
+            self._spool.commit(offset)
+
+    def _retry(self):
+        _logger.warning("Fail to deliver spooled binlog to topic[%s]: %s, retry in %ss", self._topic, self._deliveryTracker.error, self._retryBackoff)
+
+        # 等待已发送的消息都有结果，保存失败之前被确认的位置
+        while self._deliveryTracker.inFlight > self._deliveryTracker.failed:
+            self._kafkaProducer.poll(0.1)
+        self._commit()
+
+        time.sleep(self._retryBackoff)
+        self._deliveryTracker = DeliveryTracker()
+        self._spool.rewind()
+        self.retries += 1
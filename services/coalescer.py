@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+
+"""
+合并一批binlog中同一行记录(相同的database、table和主键)的多次变更，
+只保留最终的净变化：
+    INSERT ... DELETE        => 丢弃
+    INSERT ... UPDATE        => INSERT(最后的values)
+    UPDATE ... UPDATE        => UPDATE(第一个before, 最后的values)
+                                delta编码的UPDATE只包含部分字段，按照字段合并before和values
+    UPDATE/DELETE ... DELETE => DELETE(第一次变更前的values)
+                                delta编码的UPDATE的before只包含部分字段，没有变化的字段使用DELETE的values补齐
+    DELETE ... INSERT        => UPDATE(删除前的values, 最后的values)
+"""
+
+from __future__ import print_function, division
+
+import application.app as app
+
+_logger = app.getLogger('base')
+
+def coalesce(binlogEvents):
+    """
+    返回合并后的binlog列表。
+    合并后的变更放在该行记录最后一次变更的位置上；
+    没有主键信息的binlog，以及修改了主键的UPDATE，原样保留
+    """
+    slots = []
+    states = {}
+
+    for binlogEvent in binlogEvents:
+        eventType = binlogEvent['type']
+
+        primaryKey = binlogEvent.get('primary_key', None)
+        if not primaryKey:
+            slots.append([binlogEvent])
+            continue
+
+        rowKey = _getRowKey(binlogEvent, binlogEvent['values'], primaryKey)
+
+        if eventType == 'UPDATE':
+            beforeKey = _getRowKey(binlogEvent, binlogEvent['before'], primaryKey)
+            if beforeKey != rowKey:
+                # 主键发生了变化，不再与之前或之后的变更合并
+                states.pop(beforeKey, None)
+                states.pop(rowKey, None)
+                slots.append([binlogEvent])
+                continue
+
+        state = states.get(rowKey, None)
+        if state is None:
+            state = _RowState(binlogEvent)
+            states[rowKey] = state
+        else:
+            state.merge(binlogEvent)
+            # 移动到最后一次变更的位置
+            state.slot[0] = None
+
+        state.slot = [state]
+        slots.append(state.slot)
+
+    result = []
+    for slot in slots:
+        item = slot[0]
+        if item is None:
+            continue
+
+        if isinstance(item, _RowState):
+            item = item.toEvent()
+            if item is None:
+                continue
+
+        result.append(item)
+
+    if len(result) != len(binlogEvents):
+        _logger.debug('coalesce binlog events: %s => %s', len(binlogEvents), len(result))
+
+    return result
+
+def _getRowKey(binlogEvent, values, primaryKey):
+    return (binlogEvent['database'], binlogEvent['table']) + tuple(values.get(field, None) for field in primaryKey)
+
+class _RowState(object):
+    """
+    一行记录在一批binlog中的状态：变更前是否存在及其values，变更后是否存在及其values
+    """
+    def __init__(self, binlogEvent):
+        eventType = binlogEvent['type']
+
+        self.template = binlogEvent
+        self.slot = None
+
+        self.existedBefore = eventType != 'INSERT'
+        if eventType == 'UPDATE':
+            self.beforeValues = binlogEvent['before']
+        elif eventType == 'DELETE':
+            self.beforeValues = binlogEvent['values']
+        else:
+            self.beforeValues = None
+
+        self.existsAfter = False
+        self.afterValues = None
+
+        self.merge(binlogEvent)
+
+    def merge(self, binlogEvent):
+        self.template = binlogEvent
+
+        if binlogEvent['type'] == 'UPDATE' and self.existsAfter:
+            # 每个字段取最早的before和最后的values
+            self.afterValues = dict(self.afterValues)
+            self.afterValues.update(binlogEvent['values'])
+
+            if self.beforeValues is not None:
+                missing = [ field for field in binlogEvent['before'] if field not in self.beforeValues ]
+                if missing:
+                    self.beforeValues = dict(self.beforeValues)
+                    for field in missing:
+                        self.beforeValues[field] = binlogEvent['before'][field]
+            return
+
+        if binlogEvent['type'] == 'DELETE' and self.beforeValues is not None:
+            # 所有UPDATE的before中都没有的字段在这批binlog中没有变化，与DELETE时的值相同
+            missing = [ field for field in binlogEvent['values'] if field not in self.beforeValues ]
+            if missing:
+                self.beforeValues = dict(self.beforeValues)
+                for field in missing:
+                    self.beforeValues[field] = binlogEvent['values'][field]
+
+        self.existsAfter = binlogEvent['type'] != 'DELETE'
+        self.afterValues = binlogEvent['values'] if self.existsAfter else None
+
+    def toEvent(self):
+        if not self.existedBefore and not self.existsAfter:
+            return None
+
+        binlogEvent = dict(self.template)
+        binlogEvent.pop('before', None)
+
+        if not self.existedBefore:
+            binlogEvent['type'] = 'INSERT'
+            binlogEvent['values'] = self.afterValues
+        elif not self.existsAfter:
+            binlogEvent['type'] = 'DELETE'
+            binlogEvent['values'] = self.beforeValues
+        else:
+            if self.beforeValues == self.afterValues:
+                # 没有发生变化
+                return None
+
+            binlogEvent['type'] = 'UPDATE'
+            binlogEvent['before'] = self.beforeValues
+            binlogEvent['values'] = self.afterValues
+
+        return binlogEvent
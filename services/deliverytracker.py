@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+
+"""
+跟踪已经发送到kafka、尚未确认的binlog。
+binlog按照读取的顺序登记，只有一个binlog事件的所有行都被kafka确认后，
+该事件以及之前所有事件的position才可以被保存。
+多个ListenService共用一个kafka producer时，确认回调可能在其它线程的poll中执行，所以需要加锁。
+"""
+
+from __future__ import print_function, division
+
+import threading
+import collections
+
+class DeliveryTracker(object):
+    def __init__(self):
+        self._events = collections.deque()
+        self._inFlight = 0
+        self._lock = threading.Lock()
+        self.error = None
+        self.failed = 0
+
+    @property
+    def inFlight(self):
+        """
+        已发送、尚未确认的消息数
+        """
+        return self._inFlight
+
+    def track(self, position, rowCount):
+        """
+        登记一个binlog事件。position：事件之后的binlog position，rowCount：要发送的消息数。
+        返回的对象作为ack的参数
+        """
+        entry = [rowCount, position]
+        with self._lock:
+            self._events.append(entry)
+            self._inFlight += rowCount
+        return entry
+
+    def ack(self, entry):
+        with self._lock:
+            entry[0] -= 1
+            self._inFlight -= 1
+
+    def fail(self, error):
+        """
+        记录发送失败的消息，失败的消息不会被确认，之后事件的position也不会被返回
+        """
+        with self._lock:
+            self.failed += 1
+            if self.error is None:
+                self.error = error
+
+    def confirmed(self):
+        """
+        返回所有消息都已确认的最后一个binlog事件的position，没有新确认的事件时返回None
+        """
+        position = None
+        with self._lock:
+            while self._events and self._events[0][0] <= 0:
+                position = self._events.popleft()[1]
+
+        return position
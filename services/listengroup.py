@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+
+"""
+在一个进程中监听多个数据库的binlog。
+同一个MySQL实例（host和port相同）上的数据库共用一个binlog复制连接和一个检查点，
+MySQL只需要发送一份binlog；不同的MySQL实例在各自的线程中监听，所有的实例共用一个kafka producer。
+"""
+
+from __future__ import print_function, division
+
+import sys
+import threading
+import collections
+
+import application.app as app
+import modules.remote as remote
+
+from application import IllegalConfigException
+from application.config import config
+
+from .listenservice import ListenService
+
+_logger = app.getLogger('base')
+
+class ListenGroup(object):
+    def __init__(self, databases):
+        self._kafkaProducer = self._initKafkaProducer()
+        self.listeners = [ListenService(serverDatabases, self._kafkaProducer) for serverDatabases in self._groupByServer(databases)]
+
+    def position(self, force=False):
+        for listener in self.listeners:
+            listener.position(force=force)
+
+    def listen(self):
+        if len(self.listeners) == 1:
+            self.listeners[0].listen()
+            return
+
+        threads = []
+        for listener in self.listeners:
+            thread = threading.Thread(target=listener.listen, name='listen-' + listener.name)
+            # 复制连接是阻塞读取的，退出时不等待这些线程
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        # 任何一个实例的监听退出时，整个进程退出，重启后所有的实例从各自的检查点继续
+        while all(thread.is_alive() for thread in threads):
+            self._kafkaProducer.poll(1.0)
+
+        for thread in threads:
+            if not thread.is_alive():
+                _logger.error("listener thread[%s] exited, stop listening", thread.name)
+
+        self._drain()
+        sys.exit(1)
+
+    def _groupByServer(self, databases):
+        """
+        按照[mysql:<database>]中的host和port分组，保持数据库的顺序
+        """
+        servers = collections.OrderedDict()
+        sections = config().sections()
+        for database in databases:
+            section = 'mysql:' + database
+            if section not in sections:
+                raise IllegalConfigException('config section[%s] NOT found' % section)
+
+            server = (config().get(section, 'host'), config().get(section, 'port'))
+            servers.setdefault(server, []).append(database)
+
+        for server, serverDatabases in servers.items():
+            _logger.info("databases on %s:%s: %s", server[0], server[1], serverDatabases)
+
+        return list(servers.values())
+
+    def _initKafkaProducer(self):
+        try:
+            return remote.getKafkaProducer()
+        except Exception as e:
+            _logger.error("Fail to init a kafka producer")
+            sys.exit(1)
+
+    def _drain(self):
+        try:
+            self._kafkaProducer.flush(10)
+        except Exception as e:
+            _logger.error("Fail to flush kafka producer: %s", e)
+
+        for listener in self.listeners:
+            listener.flush()
@@ -5,7 +5,10 @@ from __future__ import print_function, division
 import sys
 import os
 import time
+import glob
 import datetime
+import threading
+import Queue
 import simplejson as json
 
 import application.app as app
@@ -14,6 +17,7 @@ import utils.timeutil as timeutil
 
 from datetime import datetime
 
+from concurrent.futures import ThreadPoolExecutor
 from pymysqlreplication import BinLogStreamReader
 from pymysqlreplication.row_event import (
         DeleteRowsEvent,
@@ -22,42 +26,110 @@ from pymysqlreplication.row_event import (
         )
 from pymysqlreplication.event import (
         QueryEvent,
+        GtidEvent,
+        XidEvent,
         )
+from pymysqlreplication.gtid import Gtid, GtidSet
 
-from application import NotSupportedException
+from application import NotSupportedException, IllegalConfigException
 from application.config import config
 from application.connection import ConnectinoPool
+from modules.handlers.handlerconfig import HandlerConfig
 from utils.failure import Failure
 
+from .deliverytracker import DeliveryTracker
+from .binlogcheckpoint import BinlogCheckpoint
+from .binlogspool import BinlogSpool, SpoolSender
+from . import binlogcodec
+
 _logger = app.getLogger('base')
 _binlogLogger = app.getLogger('binlog')
 
+_PARTITION_BY_TABLE = 'table'
+_PARTITION_BY_PRIMARY_KEY = 'primary_key'
+_PARTITION_BY_DOCUMENT = 'document'
+_PARTITION_BY = (_PARTITION_BY_TABLE, _PARTITION_BY_PRIMARY_KEY, _PARTITION_BY_DOCUMENT)
+# 存在扇出的表仍然按照表分配partition
+_NOT_PARTITIONED = object()
+
 class ListenService(object):
     """
-    监听指定数据库的binlog，并将数据写入kafka队列
+    监听指定数据库的binlog，并将数据写入kafka队列。
+    同一个MySQL实例上的多个数据库共用一个binlog复制连接和一个检查点
     """
-    def __init__(self, database):
+    def __init__(self, databases, kafkaProducer=None):
+        """
+        databases: 数据库名，或者同一个MySQL实例上的数据库列表
+        kafkaProducer: 多个ListenService共用的producer，None时创建新的producer
+        """
+        if isinstance(databases, basestring):
+            databases = [databases]
+
         self.topic = config().get('kafka', 'topic')
-        self.database = database
+        self.databases = list(databases)
+        # 只有一个数据库时使用数据库名，与之前的检查点文件兼容；否则使用MySQL实例的host和port
+        self.name = self.databases[0] if len(self.databases) == 1 else self._getServerName()
 
         self._connPool = ConnectinoPool()
         self._runPath = app.getPrjRoot() + "/run"
-        self._binlogPosFile = self._runPath + "/" + database + "_collector_position.safe"
-
-        self._kafkaProducer = self._initKafkaProducer()
-        self._kafkaMsgRedeliveryCount = 0
-
-        self._posStream = None
+        self._binlogPosFile = self._getBinlogPosFile(self.name)
+
+        self._kafkaProducer = kafkaProducer if kafkaProducer is not None else self._initKafkaProducer()
+        self._maxInFlight = int(config().get('kafka', 'producer_max_in_flight', '10000'))
+        self._messageFormat = config().get('kafka', 'message_format', binlogcodec.FORMAT_JSON)
+
+        # kafka消息的key(决定消息的partition)：table、primary_key或者document
+        self._partitionBy = config().get('kafka', 'partition_by', _PARTITION_BY_TABLE)
+        if self._partitionBy not in _PARTITION_BY:
+            raise IllegalConfigException('partition_by must be one of %s, but %s' % (_PARTITION_BY, self._partitionBy))
+        # 存在扇出(从表的变更通过update_by_query修改多个文档)的配置是否也按行/文档分配partition。
+        # 默认不分配，因为扇出的变更在不同partition之间没有顺序保证
+        self._partitionFanout = config().getBoolean('kafka', 'partition_fanout', False)
+        # 同步配置加载之前为None，所有表按照表分配partition
+        self._partitionFields = None
+        self._deliveryTracker = DeliveryTracker()
+
+        # 消息先写入本地spool，由SpoolSender异步发送到kafka
+        self._spool = self._initSpool()
+        self._spoolSender = None
+
+        # 是否使用GTID定位binlog
+        self._gtidMode = config().getBoolean('listen', 'gtid', False)
+        self._binlogCheckpoint = self._initBinlogCheckpoint()
+        # 共用producer时，其它线程退出前也会保存本实例的检查点
+        self._checkpointLock = threading.Lock()
+
+        # 只监听同步配置中引用到的表
+        self._tableFilter = config().getBoolean('listen', 'table_filter', True)
+        self._handlerConfigDir = os.path.join(app.getPrjRoot(), config().get('listen', 'handler_config_dir', 'conf/handlers'))
+        self._handlerConfigCheckInterval = int(config().get('listen', 'handler_config_check_interval', '10'))
+        self._handlerConfigVersion = None
+        self._handlerConfigCheckTime = 0
+        self._watchedTables = None
+        self._watchedTableSet = None
+
+        # 每个表需要发送的字段(除主键之外)，None表示所有字段
+        self._columnProjection = config().getBoolean('listen', 'column_projection', True)
+        self._projections = {}
+
+        # 是否对UPDATE使用delta编码。每个表：(总是需要发送的字段, 发生变化时需要发送完整数据的字段)
+        self._deltaUpdate = config().getBoolean('listen', 'delta_update', False)
+        self._deltas = {}
+
+        # 编码binlog的线程数，以及读取线程和发送之间的队列长度(事件数)
+        self._pipelineWorkers = int(config().get('listen', 'pipeline_workers', '2'))
+        self._pipelineQueueSize = int(config().get('listen', 'pipeline_queue_size', '1000'))
+        self._pipeline = None
+        self._serializer = None
+
+        self._mysqlSetting = None
         self._stream = None
 
     def position(self, force=False):
-        database = self.database
-        posFilePath = self._binlogPosFile
-
-        if not force and os.path.isfile(posFilePath):
+        if not force and self._loadLastBinlogPos()[0] is not None:
             return
 
-        conn = self._connPool.connection(database)
+        conn = self._connPool.connection(self.databases[0])
         with conn.cursor() as cursor:
             sqlMasterStatus = "show master status"
             cursor.execute(sqlMasterStatus)
@@ -75,7 +147,7 @@ class ListenService(object):
             raise NotSupportedException("The binlog format is NOT ROW but %s. We only support ROW now." % resultFormat['Value'])
 
         print("=" * 32)
-        print("Database: %s" % database)
+        print("Database: %s" % ", ".join(self.databases))
         print("File: %s, Position: %s, BinlogFormat: %s" % (resultMasterStatus['File'], resultMasterStatus['Position'], resultFormat['Value']))
 
         if resultSlaveStatus:
@@ -84,35 +156,85 @@ class ListenService(object):
             print("No slave status acquired")
         print("=" * 32)
 
+        gtid = None
+        if self._gtidMode:
+            gtid = (resultMasterStatus.get('Executed_Gtid_Set') or '').replace('\n', '')
+            print("Executed_Gtid_Set: %s" % gtid)
+
         # 将Position写入run目录中            
-        with open(posFilePath, 'w+') as f:
-            f.write("%(File)s:%(Position)s" % resultMasterStatus)
+        self._binlogCheckpoint.save(resultMasterStatus['File'], int(resultMasterStatus['Position']), gtid)
+        self._binlogCheckpoint.flush()
 
     def listen(self):
-        _logger.info("Start to listen to the binlog of %s" % self.database)    
+        _logger.info("Start to listen to the binlog of %s" % self.databases)    
 
-        section = 'mysql:' + self.database
-        mysqlSetting = {
+        section = 'mysql:' + self.databases[0]
+        self._mysqlSetting = {
                 "host": config().get(section, "host"),
                 "port": int(config().get(section, 'port')),
                 "user": config().get(section, "user"),
                 "password": config().get(section, "password"),
                 }
 
-        watchedDatabases = [self.database]
-
         # load last binlog reader position
-        logFile, logPos, resumeStrem = self._loadLastBinlogPos()
+        logFile, logPos, gtid, resumeStrem = self._loadLastBinlogPos()
 
-        self._stream = BinLogStreamReader(
-                connection_settings=mysqlSetting,
-                server_id=int(config().get(section, "slaveid")),
-                only_events=[DeleteRowsEvent, WriteRowsEvent, UpdateRowsEvent],
-                blocking=True,
-                resume_stream=resumeStrem,
-                log_file=logFile,
-                log_pos=logPos,
-                )
+        self._refreshWatchedTables()
+        self._openStream(logFile, logPos, resumeStrem, gtid if self._gtidMode and gtid else None)
+        self._startSpoolSender()
+
+        # 读取binlog、解析和编码、发送到kafka分为三个阶段：
+        # 读取线程按照binlog的顺序把编码任务提交到线程池，并把任务放入有界队列，
+        # 当前线程按照队列的顺序取出编码结果，发送到kafka并保存检查点
+        self._pipeline = Queue.Queue(maxsize=self._pipelineQueueSize)
+        self._serializer = ThreadPoolExecutor(max_workers=self._pipelineWorkers)
+
+        reader = threading.Thread(target=self._readBinlog, args=(logFile, logPos, gtid), name='binlog-' + self.name)
+        reader.daemon = True
+        reader.start()
+
+        while True:
+            try:
+                position, task = self._pipeline.get(timeout=0.1)
+            except Queue.Empty:
+                self._kafkaProducer.poll(0)
+                self._checkpoint()
+                continue
+
+            try:
+                if isinstance(task, Exception):
+                    raise task
+
+                messages = task.result() if task is not None else []
+
+                # 使用spool时，消息写入spool后即可保存position
+                delivery = self._deliveryTracker.track(position, len(messages) if self._spool is None else 0)
+                for binlogRow, headers, key in messages:
+                    if self._spool is not None:
+                        self._spool.append(key, headers, binlogRow)
+                    else:
+                        self._pushToKafka(binlogRow, headers, key, delivery)
+
+                if self._spool is not None:
+                    self._checkDeliveryError()
+
+                # binlog的所有行都被kafka确认后，才会保存它的position
+                self._checkpoint()
+            except Exception as e:
+                print(e)
+                _logger.error("Fail to listen to the binlog of %s: %s", self.databases, e)
+                self._drain()
+                sys.exit(1)
+
+    def _readBinlog(self, logFile, logPos, gtid):
+        """
+        读取线程。放入队列的是(position, 编码任务)，不需要发送的事件没有编码任务，
+        出错时放入(None, 异常)
+        """
+        # 已经完整读取的事务的GTID集合，以及当前事务的GTID。
+        # 检查点只包含之前已完成的事务，重启后当前事务会被重新发送
+        executedGtid = GtidSet(gtid) if self._gtidMode else None
+        currentGtid = None
 
         while True:
             refresh = False
@@ -121,65 +243,446 @@ class ListenService(object):
                     refresh = True
                     logFile, logPos = self._stream.log_file, self._stream.log_pos
 
+                    if isinstance(binlogEvent, GtidEvent):
+                        if currentGtid is not None and currentGtid not in executedGtid:
+                            executedGtid.merge_gtid(currentGtid)
+                        currentGtid = Gtid(binlogEvent.gtid)
+                        continue
+
+                    if isinstance(binlogEvent, XidEvent):
+                        # 事务结束。同步配置引用的表发生变化时，从事务的边界重新打开binlog
+                        if currentGtid is not None and currentGtid not in executedGtid:
+                            executedGtid.merge_gtid(currentGtid)
+                        currentGtid = None
+
+                        self._pipeline.put(((logFile, logPos, str(executedGtid) if executedGtid is not None else None), None))
+
+                        if self._refreshWatchedTables():
+                            self._stream.close()
+                            self._openStream(logFile, logPos, True, None)
+                            break
+                        continue
+
+                    position = (logFile, logPos, str(executedGtid) if executedGtid is not None else None)
+
                     # filter no watch database
-                    if binlogEvent.schema not in watchedDatabases:
-                        self._writeBinlogPos(logFile, logPos)
+                    # only_tables只按照表名过滤，不同数据库中的同名表在这里过滤
+                    if binlogEvent.schema not in self.databases or not self._isWatched(binlogEvent.schema, binlogEvent.table):
+                        self._pipeline.put((position, None))
                         continue
 
-                    binlog = {}
-                    binlog['storage'] = 'mysql'
-                    binlog['database'] = '%s' % binlogEvent.schema
-                    binlog['table'] = '%s' % binlogEvent.table
-                    binlog['timestamp'] = datetime.fromtimestamp(binlogEvent.timestamp).strftime('%Y-%m-%d %H:%M:%S')
-
-                    for row in binlogEvent.rows:
-                        if isinstance(binlogEvent, DeleteRowsEvent):
-                            binlog['values'] = row['values']
-                            binlog['type'] = 'DELETE'
-                        elif isinstance(binlogEvent, UpdateRowsEvent):
-                            binlog['before'] = row['before_values']
-                            binlog['values'] = row['after_values']
-                            binlog['type'] = 'UPDATE'
-                        elif isinstance(binlogEvent, WriteRowsEvent):
-                            binlog['values'] = row['values']
-                            binlog['type'] = 'INSERT'
-
-                        binlogRow = json.dumps(binlog, default=timeutil.dateHandler)
-                        self._pushToKafka(binlogRow, binlog['database'], binlog['table'])
-
-                    # after pushing binlog to kafka, update the binlog position
-                    self._writeBinlogPos(logFile, logPos)
+                    # 只发送同步时会用到的字段以及主键。
+                    # 同步配置刷新后，之前的事件仍然使用提交任务时的配置
+                    tableKey = (binlogEvent.schema, binlogEvent.table)
+                    task = self._serializer.submit(
+                            self._encodeEvent,
+                            binlogEvent,
+                            self._projections.get(tableKey, None),
+                            self._deltas.get(tableKey, None),
+                            self._partitionFields
+                            )
+                    self._pipeline.put((position, task))
 
                 if not refresh:
                     _logger.info("NO new input binlog, current position: [%s:%d]", logFile if logFile is not None else "", logPos if logPos is not None else 0)
                     time.sleep(0.1)
             except Exception as e:
-                print(e)
-                sys.exit(1)
+                self._pipeline.put((None, e))
+                return
+
+    def _encodeEvent(self, binlogEvent, fields, delta, partitionFields):
+        """
+        解析一个binlog事件的所有行，返回编码后的消息[(消息体, headers, key)]
+        """
+        binlog = {}
+        binlog['storage'] = 'mysql'
+        binlog['database'] = '%s' % binlogEvent.schema
+        binlog['table'] = '%s' % binlogEvent.table
+        binlog['timestamp'] = binlogEvent.timestamp
+        binlog['primary_key'] = self._getPrimaryKey(binlogEvent)
+
+        rowBinlogs = []
+        for row in binlogEvent.rows:
+            if isinstance(binlogEvent, DeleteRowsEvent):
+                binlog['values'] = self._project(row['values'], fields, binlog['primary_key'])
+                binlog['type'] = 'DELETE'
+            elif isinstance(binlogEvent, UpdateRowsEvent):
+                binlog['before'] = self._project(row['before_values'], fields, binlog['primary_key'])
+                binlog['values'] = self._project(row['after_values'], fields, binlog['primary_key'])
+                binlog['type'] = 'UPDATE'
+            elif isinstance(binlogEvent, WriteRowsEvent):
+                binlog['values'] = self._project(row['values'], fields, binlog['primary_key'])
+                binlog['type'] = 'INSERT'
+
+            rowBinlogs += self._splitByPartitionKey(binlog, partitionFields)
+
+        messages = []
+        for rowBinlog, key in rowBinlogs:
+            if rowBinlog['type'] == 'UPDATE':
+                self._encodeDelta(rowBinlog, delta)
+
+            binlogRow, headers = binlogcodec.encode(rowBinlog, self._messageFormat)
+            messages.append((binlogRow, headers, key))
+
+        return messages
+
+    def _openStream(self, logFile, logPos, resumeStream, gtid):
+        onlyEvents = [DeleteRowsEvent, WriteRowsEvent, UpdateRowsEvent, XidEvent]
+        if self._gtidMode:
+            onlyEvents.append(GtidEvent)
+
+        _logger.info("open binlog stream at [%s:%s], gtid[%s], tables%s", logFile, logPos, gtid, self._watchedTables)
+
+        onlyTables = None
+        if self._watchedTables is not None:
+            onlyTables = sorted(set(table for database, table in self._watchedTables))
 
-    def _loadLastBinlogPos(self):
-        if not os.path.exists(self._binlogPosFile):
-            return (None, None, False)
-        
-        try:
-            with open(self._binlogPosFile) as f:
-                res = f.readline()
-                if res.find(":") < 0:
-                    return (None, None, False)
+        self._stream = BinLogStreamReader(
+                connection_settings=self._mysqlSetting,
+                server_id=int(config().get('mysql:' + self.databases[0], "slaveid")),
+                only_events=onlyEvents,
+                only_schemas=self.databases,
+                only_tables=onlyTables,
+                blocking=True,
+                resume_stream=resumeStream,
+                log_file=logFile,
+                log_pos=logPos,
+                auto_position=gtid,
+                )
+
+    def _refreshWatchedTables(self):
+        """
+        同步配置文件发生变化时，重新计算需要监听的表以及每个表需要发送的字段。
+        需要监听的表发生变化时返回True
+        """
+        if not self._tableFilter and not self._columnProjection and self._partitionBy == _PARTITION_BY_TABLE:
+            return False
+
+        now = time.time()
+        if self._handlerConfigVersion is not None and now - self._handlerConfigCheckTime < self._handlerConfigCheckInterval:
+            return False
+        self._handlerConfigCheckTime = now
+
+        version = self._getHandlerConfigVersion()
+        if version == self._handlerConfigVersion:
+            return False
+        self._handlerConfigVersion = version
+
+        handlerConfigs = self._loadHandlerConfigs()
+        self._projections = self._getProjections(handlerConfigs) if self._columnProjection else {}
+        self._deltas = self._getDeltas(handlerConfigs) if self._deltaUpdate else {}
+        self._partitionFields = self._getPartitionFields(handlerConfigs) if self._partitionBy != _PARTITION_BY_TABLE else {}
+
+        if not self._tableFilter:
+            return False
+
+        tables = self._getWatchedTables(handlerConfigs)
+        if tables == self._watchedTables:
+            return False
+
+        _logger.info("watched tables of %s changed: %s => %s", self.databases, self._watchedTables, tables)
+        self._watchedTables = tables
+        self._watchedTableSet = frozenset(tables) if tables is not None else None
+        return True
+
+    def _isWatched(self, database, table):
+        return self._watchedTableSet is None or (database, table) in self._watchedTableSet
+
+    def _loadHandlerConfigs(self):
+        """
+        加载handler配置目录中的所有同步配置，任何一个加载失败时返回None
+        """
+        handlerConfigs = []
+        for filepath in sorted(glob.glob(os.path.join(self._handlerConfigDir, '*.yml'))):
+            handlerConfig = HandlerConfig()
+            try:
+                handlerConfig.loadFromFile(filepath)
+            except IllegalConfigException as e:
+                _logger.error("Fail to load handler config[%s], listen to all tables and columns: %s", filepath, e)
+                return None
+
+            handlerConfigs.append(handlerConfig)
+
+        return handlerConfigs
+
+    def _getWatchedTables(self, handlerConfigs):
+        """
+        同步配置中引用的所监听数据库的表[(database, table)]。
+        没有同步配置或者某个数据库没有被引用时，返回None，即监听所有的表
+        """
+        if handlerConfigs is None:
+            return None
+
+        tables = self._getReferencedTables(handlerConfigs)
+        for database in self.databases:
+            if not any(tableDatabase == database for tableDatabase, table in tables):
+                _logger.warning("NO table of %s found in handler configs[%s], listen to all tables", database, self._handlerConfigDir)
+                return None
+
+        return sorted(tables)
+
+    def _getReferencedTables(self, handlerConfigs):
+        tables = set()
+        for handlerConfig in handlerConfigs:
+            for database, table in handlerConfig.getDatabaseTables():
+                if database in self.databases:
+                    tables.add((database, table))
+
+        return tables
+
+    def _getProjections(self, handlerConfigs):
+        """
+        每个表需要发送的字段。不在结果中的表，发送所有的字段
+        """
+        if handlerConfigs is None:
+            return {}
+
+        projections = {}
+        for database, table in self._getReferencedTables(handlerConfigs):
+            fields = set()
+            for handlerConfig in handlerConfigs:
+                tableFields = handlerConfig.getProjectedFields(database, table)
+                if tableFields is None:
+                    _logger.info("can NOT resolve the columns used by %s.%s, send all columns", database, table)
+                    fields = None
+                    break
+                fields.update(tableFields)
+
+            if fields is not None:
+                projections[(database, table)] = frozenset(fields)
+
+        _logger.info("column projections of %s: %s", self.databases, projections)
+        return projections
+
+    def _getPartitionFields(self, handlerConfigs):
+        """
+        document：同步配置中partition_key引用的字段。
+        存在扇出并且没有开启partition_fanout时，配置中引用的表为_NOT_PARTITIONED。
+        同步配置加载失败时返回None
+        """
+        if handlerConfigs is None:
+            return {} if self._partitionFanout else None
+
+        byDocument = self._partitionBy == _PARTITION_BY_DOCUMENT
+        partitionFields = {}
+        if not self._partitionFanout:
+            for handlerConfig in handlerConfigs:
+                for tableKey in handlerConfig.getFanoutTables(byDocument):
+                    partitionFields[tableKey] = _NOT_PARTITIONED
+
+        for database, table in self._getReferencedTables(handlerConfigs):
+            if not byDocument or (database, table) in partitionFields:
+                continue
+
+            tableFields = set()
+            for handlerConfig in handlerConfigs:
+                fields = handlerConfig.getPartitionFields(database, table)
+                if fields:
+                    tableFields.add(fields)
+
+            if len(tableFields) == 1:
+                partitionFields[(database, table)] = tableFields.pop()
+            elif len(tableFields) > 1:
+                _logger.warning("conflicting partition_key of %s.%s: %s, partition by primary key", database, table, tableFields)
+
+        _logger.info("partition fields of %s: %s", self.databases,
+                { key: 'table' if fields is _NOT_PARTITIONED else fields for key, fields in partitionFields.items() })
+        return partitionFields
+
+    def _getMessageKey(self, binlog, values, partitionFields):
+        """
+        table：同一个表的消息在同一个partition中
+        primary_key：同一行记录的消息在同一个partition中
+        document：partition_key的值相同的消息(例如同一个ES文档的主表和从表记录)在同一个partition中，
+                  没有配置partition_key的表按照primary_key
+        存在扇出的表(除非开启了partition_fanout)，以及同步配置加载失败时，按照table
+        """
+        tableKey = binlog['database'] + binlog['table']
+        if self._partitionBy == _PARTITION_BY_TABLE or partitionFields is None:
+            return tableKey
+
+        fields = partitionFields.get((binlog['database'], binlog['table']), None)
+        if fields is _NOT_PARTITIONED:
+            return tableKey
+
+        if self._partitionBy == _PARTITION_BY_DOCUMENT and fields:
+            return u'|'.join(unicode(values.get(field, None)) for field in fields).encode('utf-8')
+
+        fields = binlog['primary_key']
+        if not fields:
+            return tableKey
+
+        return (tableKey + u'|' + u'|'.join(unicode(values.get(field, None)) for field in fields)).encode('utf-8')
+
+    def _splitByPartitionKey(self, binlog, partitionFields):
+        """
+        返回[(binlog, key)]。
+        UPDATE前后的key不同时，拆分为更新前数据的DELETE和更新后数据的INSERT，分别发送到各自的partition，
+        保证每个partition中同一行记录/同一个文档的变更是有序的
+        """
+        binlog = dict(binlog)
+        if binlog['type'] != 'UPDATE':
+            binlog.pop('before', None)
+            return [(binlog, self._getMessageKey(binlog, binlog['values'], partitionFields))]
+
+        beforeKey = self._getMessageKey(binlog, binlog['before'], partitionFields)
+        afterKey = self._getMessageKey(binlog, binlog['values'], partitionFields)
+        if beforeKey == afterKey:
+            return [(binlog, afterKey)]
+
+        deleteBinlog = dict(binlog, type='DELETE', values=binlog['before'])
+        insertBinlog = dict(binlog, type='INSERT')
+        del deleteBinlog['before']
+        del insertBinlog['before']
+        return [(deleteBinlog, beforeKey), (insertBinlog, afterKey)]
+
+    def _getDeltas(self, handlerConfigs):
+        """
+        只对能够确定字段的表(self._projections)使用delta编码
+        """
+        deltas = {}
+        for database, table in self._projections:
+            requiredFields = set()
+            rebuildFields = set()
+            for handlerConfig in handlerConfigs:
+                requiredFields.update(handlerConfig.getProjectedFields(database, table, withPlainMapping=False))
+                rebuildFields.update(handlerConfig.getRebuildFields(database, table))
+
+            deltas[(database, table)] = (frozenset(requiredFields), frozenset(rebuildFields))
+
+        return deltas
+
+    def _encodeDelta(self, binlog, delta):
+        """
+        UPDATE只发送发生变化的字段以及总是需要的字段。
+        anchor fields或者filter中的字段发生变化时，SyncService需要完整的数据
+        """
+        binlog.pop('delta', None)
+        if delta is None:
+            return
+
+        requiredFields, rebuildFields = delta
+        changedFields = binlogcodec.getChangedFields(binlog['before'], binlog['values'])
+        if changedFields & rebuildFields:
+            return
 
-                logFile, logPos = res.split(":")
-                logPos = int(logPos)
-        except IOError:
-            return (None, None, False)
+        binlog['values'], binlog['before'] = binlogcodec.encodeUpdate(
+                binlog['before'],
+                binlog['values'],
+                changedFields,
+                requiredFields,
+                binlog['primary_key']
+                )
+        binlog['delta'] = 1
+
+    def _project(self, values, fields, primaryKey):
+        if fields is None:
+            return values
+
+        return { column: value for column, value in values.items() if column in fields or column in primaryKey }
+
+    def _getHandlerConfigVersion(self):
+        version = []
+        for root, dirs, files in os.walk(self._handlerConfigDir):
+            for filename in files:
+                if filename.endswith('.yml'):
+                    filepath = os.path.join(root, filename)
+                    version.append((filepath, os.path.getmtime(filepath)))
+
+        return sorted(version)
+
+    def _getPrimaryKey(self, binlogEvent):
+        """
+        表的主键列名列表，SyncService根据主键合并同一行记录的多次变更
+        """
+        primaryKey = binlogEvent.primary_key
+        if not primaryKey:
+            return []
+        elif isinstance(primaryKey, basestring):
+            return [primaryKey]
+        else:
+            return list(primaryKey)
+
+    def _initBinlogCheckpoint(self):
+        redisClient = None
+        if config().getBoolean('listen', 'checkpoint_redis', False):
+            redisClient = remote.getRedisClient()
+
+        return BinlogCheckpoint(
+                self._binlogPosFile,
+                interval=int(config().get('listen', 'checkpoint_interval_ms', '1000')) / 1000,
+                eventCount=int(config().get('listen', 'checkpoint_events', '1000')),
+                fsync=config().get('listen', 'checkpoint_fsync', 'always'),
+                redisClient=redisClient,
+                redisKey='__mee_binlog_position_' + self.name,
+                # 检查点之前的binlog必须已经写入spool
+                beforeFlush=self._spool.sync if self._spool is not None else None
+                )
+
+    def _initSpool(self):
+        if not config().getBoolean('listen', 'spool', False):
+            return None
+
+        maxBytes = int(config().get('listen', 'spool_max_bytes', '1073741824'))
+        return BinlogSpool(
+                self._runPath + "/" + self.name + "_spool",
+                segmentBytes=int(config().get('listen', 'spool_segment_bytes', '67108864')),
+                maxBytes=maxBytes,
+                resumeBytes=int(config().get('listen', 'spool_resume_bytes', str(int(maxBytes * 0.8)))),
+                fsync=config().get('listen', 'checkpoint_fsync', 'always'),
+                )
+
+    def _startSpoolSender(self):
+        if self._spool is None or self._spoolSender is not None:
+            return
+
+        self._spoolSender = SpoolSender(
+                self._spool,
+                self._kafkaProducer,
+                self.topic,
+                maxInFlight=self._maxInFlight,
+                statsInterval=int(config().get('listen', 'spool_stats_interval', '60')),
+                )
+        thread = threading.Thread(target=self._spoolSender.run, name='spool-' + self.name)
+        thread.daemon = True
+        thread.start()
 
-        return (logFile, logPos, True)
+    def _getServerName(self):
+        section = 'mysql:' + self.databases[0]
+        return '%s_%s' % (config().get(section, 'host'), config().get(section, 'port'))
 
-    def _writeBinlogPos(self, logFile, logPos):
-        _logger.info('locate binlog file[%s] position [%d]', logFile, logPos)
-        if self._posStream is None:
-            self._posStream = open(self._binlogPosFile, 'w')
+    def _getBinlogPosFile(self, name):
+        return self._runPath + "/" + name + "_collector_position.safe"
 
-        self._posStream.write("%s:%d" % (logFile, logPos))
+    def _loadLastBinlogPos(self):
+        checkpoint = self._binlogCheckpoint.load()
+        if checkpoint is None and len(self.databases) > 1:
+            checkpoint = self._loadLegacyCheckpoint()
+        if checkpoint is None:
+            return (None, None, None, False)
+
+        return (checkpoint.get('log_file'), checkpoint.get('log_pos'), checkpoint.get('gtid'), True)
+
+    def _loadLegacyCheckpoint(self):
+        """
+        从每个数据库单独监听时的检查点中，选择最早的position，之后的binlog会被重新发送
+        """
+        checkpoints = []
+        for database in self.databases:
+            checkpoint = BinlogCheckpoint(self._getBinlogPosFile(database)).load()
+            if checkpoint is not None and checkpoint.get('log_file'):
+                checkpoints.append(checkpoint)
+
+        if not checkpoints:
+            return None
+
+        checkpoint = min(checkpoints, key=lambda checkpoint: (checkpoint['log_file'], checkpoint['log_pos']))
+        _logger.info("load binlog checkpoint of %s from the checkpoints of each database: %s", self.databases, checkpoint)
+        return checkpoint
+
+    def _writeBinlogPos(self, logFile, logPos, gtid=None):
+        _logger.debug('locate binlog file[%s] position [%d] gtid [%s]', logFile, logPos, gtid)
+        self._binlogCheckpoint.save(logFile, logPos, gtid)
 
     def _initKafkaProducer(self):
         try:
@@ -189,37 +692,86 @@ class ListenService(object):
             _logger.error("Fail to init a kafka producer")
             sys.exit(1)
 
-    def _pushToKafka(self, rowValue, database, table):
-        try:
-            self._kafkaMsgRedeliveryCount = 0
-            key = database + table
-            self._kafkaProducer.produce(
-                    self.topic, 
-                    rowValue.encode("utf-8"), 
-                    key,
-                    callback=self._kafkaDeliveryCallback
-                    )
-            self._kafkaProducer.flush()
-            return True
-        except Exception as e:
-            _logger.error("Fail to push to topic[%s] row[%s]. Error: %s", self.topic, rowValue, e)
-            sys.exit(1)
+    def _pushToKafka(self, rowValue, headers, key, delivery):
+        """
+        异步发送，不等待kafka的确认。已发送、尚未确认的消息数超过producer_max_in_flight时，等待确认
+        """
+        callback = lambda err, msg: self._kafkaDeliveryCallback(delivery, err, msg)
+
+        while True:
+            try:
+                self._kafkaProducer.produce(
+                        self.topic, 
+                        rowValue, 
+                        key,
+                        headers=headers,
+                        callback=callback
+                        )
+                break
+            except BufferError:
+                # producer本地的缓存已满
+                self._kafkaProducer.poll(0.1)
+            except Exception as e:
+                _logger.error("Fail to push to topic[%s] row[%r]. Error: %s", self.topic, rowValue, e)
+                self._drain()
+                sys.exit(1)
+
+        self._kafkaProducer.poll(0)
+        while self._deliveryTracker.inFlight >= self._maxInFlight:
+            self._kafkaProducer.poll(0.1)
+            self._checkDeliveryError()
 
-    def _kafkaDeliveryCallback(self, err, msg):
+        self._checkDeliveryError()
+        return True
+
+    def _kafkaDeliveryCallback(self, delivery, err, msg):
         if err:
-            if self._kafkaMsgRedeliveryCount < 3:
-                """
-                redelivery msg when error happens
-                """
-                self._kafkaMsgRedeliveryCount += 1
-                _binlogLogger.info("redelivery(count=%d): topic[%s], msg[%s]", self._kafkaMsgRedeliveryCount, self.topic, msg.value())
-                self._kafkaProducer.produce(self.topic, msg.value(), callback=self._kafkaDeliveryCallback)
-            else:
-                _binlogLogger.error("delivery failed; topic[%s], msg[%s], err[%s]", self.topic, msg.value(), err)
+            # producer内部重试之后仍然失败。该binlog及之后的position不会被保存，
+            # 重启后从最后一个被确认的position重新发送
+            _binlogLogger.error("delivery failed; topic[%s], msg[%s], err[%s]", self.topic, msg.value(), err)
+            self._deliveryTracker.fail(err)
         else:
+            self._deliveryTracker.ack(delivery)
             _binlogLogger.info("topic[%s], msg[%s]", self.topic, msg.value())
 
+    def _checkDeliveryError(self):
+        if self._spoolSender is not None and self._spoolSender.error is not None:
+            _logger.error("Fail to send spooled binlog to topic[%s]: %s", self.topic, self._spoolSender.error)
+            self._drain()
+            sys.exit(1)
+
+        if self._deliveryTracker.error is not None:
+            _logger.error("Fail to deliver binlog to topic[%s]: %s", self.topic, self._deliveryTracker.error)
+            self._drain()
+            sys.exit(1)
+
+    def _checkpoint(self):
+        with self._checkpointLock:
+            position = self._deliveryTracker.confirmed()
+            if position is not None:
+                self._writeBinlogPos(*position)
+
+    def flush(self):
+        """
+        立即保存最后确认的position
+        """
+        self._checkpoint()
+        with self._checkpointLock:
+            self._binlogCheckpoint.flush()
+
+    def _drain(self):
+        """
+        退出前等待已发送的消息被确认，并保存最后确认的position
+        """
+        if self._spoolSender is not None:
+            self._spoolSender.stop()
+
+        try:
+            self._kafkaProducer.flush(10)
+        except Exception as e:
+            _logger.error("Fail to flush kafka producer: %s", e)
+        self.flush()
+
     def __del__(self):
-        if self._posStream:
-            self._posStream.flush()
-            self._posStream.close()
+        if getattr(self, '_binlogCheckpoint', None):
+            self._binlogCheckpoint.flush()
@@ -15,6 +15,8 @@ from modules.status import RedisStatus, RedisStatusConfig, HandlerConfig
 from utils.singleton import cache
 from utils.failure import Failure
 from modules.handlers.v1 import CommonHandler
+from .coalescer import coalesce
+from . import binlogcodec
 
 from .basecosumerservice import *
 
@@ -32,6 +34,10 @@ class SyncService(BaseConsumerService):
         self.status = RedisStatus(taskName)
         self.relayTopic = config().get('kafka', 'topic')
 
+        # 每批最多处理的消息数，以及等待一批消息的最长时间(毫秒)
+        self.batchSize = int(config().get('sync', 'batch_size', str(self._PATCH_MESSAGE_COUNT)))
+        self.batchWaitMs = int(config().get('sync', 'batch_wait_ms', '1000'))
+
         self.statusConfig = None
         self.kafkaConsumer = None
         self.handler = None
@@ -84,32 +90,42 @@ class SyncService(BaseConsumerService):
                     )
             self.kafkaConsumer.subscribe([self.relayTopic])
             self.handler = CommonHandler(self.statusConfig)
+            self.handler.registerScripts()
 
-        while True:
-            message = self.kafkaConsumer.poll(1)
-            if not self._handleMessage(message):
-                break
+        messages = self.kafkaConsumer.consume(self.batchSize, self.batchWaitMs / 1000)
+        self._handleMessages(messages)
 
-        self.commit()
+    def _handleMessages(self, messages):
+        """
+        一批消息中的binlog一起同步到ES，全部写入成功后再提交offset
+        """
+        events = []
+        okMessages = []
+        for message in messages:
+            if self.checkMessage(message) != MESSAGE_OK:
+                continue
 
-    def _handleMessage(self, message):
-        msgStatus = self.checkMessage(message)
+            _logger.debug('_handleMessages message: offset[%s]', message.offset())
 
-        if msgStatus == MESSAGE_OK:
-            _logger.debug('_handleMessage message: offset[%s]', message.offset())
+            okMessages.append(message)
 
-            event = json.loads(message.value())
-            self.handler.syncFromBinlog(event)
+            # 根据header丢弃无关的消息，不需要解码消息体
+            routing = binlogcodec.getRouting(message.headers())
+            if routing and not self.handler.isWatched(routing[0], routing[1]):
+                continue
 
-            self.prepareCommit(message)
+            events.append(binlogcodec.decode(message.value(), message.headers()))
 
-            self.itemCount += 1
-            if self.itemCount >= self._PATCH_MESSAGE_COUNT:
-                self.itemCount = 0
-                return False
-        elif msgStatus == MESSAGE_TIMEOUT or msgStatus == MESSAGE_EOF:
-            self.itemCount = 0
-            return False
+        if not okMessages:
+            return
 
-        return True
+        if events:
+            # 同一行记录的多次变更，只同步最终的净变化
+            self.handler.syncFromBinlogBatch(coalesce(events))
+
+        for message in okMessages:
+            self.prepareCommit(message)
+
+        self.itemCount += len(events)
+        self.commit()
 
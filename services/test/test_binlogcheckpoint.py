@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, division
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from ..binlogcheckpoint import BinlogCheckpoint
+
+class _FakeRedis(object):
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key, None)
+
+    def set(self, key, value):
+        self.data[key] = value
+
+class BinlogCheckpointTests(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'db_collector_position.safe')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_save_by_count(self):
+        checkpoint = BinlogCheckpoint(self.path, interval=3600, eventCount=2)
+        self.assertIsNone(checkpoint.load())
+
+        checkpoint.save('mysql-bin.000001', 100)
+        self.assertIsNone(checkpoint.load())
+
+        checkpoint.save('mysql-bin.000001', 200, '3e11fa47-71ca-11e1-9e33-c80aa9429562:1-5')
+        self.assertEqual(checkpoint.load(), {
+            'log_file': 'mysql-bin.000001',
+            'log_pos': 200,
+            'gtid': '3e11fa47-71ca-11e1-9e33-c80aa9429562:1-5'
+            })
+        self.assertFalse(os.path.exists(self.path + '.tmp'))
+
+    def test_flush(self):
+        checkpoint = BinlogCheckpoint(self.path, interval=3600, eventCount=1000, fsync='never')
+        checkpoint.save('mysql-bin.000001', 100)
+        checkpoint.save('mysql-bin.000002', 4)
+        checkpoint.flush()
+
+        self.assertEqual(BinlogCheckpoint(self.path).load()['log_pos'], 4)
+
+    def test_legacy_format(self):
+        with open(self.path, 'w') as f:
+            f.write('mysql-bin.000003:120mysql-bin.000003:240')
+
+        checkpoint = BinlogCheckpoint(self.path).load()
+        self.assertEqual((checkpoint['log_file'], checkpoint['log_pos']), ('mysql-bin.000003', 120))
+
+    def test_redis_mirror(self):
+        redis = _FakeRedis()
+        checkpoint = BinlogCheckpoint(self.path, eventCount=1, redisClient=redis, redisKey='pos')
+        checkpoint.save('mysql-bin.000001', 100)
+        os.remove(self.path)
+
+        self.assertEqual(checkpoint.load()['log_pos'], 100)
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, division
+
+import unittest
+import datetime
+import simplejson as json
+
+from decimal import Decimal
+
+from .. import binlogcodec
+
+class BinlogCodecTests(unittest.TestCase):
+    def test_delta_update(self):
+        before = { 'id': 1, 'user_id': 7, 'name': 'a', 'remark': 'x' }
+        after = { 'id': 1, 'user_id': 7, 'name': 'b', 'remark': 'x' }
+
+        changed = binlogcodec.getChangedFields(before, after)
+        self.assertSetEqual(changed, {'name'})
+
+        values, beforeDelta = binlogcodec.encodeUpdate(before, after, changed, {'user_id'}, ['id'])
+        self.assertEqual(values, { 'id': 1, 'user_id': 7, 'name': 'b' })
+        self.assertEqual(beforeDelta, { 'name': 'a' })
+
+        data = json.dumps({ 'type': 'UPDATE', 'delta': 1, 'values': values, 'before': beforeDelta })
+        binlog = binlogcodec.decode(data)
+        self.assertNotIn('delta', binlog)
+        self.assertEqual(binlog['before'], { 'id': 1, 'user_id': 7, 'name': 'a' })
+        self.assertEqual(binlog['values'], { 'id': 1, 'user_id': 7, 'name': 'b' })
+
+    def test_full_update(self):
+        data = json.dumps({ 'type': 'UPDATE', 'values': { 'id': 1, 'name': 'b' }, 'before': { 'id': 1, 'name': 'a' } })
+        binlog = binlogcodec.decode(data)
+        self.assertEqual(binlog['before'], { 'id': 1, 'name': 'a' })
+
+    def test_msgpack(self):
+        binlog = {
+                'storage': 'mysql',
+                'database': u'db',
+                'table': u'users',
+                'type': 'UPDATE',
+                'timestamp': 1545000000,
+                'primary_key': [u'id'],
+                'values': { u'id': 1, u'name': u'名字', u'amount': Decimal('1.50'), u'created_at': datetime.datetime(2018, 12, 12, 8, 23, 12), u'birthday': datetime.date(2000, 1, 2) },
+                'before': { u'id': 1, u'name': u'a', u'amount': None, u'created_at': None, u'birthday': None },
+                }
+
+        jsonData, jsonHeaders = binlogcodec.encode(binlog, binlogcodec.FORMAT_JSON)
+        data, headers = binlogcodec.encode(binlog, binlogcodec.FORMAT_MSGPACK)
+        self.assertLess(len(data), len(jsonData))
+        self.assertEqual(binlogcodec.getRouting(headers), (u'db', u'users', u'UPDATE'))
+
+        self.assertEqual(binlogcodec.decode(data, headers), binlogcodec.decode(jsonData, jsonHeaders))
+        self.assertEqual(binlogcodec.decode(data, headers)['values'][u'created_at'], '2018-12-12 08:23:12')
+
+        # 没有header的旧消息
+        self.assertIsNone(binlogcodec.getRouting(None))
+        self.assertEqual(binlogcodec.decode(jsonData), binlogcodec.decode(jsonData, jsonHeaders))
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, division
+
+import os
+import glob
+import shutil
+import tempfile
+import unittest
+
+from ..binlogspool import BinlogSpool, SpoolSender
+
+class _FakeProducer(object):
+    """
+    poll时回调；failures次发送失败后全部成功
+    """
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.messages = []
+        self._pending = []
+
+    def produce(self, topic, value, key, headers=None, callback=None):
+        self._pending.append((value, callback))
+
+    def poll(self, timeout=0):
+        pending, self._pending = self._pending, []
+        for value, callback in pending:
+            if self.failures > 0:
+                self.failures -= 1
+                callback('timeout', None)
+            else:
+                self.messages.append(value)
+                callback(None, None)
+
+class BinlogSpoolTests(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_append_read_commit(self):
+        spool = BinlogSpool(self.dir, segmentBytes=64, fsync='never')
+        for i in range(5):
+            spool.append(u'key%d' % i, [('mee.v', '1')], b'value%d' % i)
+
+        records = spool.read(3)
+        self.assertEqual([record[3] for record in records], [b'value0', b'value1', b'value2'])
+        self.assertEqual(records[0][1:3], (u'key0', [('mee.v', '1')]))
+        self.assertEqual(len(spool.read(10)), 2)
+        self.assertEqual(spool.read(10), [])
+        self.assertGreater(spool.stats()['segments'], 1)
+
+        # 已经确认的segment被删除，重新读取时从确认的位置开始
+        spool.commit(records[2][0])
+        spool.rewind()
+        self.assertEqual([record[3] for record in spool.read(10)], [b'value3', b'value4'])
+        self.assertLess(len(glob.glob(os.path.join(self.dir, '*.seg'))), 5)
+        spool.close()
+
+    def test_reopen(self):
+        spool = BinlogSpool(self.dir, fsync='never')
+        spool.append(u'key', [], b'value0')
+        spool.append(u'key', [], b'value1')
+        spool.commit(spool.read(1)[0][0])
+        spool.close()
+
+        # 进程崩溃时写了一半的消息被截掉
+        segment = glob.glob(os.path.join(self.dir, '*.seg'))[0]
+        with open(segment, 'ab') as f:
+            f.write(b'\x00\x00\x01')
+
+        spool = BinlogSpool(self.dir, fsync='never')
+        self.assertEqual([record[3] for record in spool.read(10)], [b'value1'])
+        spool.append(u'key', [], b'value2')
+        self.assertEqual([record[3] for record in spool.read(10)], [b'value2'])
+        spool.close()
+
+    def test_sender_retry(self):
+        spool = BinlogSpool(self.dir, fsync='never')
+        for i in range(3):
+            spool.append(u'key', [], b'value%d' % i)
+
+        producer = _FakeProducer(failures=1)
+        sender = SpoolSender(spool, producer, 'topic', retryBackoff=0)
+        sender._produce(*spool.read(10)[0])
+        producer.poll()
+        sender._retry()
+        self.assertEqual(sender.retries, 1)
+
+        for record in spool.read(10):
+            sender._produce(*record)
+        producer.poll()
+        sender._commit()
+
+        self.assertEqual(producer.messages, [b'value0', b'value1', b'value2'])
+        self.assertEqual(spool.stats()['backlog_bytes'], 0)
+        spool.close()
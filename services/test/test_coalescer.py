@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, division
+
+import unittest
+
+import simplejson as json
+
+from .. import binlogcodec
+from ..coalescer import coalesce
+
+def _event(eventType, values, before=None, table='loan_base', primaryKey=('id',)):
+    event = {
+            'database': 'db',
+            'table': table,
+            'type': eventType,
+            'values': values,
+            'primary_key': list(primaryKey) if primaryKey else None
+            }
+    if before is not None:
+        event['before'] = before
+    return event
+
+class CoalescerTests(unittest.TestCase):
+    def test_updates_fold(self):
+        events = [
+                _event('UPDATE', { 'id': 1, 'balance': 2 }, before={ 'id': 1, 'balance': 1 }),
+                _event('UPDATE', { 'id': 1, 'balance': 3 }, before={ 'id': 1, 'balance': 2 }),
+                _event('UPDATE', { 'id': 1, 'balance': 4 }, before={ 'id': 1, 'balance': 3 }),
+                ]
+        result = coalesce(events)
+
+        self.assertEqual(len(result), 1)
+        self.assertEqual(result[0]['type'], 'UPDATE')
+        self.assertEqual(result[0]['before'], { 'id': 1, 'balance': 1 })
+        self.assertEqual(result[0]['values'], { 'id': 1, 'balance': 4 })
+
+    def test_insert_delete_cancel(self):
+        events = [
+                _event('INSERT', { 'id': 1, 'balance': 1 }),
+                _event('UPDATE', { 'id': 1, 'balance': 2 }, before={ 'id': 1, 'balance': 1 }),
+                _event('DELETE', { 'id': 1, 'balance': 2 }),
+                ]
+        self.assertEqual(coalesce(events), [])
+
+    def test_insert_update(self):
+        events = [
+                _event('INSERT', { 'id': 1, 'balance': 1 }),
+                _event('UPDATE', { 'id': 1, 'balance': 2 }, before={ 'id': 1, 'balance': 1 }),
+                ]
+        result = coalesce(events)
+
+        self.assertEqual(len(result), 1)
+        self.assertEqual(result[0]['type'], 'INSERT')
+        self.assertEqual(result[0]['values'], { 'id': 1, 'balance': 2 })
+        self.assertNotIn('before', result[0])
+
+    def test_update_delete(self):
+        events = [
+                _event('UPDATE', { 'id': 1, 'balance': 2 }, before={ 'id': 1, 'balance': 1 }),
+                _event('DELETE', { 'id': 1, 'balance': 2 }),
+                ]
+        result = coalesce(events)
+
+        self.assertEqual(len(result), 1)
+        self.assertEqual(result[0]['type'], 'DELETE')
+        self.assertEqual(result[0]['values'], { 'id': 1, 'balance': 1 })
+
+    def test_delta_update_delete(self):
+        # delta编码的UPDATE解码后，before和values只包含主键、发生变化的字段以及总是需要的字段
+        update = binlogcodec.decode(json.dumps({
+            'database': 'db', 'table': 'loan_base', 'type': 'UPDATE', 'primary_key': ['id'], 'delta': 1,
+            'values': { 'id': 1, 'user_id': 3, 'balance': 2 },
+            'before': { 'balance': 1 }
+            }))
+        events = [
+                update,
+                _event('DELETE', { 'id': 1, 'user_id': 3, 'balance': 2, 'name': 'a', 'status': 0 }),
+                ]
+        result = coalesce(events)
+
+        self.assertEqual(len(result), 1)
+        self.assertEqual(result[0]['type'], 'DELETE')
+        # 没有变化的字段使用DELETE时的值，保证DELETE的values是完整的
+        self.assertEqual(result[0]['values'], { 'id': 1, 'user_id': 3, 'balance': 1, 'name': 'a', 'status': 0 })
+
+    def test_delete_insert(self):
+        events = [
+                _event('DELETE', { 'id': 1, 'balance': 1 }),
+                _event('INSERT', { 'id': 1, 'balance': 5 }),
+                ]
+        result = coalesce(events)
+
+        self.assertEqual(len(result), 1)
+        self.assertEqual(result[0]['type'], 'UPDATE')
+        self.assertEqual(result[0]['before'], { 'id': 1, 'balance': 1 })
+        self.assertEqual(result[0]['values'], { 'id': 1, 'balance': 5 })
+
+        events = [
+                _event('DELETE', { 'id': 1, 'balance': 1 }),
+                _event('INSERT', { 'id': 1, 'balance': 1 }),
+                ]
+        self.assertEqual(coalesce(events), [])
+
+    def test_order_and_keys(self):
+        events = [
+                _event('UPDATE', { 'id': 1, 'balance': 2 }, before={ 'id': 1, 'balance': 1 }),
+                _event('INSERT', { 'id': 2, 'balance': 1 }),
+                _event('INSERT', { 'id': 1, 'name': 'a' }, table='user'),
+                _event('UPDATE', { 'id': 1, 'balance': 3 }, before={ 'id': 1, 'balance': 2 }),
+                ]
+        result = coalesce(events)
+
+        self.assertEqual([ (e['table'], e['values']['id']) for e in result ], [('loan_base', 2), ('user', 1), ('loan_base', 1)])
+
+    def test_passthrough(self):
+        events = [
+                _event('UPDATE', { 'id': 1, 'balance': 2 }, before={ 'id': 1, 'balance': 1 }, primaryKey=None),
+                _event('UPDATE', { 'id': 1, 'balance': 3 }, before={ 'id': 1, 'balance': 2 }, primaryKey=None),
+                ]
+        self.assertEqual(coalesce(events), events)
+
+    def test_primary_key_changed(self):
+        events = [
+                _event('UPDATE', { 'id': 1, 'balance': 2 }, before={ 'id': 1, 'balance': 1 }),
+                _event('UPDATE', { 'id': 2, 'balance': 2 }, before={ 'id': 1, 'balance': 2 }),
+                _event('UPDATE', { 'id': 2, 'balance': 3 }, before={ 'id': 2, 'balance': 2 }),
+                ]
+        result = coalesce(events)
+
+        self.assertEqual(result, events)
+
+    def test_partial_updates(self):
+        events = [
+                _event('UPDATE', { 'id': 1, 'balance': 2 }, before={ 'id': 1, 'balance': 1 }),
+                _event('UPDATE', { 'id': 1, 'name': 'b' }, before={ 'id': 1, 'name': 'a' }),
+                _event('UPDATE', { 'id': 1, 'balance': 3 }, before={ 'id': 1, 'balance': 2 }),
+                ]
+        result = coalesce(events)
+
+        self.assertEqual(len(result), 1)
+        self.assertEqual(result[0]['before'], { 'id': 1, 'balance': 1, 'name': 'a' })
+        self.assertEqual(result[0]['values'], { 'id': 1, 'balance': 3, 'name': 'b' })
+
+        events = [
+                _event('INSERT', { 'id': 1, 'balance': 1, 'name': 'a' }),
+                _event('UPDATE', { 'id': 1, 'name': 'b' }, before={ 'id': 1, 'name': 'a' }),
+                ]
+        self.assertEqual(coalesce(events)[0]['values'], { 'id': 1, 'balance': 1, 'name': 'b' })
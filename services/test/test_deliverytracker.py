@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, division
+
+import unittest
+
+from ..deliverytracker import DeliveryTracker
+
+class DeliveryTrackerTests(unittest.TestCase):
+    def test_confirm_in_order(self):
+        tracker = DeliveryTracker()
+        first = tracker.track(('binlog.000001', 100), 2)
+        second = tracker.track(('binlog.000001', 200), 1)
+        tracker.track(('binlog.000001', 300), 0)
+        self.assertEqual(tracker.inFlight, 3)
+
+        # 后面的事件先被确认，position不能越过未确认的事件
+        tracker.ack(second)
+        self.assertIsNone(tracker.confirmed())
+
+        tracker.ack(first)
+        self.assertIsNone(tracker.confirmed())
+
+        tracker.ack(first)
+        self.assertEqual(tracker.confirmed(), ('binlog.000001', 300))
+        self.assertEqual(tracker.inFlight, 0)
+        self.assertIsNone(tracker.confirmed())
+
+    def test_fail(self):
+        tracker = DeliveryTracker()
+        first = tracker.track(('binlog.000001', 100), 1)
+        tracker.track(('binlog.000001', 200), 1)
+
+        tracker.fail('timeout')
+        tracker.fail('other')
+        self.assertEqual(tracker.error, 'timeout')
+        self.assertIsNone(tracker.confirmed())
+
+        tracker.ack(first)
+        self.assertEqual(tracker.confirmed(), ('binlog.000001', 100))
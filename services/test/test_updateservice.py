@@ -2,6 +2,7 @@
 
 from __future__ import print_function, division
 
+import time
 import unittest
 
 from ..updateservice import *
@@ -24,3 +25,17 @@ class UpdateServiceTests(unittest.TestCase):
     def test_update(self):
         self.svc.update()
 
+class CatchupTests(unittest.TestCase):
+    def test_isCaughtUp(self):
+        svc = UpdateService.__new__(UpdateService)
+
+        # 还没有消费到消息时，不能根据落后的秒数判断
+        self.assertEqual(svc._isCaughtUp(1000000, None, 100, 5), (False, None))
+        self.assertEqual(svc._isCaughtUp(50, None, 100, 5), (True, None))
+        self.assertEqual(svc._isCaughtUp(None, None, 100, 5), (False, None))
+        self.assertEqual(svc._isCaughtUp(0, None, 100, 5), (True, 0))
+
+        caughtUp, lagSeconds = svc._isCaughtUp(1000000, time.time() - 60, 100, 5)
+        self.assertFalse(caughtUp)
+        self.assertGreaterEqual(lagSeconds, 60)
+        self.assertTrue(svc._isCaughtUp(1000000, time.time(), 100, 5)[0])
@@ -14,25 +14,35 @@ import modules.remote as remote
 from elasticsearch import Elasticsearch, NotFoundError
 from elasticsearch.client import IndicesClient
 
-from confluent_kafka import TopicPartition
+from confluent_kafka import TopicPartition, TIMESTAMP_NOT_AVAILABLE
 from application.config import config
 from modules.status import RedisStatus, RedisStatusConfig, HandlerConfig
+from modules.handlers.v1.reverseindex import ReverseIndex
 from modules.interfaces import (STATUS_INITIAL, 
                               STATUS_FULL_UPDATING,
                               STATUS_INCRE_UPDATING
                               )
 from utils.failure import Failure
 
+from .basecosumerservice import *
+from . import binlogcodec
+
 _logger = app.getLogger('base')
 _DISTRIBUTE_REDIS_LOCK_PREFIX = '__mee_status_lock_'
 
-class UpdateService(object):
+class UpdateService(BaseConsumerService):
     """
     全量更新的service
     """
-    def __init__(self, taskName, handlerConfigPath):
+
+    _PATCH_MESSAGE_COUNT = 100
+
+    def __init__(self, taskName, handlerConfigPath, workers=None):
         self.handlerConfigPath = handlerConfigPath
 
+        # 全量更新时并行的进程数
+        self.workers = workers or int(config().get('update', 'workers', '1'))
+
         self.redisClient = remote.getRedisClient()
         self.esClient = remote.getElasticClient()
         self.esIndexClient = IndicesClient(self.esClient)
@@ -44,6 +54,11 @@ class UpdateService(object):
         # classname of handler
         self.handlerClassName = 'modules.handlers.v1.CommonHandler'
 
+        # 追赶增量数据时使用的kafka consumer
+        self.kafkaConsumer = None
+
+        super(UpdateService, self).__init__()
+
     def update(self):
         """
         update action.
@@ -63,8 +78,9 @@ class UpdateService(object):
 
         if syncResult:
             # 从kafka队列中消费数据，直至赶上老的消费者 
-            self._catchupwithCurrentConsumer()
+            syncResult = self._catchupwithCurrentConsumer()
 
+        if syncResult:
             # 移除老的es index的alias，增加新的es index的alias
             self._setESIndexAlias()
 
@@ -236,7 +252,7 @@ class UpdateService(object):
         try:
             handlerClass = utils.classForName(self.handlerClassName)
             commonHandler = handlerClass(nextStatusConfig)
-            commonHandler.syncFromMySQL()
+            commonHandler.syncFromMySQL(workers=self.workers)
             return True
         except Exception as e:
             _logger.error('exception occurs when syncFromMySQL: %s', Failure())
@@ -245,55 +261,151 @@ class UpdateService(object):
     def _catchupwithCurrentConsumer(self):
         """
         取新的consumer_group_id，从kafka队列中消费数据。
-        直到新的消费者赶上旧的消费者。
+        直到新的消费者落后的消息数或者秒数小于阈值（[update] catchup_max_lag_messages, catchup_max_lag_seconds）。
+        超过[update] catchup_timeout秒仍未赶上时，返回False
         """
-        # TODO
+        topicName = config().get('kafka', 'topic')
+        maxLagMessages = int(config().get('update', 'catchup_max_lag_messages', '100'))
+        maxLagSeconds = float(config().get('update', 'catchup_max_lag_seconds', '5'))
+        timeout = float(config().get('update', 'catchup_timeout', '3600'))
+
+        nextStatusConfig = RedisStatusConfig(self.status.nextConfig, forceSync=True)
+
+        print('begin to catch up with current consumer')
+
+        startTime = time.time()
+        try:
+            handlerClass = utils.classForName(self.handlerClassName)
+            commonHandler = handlerClass(nextStatusConfig)
+            commonHandler.registerScripts()
+
+            self.kafkaConsumer = remote.getKafkaConsumer(
+                    nextStatusConfig.kafkaGroupId,
+                    autoCommit=False
+                    )
+            self.kafkaConsumer.subscribe([topicName])
+
+            count = 0
+            lastTimestamp = None
+            while True:
+                itemCount = 0
+                while itemCount < self._PATCH_MESSAGE_COUNT:
+                    message = self.kafkaConsumer.poll(1)
+                    if self.checkMessage(message) != MESSAGE_OK:
+                        break
+
+                    commonHandler.syncFromBinlog(binlogcodec.decode(message.value(), message.headers()))
+                    self.prepareCommit(message)
+
+                    tsType, timestamp = message.timestamp()
+                    if tsType != TIMESTAMP_NOT_AVAILABLE:
+                        lastTimestamp = timestamp / 1000
+
+                    itemCount += 1
+
+                if self.commitCache:
+                    self.commit()
+                count += itemCount
+
+                lagMessages = self._getConsumerLag()
+                caughtUp, lagSeconds = self._isCaughtUp(lagMessages, lastTimestamp, maxLagMessages, maxLagSeconds)
+
+                _logger.info('catch up with current consumer: consumed[%s], lag messages[%s], lag seconds[%s]', count, lagMessages, lagSeconds)
+
+                if caughtUp:
+                    print('finish to catch up with current consumer, consumed[%s], lag messages[%s], lag seconds[%s]' % (count, lagMessages, lagSeconds))
+                    return True
+
+                if timeout and time.time() - startTime > timeout:
+                    self._fail('fail to catch up with current consumer in %s seconds: lag messages[%s], lag seconds[%s]' % (timeout, lagMessages, lagSeconds))
+                    return False
+        except Exception as e:
+            _logger.error('exception occurs when catching up with current consumer: %s', Failure())
+            return False
+        finally:
+            if self.kafkaConsumer:
+                self.kafkaConsumer.close()
+                self.kafkaConsumer = None
+            self.commitCache.clear()
+
+    def _isCaughtUp(self, lagMessages, lastTimestamp, maxLagMessages, maxLagSeconds):
+        """
+        返回 (是否已经赶上, 落后的秒数)。
+        落后的秒数只根据已经消费的消息的时间戳计算，还没有消费到带时间戳的消息时为None，
+        此时只比较落后的消息数
+        """
+        if lagMessages is None:
+            # 还没有分配到partition
+            return False, None
+
+        if lagMessages == 0:
+            return True, 0
+
+        if lastTimestamp is None:
+            return lagMessages <= maxLagMessages, None
+
+        lagSeconds = max(time.time() - lastTimestamp, 0)
+        return lagMessages <= maxLagMessages or lagSeconds <= maxLagSeconds, lagSeconds
+
+    def _getConsumerLag(self):
+        """
+        新的消费者在所有已分配的partition上落后的消息数。
+        尚未分配partition时返回None
+        """
+        partitions = self.kafkaConsumer.assignment()
+        if not partitions:
+            return None
+
+        lag = 0
+        for tp in self.kafkaConsumer.position(partitions):
+            low, high = self.kafkaConsumer.get_watermark_offsets(tp, timeout=10, cached=False)
+            # 还没有消费过的partition，position无效
+            offset = tp.offset if tp.offset >= 0 else low
+            lag += max(high - offset, 0)
+
+        return lag
 
     def _setESIndexAlias(self):
         """
         移除老的es index的alias，增加新的es index的alias
         """
-        configKey = self.status.config
-        if configKey:
-            statusConfig = RedisStatusConfig(configKey, forceSync=True)
-            self._removeESIndexAlias(statusConfig)
-
-        nextConfigKey = self.status.nextConfig
-        if nextConfigKey:
-            nextStatusConfig = RedisStatusConfig(nextConfigKey, forceSync=True)
-            self._addESIndexAlias(nextStatusConfig)
+        self._switchESIndexAlias(self.status.config, self.status.nextConfig)
 
     def _restoreESIndexAlias(self):
         """
         恢复老的es index的alias，删除新的es index的alias
         """
-        nextConfigKey = self.status.nextConfig
-        if nextConfigKey:
-            nextStatusConfig = RedisStatusConfig(nextConfigKey, forceSync=True)
-            self._removeESIndexAlias(nextStatusConfig)
+        self._switchESIndexAlias(self.status.nextConfig, self.status.config)
 
-        configKey = self.status.config
-        if configKey:
-            statusConfig = RedisStatusConfig(configKey, forceSync=True)
-            self._addESIndexAlias(statusConfig)
-
-    def _removeESIndexAlias(self, statusConfig):
+    def _switchESIndexAlias(self, fromConfigKey, toConfigKey):
         """
-        移除指定es index的alias
+        通过一次update_aliases请求，把alias从fromConfigKey对应的es index切换到toConfigKey对应的es index。
+        切换是原子的，不会出现alias不指向任何index的情况
         """
-        esIndexSuffix = statusConfig.esIndexSuffix
-        indices = statusConfig.handlerConfig.indices()
-        for indexAlias in indices:
-            indexName = indexAlias + '_' + esIndexSuffix
-            try:
-                self.esIndexClient.delete_alias(
-                        index=indexName,
-                        name=indexAlias
-                        )
-            except NotFoundError as e:
-                _logger.error('index[%s] not found: %s', indexName, e)
+        actions = []
+        if fromConfigKey:
+            statusConfig = RedisStatusConfig(fromConfigKey, forceSync=True)
+            esIndexSuffix = statusConfig.esIndexSuffix
+            for indexAlias in statusConfig.handlerConfig.indices():
+                indexName = indexAlias + '_' + esIndexSuffix
+                if self.esIndexClient.exists_alias(index=indexName, name=indexAlias):
+                    actions.append({ 'remove': { 'index': indexName, 'alias': indexAlias } })
+
+        if toConfigKey:
+            statusConfig = RedisStatusConfig(toConfigKey, forceSync=True)
+            esIndexSuffix = statusConfig.esIndexSuffix
+            for indexAlias in statusConfig.handlerConfig.indices():
+                indexName = indexAlias + '_' + esIndexSuffix
+                if self.esIndexClient.exists(index=indexName):
+                    actions.append({ 'add': { 'index': indexName, 'alias': indexAlias } })
+                else:
+                    _logger.error('index[%s] not found', indexName)
+
+        if actions:
+            _logger.info('switch es index alias: %s', actions)
+            self.esIndexClient.update_aliases(body={ 'actions': actions })
 
-    def _addESIndexAlias(self, statusConfig):
+    def _removeESIndexAlias(self, statusConfig):
         """
         移除指定es index的alias
         """
@@ -302,7 +414,7 @@ class UpdateService(object):
         for indexAlias in indices:
             indexName = indexAlias + '_' + esIndexSuffix
             try:
-                self.esIndexClient.put_alias(
+                self.esIndexClient.delete_alias(
                         index=indexName,
                         name=indexAlias
                         )
@@ -361,6 +473,10 @@ class UpdateService(object):
                 # 只删除alias，不删除index
                 self._removeESIndexAlias(statusConfig)
 
+            # 删除slave配置节的反向索引
+            if statusConfig.esIndexSuffix:
+                ReverseIndex.clear(self.redisClient, statusConfig.esIndexSuffix)
+
             # 在redis中删除status config
             # 设置为1天后过期
             statusConfig.delete(24 * 3600)
@@ -15,6 +15,7 @@ def validate_parser():
     parser = argparse.ArgumentParser(description='全量更新ES中的所有数据')
     parser.add_argument('-c', '--config', type=str, action='store', required=True, help='指定的配置文件。可以是绝对路径或者相对路径。若是相对路劲，则是相对于目录 <project root dir>/conf/handlers/')
     parser.add_argument('-n', '--name', type=str, action='store', required=True, help='指定的唯一任务名，必选，对应的增量更新进程需要指定同样的值。')
+    parser.add_argument('-w', '--workers', type=int, action='store', default=None, help='全量更新时并行的进程数，默认使用配置文件中[update] workers的值。大于1时，按照主表的keyset列(%%__last)分片，每个分片在一个进程中同步。')
     parser.add_argument('-a', '--action', type=str, action='store', default='update', help='指定的动作，默认是update。目前只支持update、reset和clean: update, 全量更新；reset, 重置任务状态，通常在全量更新失败执行reset；clean, 清理脏数据，脏数据通常是因为全量更新失败造成的。')
     return parser
 
@@ -35,10 +36,11 @@ if __name__ == '__main__':
     print('action is %s ' % action)
     print('handler config path is %s' % handlerConfigPath)
     print('task name is %s' % name)
+    print('workers is %s' % args.workers)
 
     # 要在app.init后再import，这样可以使得logger生效
     from services.updateservice import UpdateService
-    svc = UpdateService(name, handlerConfigPath)
+    svc = UpdateService(name, handlerConfigPath, workers=args.workers)
 
     startTime = time.time()
 
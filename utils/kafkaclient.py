@@ -20,10 +20,13 @@ class KafkaAdminClient(object):
         return method
 
 class KafkaProducer(object):
-    def __init__(self, brokers):
-        self.producer = Producer({
+    def __init__(self, brokers, settings=None):
+        producerConfig = {
                 'bootstrap.servers': brokers
-                })
+                }
+        if settings:
+            producerConfig.update(settings)
+        self.producer = Producer(producerConfig)
     
     def __getattr__(self, name):
         method = getattr(self.producer, name)